@@ -1,18 +1,101 @@
-from flask import Flask, jsonify, request, send_file
+import time
+_import_started = time.perf_counter()
+from flask import Flask, Request, abort, g, jsonify, make_response, request, send_file, Response, stream_with_context
+from werkzeug.exceptions import HTTPException
+from pymongo.errors import ConnectionFailure
 from flask_cors import CORS
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
+from io import BytesIO
 import os
-from pymongo import MongoClient
+
+# The modules below read their settings from the environment at import
+load_dotenv()
+
 from bson import ObjectId
-from sorting import sort_pdfs
-from merging import merge_care_gap_sheets
+from database import get_db
+from startup import first_request, record, startup_stats, warm_up
+from sorting import sort_pdfs, load_master, iter_sorted_zip
+from archive import compression_policy
+from pdf_ids import pdf_text_stats
+from fuzzy_dedup import REVIEW_SHEET_NAME, fuzzy_options
+from merging import build_merged_frame, append_to_master_store, import_master_workbook, MERGED_SHEET_NAME, REQUIRED_FIELDS
+from readers import is_unmapped, read_table
+from writers import OUTPUT_FORMATS, output_format, download_name, spool_table, write_table
+from master_store import MasterStoreBusy, get_master_store
+from gaps_store import save_gaps, get_gaps_meta, GapsVersionConflict
+from config_store import bump_configs_version, get_configs_version, list_configs, listing_etag, parse_cursor, parse_fields
+from cache import get_gaps, get_insurance_configs as cached_insurance_configs, get_column_plan, invalidate_config, cache_stats
+from jobs import create_job, start_job, get_job
+from metrics import Trace, render_prometheus, stage, trace, traced_chunks, use_trace
+from uploads import MAX_UPLOAD_BYTES, UploadBudgetExceeded, spooled_stream, start_budget, upload_source
+from upload_sessions import SessionNotFound, SessionNotReady, create_session, delete_session, finalize_session, session_files, session_status, start_sweeper, write_chunk
+from result_cache import merge_key, sort_key, open_result, copy_result, store_file, store_bytes, tee_chunks, result_cache_stats
 from functools import wraps
 import jwt
 
-load_dotenv()
+record("import", time.perf_counter() - _import_started)
+warm_up()
+
+class UploadRequest(Request):
+    # Uploads spool to disk past UPLOAD_SPOOL_KB instead of werkzeug's fixed 500KB
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return spooled_stream(content_length)
 
 app = Flask(__name__)
+app.request_class = UploadRequest
+# Requests over the upload budget are rejected with 413 before anything is read
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
+@app.before_request
+def start_upload_budget():
+    # Checked up front: the routes' own error handling would turn werkzeug's 413 into a 500
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_BYTES:
+        return upload_too_large(None)
+    start_budget()
+    start_sweeper()
+
+# Routes that read an upload session without using it up: a validation is followed by
+# the merge of the same session
+KEEPS_UPLOAD_SESSION = {'validate_care_gaps'}
+
+def request_files():
+    """
+    The request's uploaded files, or those of the finalized upload session it names
+    (uploadSession=<id> stands in for the multipart files of a merge/sort request).
+
+    Only called from routes behind require_auth, so unauthenticated requests neither get
+    their bodies parsed nor learn which session ids exist. An unknown session aborts
+    with 404, an unfinished one with 409; routes re-raise HTTPException past their own
+    error handling.
+    """
+    if 'session_files' not in g:
+        files = None
+        session_id = request.form.get('uploadSession')
+        if session_id:
+            try:
+                files = session_files(session_id)
+                g.upload_session = session_id
+            except SessionNotFound as e:
+                abort(make_response(jsonify({"message": str(e)}), 404))
+            except SessionNotReady as e:
+                abort(make_response(jsonify({"message": str(e)}), 409))
+        g.session_files = files
+    return g.session_files if g.session_files is not None else request.files
+
+@app.after_request
+def release_upload_session(response):
+    # Uploads contain PHI: a session a merge/sort succeeded with is deleted once the
+    # response (including a streamed one) has been sent. Jobs hold hard links to the
+    # files they stored, so they're unaffected; failed requests keep it for a retry
+    session_id = g.get('upload_session')
+    if session_id and response.status_code < 400 and request.endpoint not in KEEPS_UPLOAD_SESSION:
+        response.call_on_close(lambda: delete_session(session_id))
+    return response
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({"message": f"Upload is larger than the {MAX_UPLOAD_BYTES // 2**20} MB limit."}), 413
 
 # Configure CORS to allow credentials
 CORS(app, 
@@ -23,27 +106,31 @@ CORS(app,
          "https://nch-auditing.netlify.app",  # ADD THIS LINE
          os.getenv("FRONTEND_URL", "http://localhost:3000")
      ],
-     allow_headers=["Content-Type", "Authorization"],
+     allow_headers=["Content-Type", "Authorization", "X-Chunk-Sha256"],
+     expose_headers=["X-Dedup-Stats", "X-Gaps-Version", "X-Next-Cursor", "ETag"],
      methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"])
 
-# Establish MongoDB connection
-mongo_uri = os.getenv("MONGO_URI")
-mongo_client = None
-db = None
+# MongoDB is connected on first use (see database.get_db); indexes are ensured at boot
+# by the gunicorn master, or below when run directly
 
-if mongo_uri:
-    try:
-        mongo_client = MongoClient(mongo_uri)
-        # Test the connection
-        mongo_client.admin.command('ping')
-        db = mongo_client['configs']  # Use a specific database name
-        print("Connected to MongoDB successfully.")
-    except Exception as e:
-        print(f"Error connecting to MongoDB: {e}")
-        mongo_client = None
-        db = None
-else:
-    print("MONGO_URI not found in environment variables.")
+@app.errorhandler(ConnectionFailure)
+def database_down(e):
+    # Unreachable cluster (server selection timed out) or no client; routes re-raise
+    # ConnectionFailure past their own error handling so it ends up here
+    print(f"MongoDB unavailable: {e}")
+    return jsonify({"message": "Database connection is down."}), 503
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_first_request(response):
+    # Logs the first request each process serves (cold start latency)
+    started = g.get('request_started')
+    if started is not None:
+        first_request(time.perf_counter() - started)
+    return response
 
 # Get debug mode from environment
 DEBUG_MODE = os.getenv("DEBUG_MODE", "false").lower() == "true"
@@ -91,8 +178,7 @@ def require_auth(f):
 @require_auth
 def submit_json_to_mongo():
     
-    if db is None:
-        return jsonify({"message": "Database connection is down."}), 503
+    db = get_db()
 
     data_payload = request.json
     if not data_payload:
@@ -109,12 +195,15 @@ def submit_json_to_mongo():
         data_payload['created_at'] = datetime.now(timezone.utc)  # FIXED
         
         result = collection.insert_one(data_payload)
+        bump_configs_version(db)
             
         return jsonify({
             "message": "Configuration added successfully.",
             "id": str(result.inserted_id)  # Changed to 'id' for consistency
         }), 201
 
+    except ConnectionFailure:
+        raise
     except Exception as e:
         return jsonify({"message": "MongoDB insertion failed.", "error": str(e)}), 500
 
@@ -122,16 +211,32 @@ def submit_json_to_mongo():
 @app.route('/api/insurance-configs', methods=['GET'])
 @require_auth
 def get_insurance_configs():
-    if db is None:
-        return jsonify({"message": "Database connection is down."}), 503
+    db = get_db()
 
+    # ?fields=name for ids and names only, ?limit=N&after=<cursor> to page
     try:
-        collection = db.insurance
-        configs = list(collection.find())
-        for config in configs:
-            config['_id'] = str(config['_id'])  # Convert ObjectId to string
-        return jsonify(configs), 200
+        projection = parse_fields(request.args.get('fields'))
+        after = parse_cursor(request.args.get('after'))
+        limit = request.args.get('limit', type=int)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
 
+    try:
+        # Unchanged since the client's copy: skip the query entirely
+        etag = listing_etag(get_configs_version(db), projection, limit, str(after))
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            configs, next_cursor = list_configs(db, projection, limit, after)
+            response = jsonify(configs)
+            if next_cursor is not None:
+                response.headers['X-Next-Cursor'] = next_cursor
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response, response.status_code
+
+    except ConnectionFailure:
+        raise
     except Exception as e:
         return jsonify({"message": "MongoDB retrieval failed.", "error": str(e)}), 500
     
@@ -139,8 +244,7 @@ def get_insurance_configs():
 @app.route('/api/insurance-configs/<config_id>', methods=['PUT'])
 @require_auth
 def edit_insurance_config(config_id):
-    if db is None:
-        return jsonify({"message": "Database connection is down."}), 503
+    db = get_db()
 
     data_payload = request.json
     if not data_payload:
@@ -148,6 +252,10 @@ def edit_insurance_config(config_id):
 
     try:
         collection = db.insurance
+        
+        # Stamp the edit so cached copies of this config are refreshed
+        data_payload['updated_at'] = datetime.now(timezone.utc)
+        
         result = collection.update_one(
             {"_id": ObjectId(config_id)},
             {"$set": data_payload}
@@ -156,8 +264,13 @@ def edit_insurance_config(config_id):
         if result.matched_count == 0:
             return jsonify({"message": "Configuration not found."}), 404
 
+        invalidate_config(config_id)
+        bump_configs_version(db)
+
         return jsonify({"message": "Configuration updated successfully."}), 200
 
+    except ConnectionFailure:
+        raise
     except Exception as e:
         return jsonify({"message": "MongoDB update failed.", "error": str(e)}), 500
     
@@ -165,8 +278,7 @@ def edit_insurance_config(config_id):
 @app.route('/api/insurance-configs/<config_id>', methods=['DELETE'])
 @require_auth
 def delete_insurance_config(config_id):
-    if db is None:
-        return jsonify({"message": "Database connection is down."}), 503
+    db = get_db()
 
     try:
         collection = db.insurance
@@ -175,8 +287,13 @@ def delete_insurance_config(config_id):
         if result.deleted_count == 0:
             return jsonify({"message": "Configuration not found."}), 404
 
+        invalidate_config(config_id)
+        bump_configs_version(db)
+
         return jsonify({"message": "Configuration deleted successfully."}), 200
 
+    except ConnectionFailure:
+        raise
     except Exception as e:
         return jsonify({"message": "MongoDB deletion failed.", "error": str(e)}), 500
 
@@ -184,40 +301,33 @@ def delete_insurance_config(config_id):
 @app.route('/api/gaps-file', methods=['POST'])
 @require_auth
 def upload_gaps_file():
-    if db is None:
-        return jsonify({"message": "Database connection is down."}), 503
+    db = get_db()
 
     try:
         gaps_file = request.files.get('gapsFile')
         if not gaps_file:
             return jsonify({"message": "Gaps file is required."}), 400
         
-        from io import BytesIO
-        import pandas as pd
-        
-        # Read and validate the file - support both Excel and CSV
-        file_content = gaps_file.read()
-        
-        if gaps_file.filename.endswith('.csv'):
-            gaps_df = pd.read_csv(BytesIO(file_content))
-        else:
-            gaps_df = pd.read_excel(BytesIO(file_content))
-        
-        # Convert to JSON for storage
-        gaps_data = gaps_df.to_dict('records')
+        # Read and validate the file - support both Excel and CSV - from the spooled upload
+        gaps_df = read_table(upload_source(gaps_file), gaps_file.filename)
         
-        # Store in MongoDB (replace existing if any)
-        collection = db.system_files
-        collection.delete_many({"file_type": "gaps"})
-        collection.insert_one({
-            "file_type": "gaps",
-            "data": gaps_data,
-            "columns": list(gaps_df.columns),
-            "uploaded_at": datetime.now(timezone.utc)
-        })
+        # Store the changes against the active version as a new version and switch to it
+        try:
+            meta = save_gaps(db, gaps_df)
+        except GapsVersionConflict as e:
+            return jsonify({"message": str(e)}), 409
         
-        return jsonify({"message": "Gaps file uploaded successfully."}), 201
+        if meta.get("unchanged"):
+            return jsonify({"message": "Gaps file is unchanged.", "version": meta.get("version", 1)}), 200
+        return jsonify({
+            "message": "Gaps file uploaded successfully.",
+            "version": meta["version"],
+            "storage": "snapshot" if meta["snapshot"] else "delta",
+            "changes": meta["changes"]
+        }), 201
         
+    except ConnectionFailure:
+        raise
     except Exception as e:
         if DEBUG_MODE:
             print(f"Error uploading gaps file: {str(e)}")
@@ -229,120 +339,441 @@ def upload_gaps_file():
 @app.route('/api/gaps-file', methods=['GET'])
 @require_auth
 def get_gaps_file_info():
-    if db is None:
-        return jsonify({"message": "Database connection is down."}), 503
+    db = get_db()
 
     try:
-        collection = db.system_files
-        gaps_file = collection.find_one({"file_type": "gaps"})
+        # Metadata of the active version only; row data lives in chunks
+        gaps_file = get_gaps_meta(db)
         
         if gaps_file:
             return jsonify({
                 "exists": True,
                 "uploaded_at": gaps_file.get("uploaded_at"),
-                "row_count": len(gaps_file.get("data", []))
+                "row_count": gaps_file.get("row_count", 0),
+                "version": gaps_file.get("version", 1),
+                "base_version": gaps_file.get("base_version"),
+                "storage": "snapshot" if gaps_file.get("snapshot", True) else "delta",
+                "changes": gaps_file.get("changes")
             }), 200
         else:
             return jsonify({"exists": False}), 200
             
+    except ConnectionFailure:
+        raise
     except Exception as e:
         return jsonify({"message": "Failed to retrieve gaps file info.", "error": str(e)}), 500
 
+def get_care_gap_files_with_configs():
+    """Collect the numbered careSheet_N / configId_N pairs from the current request"""
+    care_gap_files_with_configs = []
+    
+    file_index = 0
+    while True:
+        file_key = f'careSheet_{file_index}'
+        config_key = f'configId_{file_index}'
+        
+        care_file = request_files().get(file_key)
+        config_id = request.form.get(config_key)
+        
+        if not care_file or not config_id:
+            break
+            
+        care_gap_files_with_configs.append((care_file, config_id))
+        file_index += 1
+    
+    return care_gap_files_with_configs
+
+def send_open_file(f, mimetype, name):
+    """Stream an open binary file as a download"""
+    response = send_file(f, mimetype=mimetype, as_attachment=True, download_name=name)
+    response.content_length = os.fstat(f.fileno()).st_size
+    return response
+
+def send_spooled_file(path, fmt, basename):
+    """
+    Stream a spooled output file as a download. The file is unlinked as soon as it's
+    open, so the disk space is freed when the response finishes (or the worker dies).
+    """
+    f = open(path, 'rb')
+    os.unlink(path)
+    return send_open_file(f, OUTPUT_FORMATS[fmt][0], download_name(basename, fmt))
+
+def request_fuzzy_options(fmt):
+    """
+    Fuzzy dedup options from the form (fuzzyDedup, fuzzyThreshold, fuzzyIdThreshold), or
+    None when it isn't requested.
+    
+    Raises:
+        ValueError: Invalid thresholds, or an output format without room for the review sheet
+    """
+    if request.form.get('fuzzyDedup', 'false').lower() != 'true':
+        return None
+    if fmt != 'xlsx':
+        raise ValueError("Fuzzy dedup needs xlsx output for its review sheet.")
+    return fuzzy_options(request.form.get('fuzzyThreshold'), request.form.get('fuzzyIdThreshold'))
+
+def request_gaps_version(db):
+    """
+    The gaps version a merge maps gaps with: gapsVersion from the form (to reproduce an
+    earlier merge), else the active one. Loads its lookup into the cache the merge reads from.
+    
+    Returns:
+        int or None: The version, or None if no gaps file has been uploaded
+    
+    Raises:
+        ValueError: gapsVersion isn't a version number, or that version is no longer kept
+    """
+    requested = request.form.get('gapsVersion')
+    version = None
+    if requested:
+        try:
+            version = int(requested)
+        except ValueError:
+            raise ValueError("gapsVersion must be a version number.")
+    gaps = get_gaps(db, version)
+    if gaps is None and version is not None and get_gaps_meta(db) is not None:
+        raise ValueError(f"Gaps file version {version} isn't available.")
+    return gaps[0] if gaps else None
+
+def with_dedup_stats(response, dedup_stats):
+    # Rows each dedup rule removed, for auditing why rows disappeared
+    import json
+    response.headers['X-Dedup-Stats'] = json.dumps(dedup_stats)
+    return response
+
+def with_gaps_version(response, gaps_version):
+    # The gaps version the merge mapped with; pass it back as gapsVersion to reproduce it
+    if gaps_version is not None:
+        response.headers['X-Gaps-Version'] = str(gaps_version)
+    return response
+
 # Route for appending/merging care gap sheets
 @app.route('/api/append-care-gaps', methods=['POST'])
 @require_auth
 def append_care_gaps():
-    if db is None:
-        return jsonify({"message": "Database connection is down."}), 503
+    db = get_db()
 
     try:
         # Get the uploaded files
-        master_file = request.files.get('masterFile')
+        master_file = request_files().get('masterFile')
         if not master_file:
             return jsonify({"message": "Master file is required."}), 400
         
-        # Get gaps file from database
-        gaps_doc = db.system_files.find_one({"file_type": "gaps"})
-        if not gaps_doc:
+        # Pin the gaps version the merge maps with (loads it into the cache the merge reads from)
+        try:
+            gaps_version = request_gaps_version(db)
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        if gaps_version is None:
             return jsonify({"message": "Gaps file not found. Please upload it in Settings."}), 400
         
         # Get the enableToBeRemoved boolean
         enable_to_be_removed = request.form.get('enableToBeRemoved', 'false').lower() == 'true'
         
+        # Output format: xlsx (default), csv or parquet
+        try:
+            fmt = output_format(request.form.get('outputFormat'))
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        
+        # Optional fuzzy dedup, whose review sheet is a second worksheet of the xlsx output
+        try:
+            fuzzy = request_fuzzy_options(fmt)
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        
         # Get care gap files and their config IDs
-        care_gap_files_with_configs = []
+        care_gap_files_with_configs = get_care_gap_files_with_configs()
         
-        file_index = 0
-        while True:
-            file_key = f'careSheet_{file_index}'
-            config_key = f'configId_{file_index}'
+        if len(care_gap_files_with_configs) == 0:
+            return jsonify({"message": "At least one care gap sheet is required."}), 400
+        
+        with trace("merge", sheets=len(care_gap_files_with_configs), format=fmt) as current:
+            # An identical earlier submission (same files, configs, gaps file and flags) is served from the result cache
+            with stage("cache_lookup"):
+                cache_key = merge_key(db, master_file, care_gap_files_with_configs, enable_to_be_removed, fmt,
+                                      fuzzy.key() if fuzzy else None, gaps_version)
+                cached = open_result(cache_key)
+            current.fields["cached"] = cached is not None
+            if cached is not None:
+                f, meta = cached
+                response = send_open_file(f, OUTPUT_FORMATS[fmt][0], download_name('merged_care_gaps', fmt))
+                return with_gaps_version(with_dedup_stats(response, meta.get('dedup_stats', {})), meta.get('gaps_version'))
             
-            care_file = request.files.get(file_key)
-            config_id = request.form.get(config_key)
+            # Call the merging function
+            counters = {}
+            review_sheets = {}
+            merged_frame = build_merged_frame(
+                master_file,
+                care_gap_files_with_configs,
+                db,
+                enable_to_be_removed,
+                progress=counters.update,
+                fuzzy=fuzzy,
+                review=lambda sheet: review_sheets.update({REVIEW_SHEET_NAME: sheet}),
+                gaps_version=gaps_version
+            )
             
-            if not care_file or not config_id:
-                break
-                
-            care_gap_files_with_configs.append((care_file, config_id))
-            file_index += 1
-        
+            # Spool the output to disk and stream it back as a download
+            path = spool_table(merged_frame, fmt, sheet_name=MERGED_SHEET_NAME, extra_sheets=review_sheets)
+            del merged_frame
+            dedup_stats = {name: count for name, count in counters.items() if '_duplicates_' in name}
+            store_file(cache_key, path, {"dedup_stats": dedup_stats, "gaps_version": gaps_version})
+            response = send_spooled_file(path, fmt, 'merged_care_gaps')
+            return with_gaps_version(with_dedup_stats(response, dedup_stats), gaps_version)
+            
+    except (HTTPException, ConnectionFailure):
+        raise
+    except UploadBudgetExceeded as e:
+        return jsonify({"message": str(e)}), 413
+    except Exception as e:
+        if DEBUG_MODE:
+            print(f"Error in append_care_gaps: {e}")
+            import traceback
+            traceback.print_exc()
+        return jsonify({"message": "Merging failed."}), 500
+    
+# Route for checking care gap sheets against their configs before merging
+@app.route('/api/validate-care-gaps', methods=['POST'])
+@require_auth
+def validate_care_gaps():
+    db = get_db()
+
+    try:
+        care_gap_files_with_configs = get_care_gap_files_with_configs()
         if len(care_gap_files_with_configs) == 0:
             return jsonify({"message": "At least one care gap sheet is required."}), 400
+
+        configs = cached_insurance_configs(db, [config_id for _, config_id in care_gap_files_with_configs])
+        sheets = []
+        for care_file, config_id in care_gap_files_with_configs:
+            config = configs.get(config_id)
+            if config is None:
+                return jsonify({"message": f"Insurance config {config_id} not found."}), 400
+
+            # Only the header row is read; resolution uses the same cached plan as the merge
+            columns = read_table(upload_source(care_file), care_file.filename, nrows=0).columns
+            plan = get_column_plan(config, columns)
+            fields = dict(config.get('fields', {}))
+            if fields.get("Insurance Provided") == "No":
+                # Insurance is a constant from the config, not a sheet column
+                fields.pop("Insurance", None)
+            missing_required = [field for field in REQUIRED_FIELDS if plan[field] is None]
+            sheets.append({
+                "filename": care_file.filename,
+                "config_id": config_id,
+                "config_name": config.get('name'),
+                "resolved": {field: col for field, col in plan.items() if col is not None},
+                "missing_required": missing_required,
+                # Mapped in the config but not found in the sheet's headers
+                "missing_mapped": [field for field, col in plan.items() if col is None and not is_unmapped(fields.get(field))],
+                "ok": not missing_required,
+            })
+
+        return jsonify({"ok": all(sheet["ok"] for sheet in sheets), "sheets": sheets}), 200
+
+    except (HTTPException, ConnectionFailure):
+        raise
+    except Exception as e:
+        if DEBUG_MODE:
+            print(f"Error in validate_care_gaps: {e}")
+        return jsonify({"message": "Validation failed.", "error": str(e)}), 500
+
+# Route for seeding (or resetting) the server-side master store from a master workbook
+@app.route('/api/master-store/import', methods=['POST'])
+@require_auth
+def import_master_store():
+    db = get_db()
+
+    try:
+        master_file = request_files().get('masterFile')
+        if not master_file:
+            return jsonify({"message": "Master file is required."}), 400
         
-        # Call the merging function
-        merged_file_bytes = merge_care_gap_sheets(
-            master_file,
-            care_gap_files_with_configs,
-            db,
-            enable_to_be_removed
-        )
+        enable_to_be_removed = request.form.get('enableToBeRemoved', 'false').lower() == 'true'
+        stats = import_master_workbook(get_master_store(db), master_file, enable_to_be_removed)
+        return jsonify({"message": "Master file imported successfully.", **stats}), 201
+        
+    except (HTTPException, ConnectionFailure):
+        raise
+    except MasterStoreBusy as e:
+        return jsonify({"message": str(e)}), 409
+    except Exception as e:
+        if DEBUG_MODE:
+            print(f"Error in import_master_store: {e}")
+            import traceback
+            traceback.print_exc()
+        return jsonify({"message": "Failed to import master file."}), 500
+
+# Route for merging care gap sheets into the master store (no master upload needed)
+@app.route('/api/master-store/append', methods=['POST'])
+@require_auth
+def append_master_store():
+    db = get_db()
+
+    try:
+        try:
+            gaps_version = request_gaps_version(db)
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        if gaps_version is None:
+            return jsonify({"message": "Gaps file not found. Please upload it in Settings."}), 400
         
-        if not merged_file_bytes:
-            return jsonify({"message": "Merging returned empty file."}), 500
+        care_gap_files_with_configs = get_care_gap_files_with_configs()
+        if len(care_gap_files_with_configs) == 0:
+            return jsonify({"message": "At least one care gap sheet is required."}), 400
         
-        # Send the merged file back as a download
-        from io import BytesIO
-        return send_file(
-            BytesIO(merged_file_bytes),
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name='merged_care_gaps.xlsx'
-        )
+        with trace("master_store_append", sheets=len(care_gap_files_with_configs)):
+            stats = append_to_master_store(get_master_store(db), care_gap_files_with_configs, db,
+                                           gaps_version=gaps_version)
+            stats["gaps_version"] = gaps_version
+        return jsonify(stats), 200
         
+    except (HTTPException, ConnectionFailure):
+        raise
+    except MasterStoreBusy as e:
+        return jsonify({"message": str(e)}), 409
+    except UploadBudgetExceeded as e:
+        return jsonify({"message": str(e)}), 413
     except Exception as e:
         if DEBUG_MODE:
-            print(f"Error in append_care_gaps: {e}")
+            print(f"Error in append_master_store: {e}")
             import traceback
             traceback.print_exc()
         return jsonify({"message": "Merging failed."}), 500
-    
+
+# Route for master store info
+@app.route('/api/master-store', methods=['GET'])
+@require_auth
+def get_master_store_info():
+    db = get_db()
+
+    try:
+        return jsonify(get_master_store(db).info()), 200
+    except ConnectionFailure:
+        raise
+    except Exception as e:
+        return jsonify({"message": "Failed to retrieve master store info.", "error": str(e)}), 500
+
+# Route for exporting the master store as a workbook
+@app.route('/api/master-store/export', methods=['GET'])
+@require_auth
+def export_master_store():
+    db = get_db()
+
+    try:
+        enable_to_be_removed = request.args.get('enableToBeRemoved', 'false').lower() == 'true'
+        try:
+            fmt = output_format(request.args.get('outputFormat'))
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        
+        path = get_master_store(db).export(fmt, enable_to_be_removed)
+        return send_spooled_file(path, fmt, 'merged_care_gaps')
+        
+    except ConnectionFailure:
+        raise
+    except Exception as e:
+        if DEBUG_MODE:
+            print(f"Error in export_master_store: {e}")
+            import traceback
+            traceback.print_exc()
+        return jsonify({"message": "Export failed."}), 500
+
+# Route for clearing the master store
+@app.route('/api/master-store', methods=['DELETE'])
+@require_auth
+def clear_master_store():
+    db = get_db()
+
+    try:
+        get_master_store(db).clear()
+        return jsonify({"message": "Master store cleared."}), 200
+    except ConnectionFailure:
+        raise
+    except MasterStoreBusy as e:
+        return jsonify({"message": str(e)}), 409
+    except Exception as e:
+        return jsonify({"message": "Failed to clear master store.", "error": str(e)}), 500
+
 # Route for sorting PDFs
 @app.route('/api/sort-pdfs', methods=['POST'])
 @require_auth
 def sort_pdfs_route():
     try:
         # Get the uploaded master file
-        master_file = request.files.get('masterFile')
+        master_file = request_files().get('masterFile')
         if not master_file:
             return jsonify({"message": "Master file is required."}), 400
         
         # Get the uploaded PDF files
-        pdf_files = request.files.getlist('pdfFiles')
+        pdf_files = request_files().getlist('pdfFiles')
         if not pdf_files or len(pdf_files) == 0:
             return jsonify({"message": "At least one PDF file is required."}), 400
         
+        # Match PDFs whose filename has no member ID by the text of their first pages
+        content_lookup = request.form.get('contentLookup', 'false').lower() == 'true'
+        
+        # auto (store PDFs that don't compress), store or deflate, at compressionLevel 1-9
+        try:
+            compression = compression_policy(request.form.get('compression'), request.form.get('compressionLevel'))
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        
+        # Streaming mode sends ZIP entries as each PDF is routed, so memory stays bounded
+        stream = request.form.get('stream', 'false').lower() == 'true'
+        
         # Limit to prevent memory issues
-        if len(pdf_files) > 200:
-            return jsonify({"message": "Maximum 200 PDF files allowed at once. Please split into smaller batches."}), 400
+        if not stream and len(pdf_files) > 200:
+            return jsonify({"message": "Maximum 200 PDF files allowed at once. Please split into smaller batches or use streaming mode."}), 400
+        
+        if stream:
+            # The trace stays open until the streamed response has been sent
+            current = Trace("sort", pdfs=len(pdf_files), stream=True)
+            try:
+                with use_trace(current):
+                    # Same master and PDFs as an earlier sort: send the stored archive
+                    with stage("cache_lookup"):
+                        cache_key = sort_key(master_file, pdf_files, content_lookup=content_lookup,
+                                             compression=compression.key())
+                        cached = open_result(cache_key)
+                    current.fields["cached"] = cached is not None
+                    if cached is not None:
+                        current.finish()
+                        return send_open_file(cached[0], 'application/zip', 'sorted_pdfs.zip')
+                    
+                    # Load the master sheet up front so a bad file still gets a proper error response
+                    df, member_index = load_master(master_file)
+            except Exception:
+                current.finish("error")
+                raise
+            chunks = iter_sorted_zip(df, member_index, pdf_files, content_lookup=content_lookup,
+                                     compression=compression)
+            return Response(
+                stream_with_context(traced_chunks(current, tee_chunks(cache_key, chunks))),
+                mimetype='application/zip',
+                headers={"Content-Disposition": "attachment; filename=sorted_pdfs.zip"}
+            )
         
-        # Call the sorting function
-        sorted_zip_bytes = sort_pdfs(master_file, pdf_files)
+        with trace("sort", pdfs=len(pdf_files), stream=False) as current:
+            # Same master and PDFs as an earlier sort: send the stored archive
+            with stage("cache_lookup"):
+                cache_key = sort_key(master_file, pdf_files, content_lookup=content_lookup,
+                                     compression=compression.key())
+                cached = open_result(cache_key)
+            current.fields["cached"] = cached is not None
+            if cached is not None:
+                return send_open_file(cached[0], 'application/zip', 'sorted_pdfs.zip')
+            
+            # Call the sorting function
+            sorted_zip_bytes = sort_pdfs(master_file, pdf_files, content_lookup=content_lookup,
+                                         compression=compression)
         
         if not sorted_zip_bytes:
             return jsonify({"message": "Sorting returned empty ZIP."}), 500
+        store_bytes(cache_key, sorted_zip_bytes)
         
         # Send the sorted ZIP back as a download
-        from io import BytesIO
         return send_file(
             BytesIO(sorted_zip_bytes),
             mimetype='application/zip',
@@ -350,6 +781,10 @@ def sort_pdfs_route():
             download_name='sorted_pdfs.zip'
         )
         
+    except HTTPException:
+        raise
+    except UploadBudgetExceeded as e:
+        return jsonify({"message": str(e)}), 413
     except Exception as e:
         if DEBUG_MODE:
             print(f"Error in sort_pdfs_route: {e}")
@@ -357,6 +792,245 @@ def sort_pdfs_route():
             traceback.print_exc()
         return jsonify({"message": "Sorting failed."}), 500
 
+# Route for submitting a merge as a background job
+@app.route('/api/jobs/merge', methods=['POST'])
+@require_auth
+def submit_merge_job():
+    db = get_db()
+
+    try:
+        master_file = request_files().get('masterFile')
+        if not master_file:
+            return jsonify({"message": "Master file is required."}), 400
+        
+        try:
+            gaps_version = request_gaps_version(db)
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        if gaps_version is None:
+            return jsonify({"message": "Gaps file not found. Please upload it in Settings."}), 400
+        
+        enable_to_be_removed = request.form.get('enableToBeRemoved', 'false').lower() == 'true'
+        
+        try:
+            fmt = output_format(request.form.get('outputFormat'))
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        
+        try:
+            fuzzy = request_fuzzy_options(fmt)
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        
+        care_gap_files_with_configs = get_care_gap_files_with_configs()
+        if len(care_gap_files_with_configs) == 0:
+            return jsonify({"message": "At least one care gap sheet is required."}), 400
+        
+        # Spool uploads to disk; the request's own copies are gone once we return
+        job = create_job('merge', download_name('merged_care_gaps', fmt), OUTPUT_FORMATS[fmt][0])
+        stored_master = job.store_upload(master_file)
+        stored_sheets = [(job.store_upload(care_file), config_id) for care_file, config_id in care_gap_files_with_configs]
+        
+        def work(job):
+            with trace("merge", job_id=job.id, sheets=len(stored_sheets), format=fmt) as current:
+                with stage("cache_lookup"):
+                    cache_key = merge_key(db, stored_master, stored_sheets, enable_to_be_removed, fmt,
+                                          fuzzy.key() if fuzzy else None, gaps_version)
+                    meta = copy_result(cache_key, job.result_path)
+                current.fields["cached"] = meta is not None
+                if meta is not None:
+                    job.update_progress(cached=True, gaps_version=gaps_version, **meta.get('dedup_stats', {}))
+                    return
+                
+                counters = {}
+                def progress(**update):
+                    counters.update(update)
+                    job.update_progress(**update)
+                
+                review_sheets = {}
+                merged_frame = build_merged_frame(
+                    stored_master,
+                    stored_sheets,
+                    db,
+                    enable_to_be_removed,
+                    progress=progress,
+                    fuzzy=fuzzy,
+                    review=lambda sheet: review_sheets.update({REVIEW_SHEET_NAME: sheet}),
+                    gaps_version=gaps_version
+                )
+                write_table(merged_frame, job.result_path, fmt, sheet_name=MERGED_SHEET_NAME, extra_sheets=review_sheets)
+                store_file(cache_key, job.result_path, {"dedup_stats": {name: count for name, count in counters.items() if '_duplicates_' in name},
+                                                        "gaps_version": gaps_version})
+        
+        start_job(job, work)
+        return jsonify({"job_id": job.id, "status": job.status}), 202
+        
+    except (HTTPException, ConnectionFailure):
+        raise
+    except Exception as e:
+        if DEBUG_MODE:
+            print(f"Error in submit_merge_job: {e}")
+            import traceback
+            traceback.print_exc()
+        return jsonify({"message": "Failed to submit merge job."}), 500
+
+# Route for submitting a PDF sort as a background job
+@app.route('/api/jobs/sort', methods=['POST'])
+@require_auth
+def submit_sort_job():
+    try:
+        master_file = request_files().get('masterFile')
+        if not master_file:
+            return jsonify({"message": "Master file is required."}), 400
+        
+        pdf_files = request_files().getlist('pdfFiles')
+        if not pdf_files or len(pdf_files) == 0:
+            return jsonify({"message": "At least one PDF file is required."}), 400
+        
+        content_lookup = request.form.get('contentLookup', 'false').lower() == 'true'
+        
+        try:
+            compression = compression_policy(request.form.get('compression'), request.form.get('compressionLevel'))
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        
+        job = create_job('sort', 'sorted_pdfs.zip', 'application/zip')
+        stored_master = job.store_upload(master_file)
+        stored_pdfs = [job.store_upload(pdf) for pdf in pdf_files]
+        
+        def work(job):
+            with trace("sort", job_id=job.id, pdfs=len(stored_pdfs)) as current:
+                with stage("cache_lookup"):
+                    cache_key = sort_key(stored_master, stored_pdfs, content_lookup=content_lookup,
+                                         compression=compression.key())
+                    cached = copy_result(cache_key, job.result_path) is not None
+                current.fields["cached"] = cached
+                if cached:
+                    job.update_progress(cached=True, pdfs_routed=len(stored_pdfs), pdfs_total=len(stored_pdfs))
+                    return
+                
+                df, member_index = load_master(stored_master)
+                # Write the archive entry by entry straight to the result file
+                with open(job.result_path, 'wb') as f:
+                    for chunk in iter_sorted_zip(df, member_index, stored_pdfs, progress=job.update_progress,
+                                                 content_lookup=content_lookup, compression=compression):
+                        f.write(chunk)
+                store_file(cache_key, job.result_path)
+        
+        start_job(job, work)
+        return jsonify({"job_id": job.id, "status": job.status}), 202
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        if DEBUG_MODE:
+            print(f"Error in submit_sort_job: {e}")
+            import traceback
+            traceback.print_exc()
+        return jsonify({"message": "Failed to submit sort job."}), 500
+
+# Route for starting a chunked, resumable upload session
+@app.route('/api/uploads', methods=['POST'])
+@require_auth
+def create_upload_session():
+    data = request.get_json(silent=True) or {}
+    try:
+        upload_session = create_session(data.get('files'), data.get('chunk_size'))
+        return jsonify(upload_session), 201
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"message": "Failed to create upload session.", "error": str(e)}), 500
+
+# Route for uploading one chunk of a session's file (raw body, X-Chunk-Sha256 header)
+@app.route('/api/uploads/<session_id>/files/<int:file_index>/chunks/<int:chunk>', methods=['PUT'])
+@require_auth
+def upload_chunk(session_id, file_index, chunk):
+    try:
+        stored = write_chunk(session_id, file_index, chunk, request.stream, request.headers.get('X-Chunk-Sha256'))
+        return jsonify(stored), 200
+    except SessionNotFound as e:
+        return jsonify({"message": str(e)}), 404
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"message": "Failed to store chunk.", "error": str(e)}), 500
+
+# Route for listing the chunks a session is still missing
+@app.route('/api/uploads/<session_id>', methods=['GET'])
+@require_auth
+def get_upload_session(session_id):
+    try:
+        return jsonify(session_status(session_id)), 200
+    except SessionNotFound as e:
+        return jsonify({"message": str(e)}), 404
+
+# Route for finalizing a session once all chunks arrived
+@app.route('/api/uploads/<session_id>/finalize', methods=['POST'])
+@require_auth
+def finalize_upload_session(session_id):
+    try:
+        return jsonify(finalize_session(session_id)), 200
+    except SessionNotFound as e:
+        return jsonify({"message": str(e)}), 404
+    except SessionNotReady as e:
+        return jsonify({"message": str(e), **session_status(session_id)}), 409
+    except Exception as e:
+        return jsonify({"message": "Failed to finalize upload session.", "error": str(e)}), 500
+
+# Route for discarding an upload session and its files
+@app.route('/api/uploads/<session_id>', methods=['DELETE'])
+@require_auth
+def delete_upload_session(session_id):
+    try:
+        if not delete_session(session_id):
+            return jsonify({"message": "Upload session not found."}), 404
+        return jsonify({"message": "Upload session deleted."}), 200
+    except SessionNotFound as e:
+        return jsonify({"message": str(e)}), 404
+
+# Route for polling a background job's status and progress
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@require_auth
+def get_job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"message": "Job not found."}), 404
+    
+    status = job.to_dict()
+    status.pop('pid', None)
+    return jsonify(status), 200
+
+# Route for downloading a finished job's result
+@app.route('/api/jobs/<job_id>/download', methods=['GET'])
+@require_auth
+def download_job_result(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"message": "Job not found."}), 404
+    
+    if job.status != 'done':
+        return jsonify({"message": f"Job is {job.status}.", "status": job.status}), 409
+    
+    return send_file(
+        job.result_path,
+        mimetype=job.mimetype,
+        as_attachment=True,
+        download_name=job.download_name
+    )
+
+# Route for gaps/config, PDF text and result cache hit and miss counts
+@app.route('/api/cache-stats', methods=['GET'])
+@require_auth
+def get_cache_stats():
+    return jsonify({**cache_stats(), **pdf_text_stats(), **result_cache_stats()}), 200
+
+# Route for per-stage timing, CPU, memory and row metrics in Prometheus text format
+@app.route('/api/metrics', methods=['GET'])
+@require_auth
+def get_metrics():
+    return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
+
 # Route for login (NO AUTH REQUIRED)
 @app.route('/api/login', methods=['POST'])
 def login():
@@ -409,5 +1083,13 @@ def login():
 def health():
     return jsonify({"status": "ok", "message": "Backend is running"}), 200
 
+# Route for this worker's startup timings (import, warm-up, first request)
+@app.route('/api/startup-stats', methods=['GET'])
+@require_auth
+def get_startup_stats():
+    return jsonify(startup_stats()), 200
+
 if __name__ == '__main__':
+    from database import bootstrap_indexes
+    bootstrap_indexes()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,342 @@
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+from uploads import iter_copy, upload_size, upload_view
+
+# Archive stage for the sorted-PDF ZIP.
+#
+# Most PDFs are already compressed internally, so deflating them again costs CPU for a
+# few percent at best. In "auto" mode each entry's compressibility is sampled with a fast
+# deflate of ARCHIVE_SAMPLE_KB from its middle (past the uncompressed header); entries
+# that wouldn't shrink by ARCHIVE_MIN_SAVING are stored as they are, the rest are
+# deflated on a small thread pool (zlib releases the GIL) while later entries are
+# routed, and written in routed order.
+#
+# zipfile can't take an entry that's already compressed, so entries go through a minimal
+# ZIP writer (ZipWriter). Entries compressed ahead get their CRC and sizes in the local
+# header; ones too large to compress in memory are deflated as they're written and use
+# a data descriptor, as zipfile does for an unseekable output.
+
+# Default policy: auto, store or deflate (per-request "compression" overrides it)
+ARCHIVE_COMPRESSION = os.getenv("ARCHIVE_COMPRESSION", "auto").strip().lower()
+ARCHIVE_COMPRESSION_LEVEL = int(os.getenv("ARCHIVE_COMPRESSION_LEVEL", "6"))
+# Bytes of each entry test-compressed in auto mode
+ARCHIVE_SAMPLE_BYTES = int(os.getenv("ARCHIVE_SAMPLE_KB", "64")) * 2**10
+# Entries whose sample shrinks by less than this fraction are stored
+ARCHIVE_MIN_SAVING = float(os.getenv("ARCHIVE_MIN_SAVING", "0.05"))
+# Compression threads; 1 compresses in the request thread
+ARCHIVE_THREADS = int(os.getenv("ARCHIVE_THREADS", str(min(4, os.cpu_count() or 1))))
+# Compressed data held for entries waiting to be written, and the largest entry
+# compressed in memory (bigger ones are deflated as they're written)
+ARCHIVE_MAX_PENDING_BYTES = int(os.getenv("ARCHIVE_MAX_PENDING_MB", "64")) * 2**20
+ARCHIVE_MAX_ENTRY_BYTES = int(os.getenv("ARCHIVE_MAX_ENTRY_MB", "16")) * 2**20
+
+COMPRESSION_MODES = ("auto", "store", "deflate")
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+_pool = None
+_pool_lock = threading.Lock()
+
+class CompressionPolicy:
+    def __init__(self, mode: str = "auto", level: int = 6):
+        self.mode = mode
+        self.level = level
+
+    def key(self) -> str:
+        """Identifies the policy in result cache keys (outputs differ between policies)"""
+        return "store" if self.mode == "store" else f"{self.mode}-{self.level}"
+
+def compression_policy(mode: Optional[str] = None, level=None) -> CompressionPolicy:
+    """
+    Validate a requested compression policy (defaults to ARCHIVE_COMPRESSION at
+    ARCHIVE_COMPRESSION_LEVEL).
+
+    Raises:
+        ValueError: Unknown mode, or a level outside 1-9
+    """
+    mode = (mode or ARCHIVE_COMPRESSION).strip().lower()
+    if mode not in COMPRESSION_MODES:
+        raise ValueError(f"Unsupported compression '{mode}'. Use auto, store or deflate.")
+    try:
+        level = int(level) if level not in (None, "") else ARCHIVE_COMPRESSION_LEVEL
+    except (TypeError, ValueError):
+        raise ValueError("Compression level must be a number from 1 to 9.")
+    if not 1 <= level <= 9:
+        raise ValueError("Compression level must be a number from 1 to 9.")
+    return CompressionPolicy(mode, level)
+
+def new_archive_stats() -> Dict:
+    return {"entries_stored": 0, "entries_deflated": 0, "bytes_in": 0, "bytes_out": 0,
+            "bytes_saved": 0, "compress_cpu_seconds": 0.0}
+
+def _get_pool():
+    """Thread pool shared across archives, created on first use (no threads before a fork)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _pool = ThreadPoolExecutor(max_workers=ARCHIVE_THREADS, thread_name_prefix="zip")
+        return _pool
+
+def _raw_deflate(level: int):
+    return zlib.compressobj(level, zlib.DEFLATED, -15)
+
+def _deflate_upload(upload, level: int) -> Tuple[int, int, bytes, float]:
+    """Compress a whole upload (runs on the pool): (crc, size, compressed bytes, CPU seconds)"""
+    started = time.thread_time()
+    with upload_view(upload) as view:
+        crc = zlib.crc32(view)
+        compressor = _raw_deflate(level)
+        data = compressor.compress(view) + compressor.flush()
+        size = len(view)
+    return crc, size, data, time.thread_time() - started
+
+def _completed(value) -> Future:
+    future = Future()
+    future.set_result(value)
+    return future
+
+def _worth_compressing(upload, size: int) -> Tuple[bool, float]:
+    """
+    Whether a fast deflate of ARCHIVE_SAMPLE_BYTES from the middle of the upload saves
+    ARCHIVE_MIN_SAVING: (verdict, CPU seconds spent sampling)
+    """
+    started = time.thread_time()
+    start = max(0, (size - ARCHIVE_SAMPLE_BYTES) // 2)
+    with upload_view(upload) as view:
+        sample = view[start:start + ARCHIVE_SAMPLE_BYTES]
+        try:
+            compressor = _raw_deflate(1)
+            compressed = len(compressor.compress(sample)) + len(compressor.flush())
+            sampled = len(sample)
+        finally:
+            if isinstance(sample, memoryview):
+                sample.release()
+    return compressed <= sampled * (1 - ARCHIVE_MIN_SAVING), time.thread_time() - started
+
+def _dos_datetime(timestamp: float) -> Tuple[int, int]:
+    t = time.localtime(timestamp)
+    year = max(t.tm_year, 1980)
+    return (year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday, t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+
+class _Sink:
+    """Collects written bytes for the caller to drain"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+class _DeflateSink:
+    """Deflates what's written to it into a ZipWriter, keeping the CRC and sizes"""
+
+    def __init__(self, writer: "ZipWriter", level: int):
+        self.writer = writer
+        self.compressor = _raw_deflate(level)
+        self.crc = 0
+        self.size = 0
+        self.compressed = 0
+
+    def _emit(self, data: bytes):
+        self.compressed += len(data)
+        self.writer._emit(data)
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self._emit(self.compressor.compress(data))
+        return len(data)
+
+    def finish(self):
+        self._emit(self.compressor.flush())
+
+class ZipWriter:
+    """
+    Minimal ZIP writer (ZIP64 when needed) producing the archive as a sequence of byte
+    chunks. Entries can be added already compressed, or streamed from an upload.
+    """
+
+    ZIP64_LIMIT = 0xFFFFFFFF
+
+    def __init__(self):
+        self.offset = 0
+        self.entries = []
+        self.date, self.time = _dos_datetime(time.time())
+        self._sink = _Sink()
+
+    def _emit(self, data: bytes):
+        self._sink.write(data)
+        self.offset += len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._sink.chunks)
+        self._sink.chunks = []
+        return data
+
+    def _local_header(self, name: bytes, flags: int, method: int, crc: int, compressed: int, size: int, zip64: bool):
+        extra = b""
+        if zip64:
+            extra = struct.pack("<HHQQ", 1, 16, size, compressed)
+            compressed = size = self.ZIP64_LIMIT
+        version = 45 if zip64 else 20
+        self._emit(struct.pack("<4sHHHHHIIIHH", b"PK\x03\x04", version, flags, method, self.time, self.date,
+                               crc, compressed, size, len(name), len(extra)) + name + extra)
+
+    def _entry(self, zip_path: str):
+        try:
+            name = zip_path.encode("ascii")
+            flags = 0
+        except UnicodeEncodeError:
+            name = zip_path.encode("utf-8")
+            flags = 0x800
+        return name, flags
+
+    def add_compressed(self, zip_path: str, method: int, crc: int, size: int, data: bytes):
+        """Add an entry whose data is already in its final (stored or raw-deflated) form"""
+        name, flags = self._entry(zip_path)
+        offset = self.offset
+        zip64 = size >= self.ZIP64_LIMIT or len(data) >= self.ZIP64_LIMIT
+        self._local_header(name, flags, method, crc, len(data), size, zip64)
+        self._emit(data)
+        self.entries.append((name, flags, method, crc, len(data), size, offset))
+
+    def iter_add_stored(self, zip_path: str, upload) -> Iterator[int]:
+        """Copy an upload in unchanged, chunk by chunk (its CRC is taken from a view first)"""
+        with upload_view(upload) as view:
+            crc = zlib.crc32(view)
+            size = len(view)
+        name, flags = self._entry(zip_path)
+        offset = self.offset
+        self._local_header(name, flags, ZIP_STORED, crc, size, size, size >= self.ZIP64_LIMIT)
+        for copied in iter_copy(upload, self._sink):
+            self.offset += copied
+            yield copied
+        self.entries.append((name, flags, ZIP_STORED, crc, size, size, offset))
+
+    def iter_add_deflated(self, zip_path: str, upload, level: int) -> Iterator[int]:
+        """Deflate an upload as it's copied in; sizes follow the data in a data descriptor"""
+        name, flags = self._entry(zip_path)
+        flags |= 0x08
+        offset = self.offset
+        # Sizes aren't known yet; a size hint decides ZIP64 like zipfile's does
+        zip64 = upload_size(upload) * 1.05 >= self.ZIP64_LIMIT
+        self._local_header(name, flags, ZIP_DEFLATED, 0, 0, 0, zip64)
+        sink = _DeflateSink(self, level)
+        yield from iter_copy(upload, sink)
+        sink.finish()
+        crc, size, compressed = sink.crc, sink.size, sink.compressed
+        if zip64:
+            self._emit(struct.pack("<4sIQQ", b"PK\x07\x08", crc, compressed, size))
+        else:
+            self._emit(struct.pack("<4sIII", b"PK\x07\x08", crc, compressed, size))
+        self.entries.append((name, flags, ZIP_DEFLATED, crc, compressed, size, offset))
+
+    def close(self):
+        """Write the central directory"""
+        start = self.offset
+        for name, flags, method, crc, compressed, size, offset in self.entries:
+            extra_values = []
+            if size >= self.ZIP64_LIMIT or compressed >= self.ZIP64_LIMIT:
+                extra_values += [size, compressed]
+                size = compressed = self.ZIP64_LIMIT
+            if offset >= self.ZIP64_LIMIT:
+                extra_values.append(offset)
+                offset = self.ZIP64_LIMIT
+            extra = struct.pack(f"<HH{len(extra_values)}Q", 1, 8 * len(extra_values), *extra_values) if extra_values else b""
+            version = 45 if extra_values else 20
+            self._emit(struct.pack("<4sBBHHHHHIIIHHHHHII", b"PK\x01\x02", version, 3, version, flags, method,
+                                   self.time, self.date, crc, compressed, size, len(name), len(extra), 0, 0, 0,
+                                   0o600 << 16, offset) + name + extra)
+        count, size, start_offset = len(self.entries), self.offset - start, start
+        if count >= 0xFFFF or size >= self.ZIP64_LIMIT or start >= self.ZIP64_LIMIT:
+            zip64_end = self.offset
+            self._emit(struct.pack("<4sQHHIIQQQQ", b"PK\x06\x06", 44, 45, 45, 0, 0, count, count, size, start))
+            self._emit(struct.pack("<4sIQI", b"PK\x06\x07", 0, zip64_end, 1))
+            count, size, start_offset = min(count, 0xFFFF), min(size, self.ZIP64_LIMIT), min(start, self.ZIP64_LIMIT)
+        self._emit(struct.pack("<4sHHHHIIH", b"PK\x05\x06", 0, 0, count, count, size, start_offset, 0))
+
+def iter_archive(entries: Iterable[Tuple[str, object]], policy: CompressionPolicy,
+                 stats: Optional[Dict] = None) -> Iterator[bytes]:
+    """
+    Build a ZIP from (zip_path, upload) pairs under a compression policy.
+
+    Deflated entries are compressed on the thread pool ahead of being written, with up to
+    ARCHIVE_MAX_PENDING_BYTES in flight; entries are written in the order given.
+
+    Args:
+        entries: (path in the archive, upload) pairs, consumed lazily
+        policy: See compression_policy
+        stats: Optional dict (see new_archive_stats) updated with entry counts, bytes in
+               and out, and compression CPU time
+
+    Yields:
+        bytes: Consecutive chunks of the archive
+    """
+    stats = stats if stats is not None else new_archive_stats()
+    writer = ZipWriter()
+    pool = _get_pool() if ARCHIVE_THREADS > 1 else None
+    pending = deque()  # (zip_path, upload, size, future or None, method)
+    pending_bytes = 0
+
+    def write_next() -> Iterator[bytes]:
+        nonlocal pending_bytes
+        zip_path, upload, size, future, method = pending.popleft()
+        pending_bytes -= size if future is not None else 0
+        before = writer.offset
+        if future is not None:
+            crc, size, data, cpu = future.result()
+            writer.add_compressed(zip_path, ZIP_DEFLATED, crc, size, data)
+            stats["compress_cpu_seconds"] += cpu
+            yield writer.drain()
+        elif method == ZIP_DEFLATED:
+            started = time.thread_time()
+            for _ in writer.iter_add_deflated(zip_path, upload, policy.level):
+                yield writer.drain()
+            stats["compress_cpu_seconds"] += time.thread_time() - started
+        else:
+            for _ in writer.iter_add_stored(zip_path, upload):
+                yield writer.drain()
+        yield writer.drain()
+        stats["entries_deflated" if method == ZIP_DEFLATED else "entries_stored"] += 1
+        stats["bytes_in"] += size
+        # Compressed data only (headers excluded), so bytes_saved is what compression saved
+        stats["bytes_out"] += writer.entries[-1][4]
+        stats["bytes_saved"] = stats["bytes_in"] - stats["bytes_out"]
+
+    for zip_path, upload in entries:
+        size = upload_size(upload)
+        method = ZIP_DEFLATED if policy.mode != "store" else ZIP_STORED
+        if policy.mode == "auto" and size > 0:
+            worth, cpu = _worth_compressing(upload, size)
+            stats["compress_cpu_seconds"] += cpu
+            method = ZIP_DEFLATED if worth else ZIP_STORED
+
+        future = None
+        if method == ZIP_DEFLATED and size <= ARCHIVE_MAX_ENTRY_BYTES:
+            if pool is not None:
+                # Make room first so compressed data in flight stays bounded
+                while pending and pending_bytes + size > ARCHIVE_MAX_PENDING_BYTES:
+                    yield from write_next()
+                future = pool.submit(_deflate_upload, upload, policy.level)
+                pending_bytes += size
+            else:
+                future = _completed(_deflate_upload(upload, policy.level))
+        pending.append((zip_path, upload, size, future, method))
+
+        # Write whatever is ready at the head; stored and streamed entries wait their turn
+        while pending and (pending[0][3] is None or pending[0][3].done()):
+            yield from write_next()
+
+    while pending:
+        yield from write_next()
+    writer.close()
+    yield writer.drain()
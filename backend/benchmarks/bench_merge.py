@@ -0,0 +1,150 @@
+"""
+Benchmark merge_care_gap_sheets against a previous revision of merging.py.
+
+Generates synthetic payer sheets (see synthetic.py), runs the current merge and the merge from a
+baseline git revision on the same inputs, and checks the merged workbooks have identical
+cell contents. Each run happens in its own interpreter with that revision's backend/ on
+sys.path, so the baseline's sibling modules are the ones it shipped with, and reports
+that interpreter's peak RSS alongside the time.
+
+--object-dtypes compares against the current tree with COMPACT_DTYPES=false (plain
+object columns) instead of a git revision.
+
+Usage (from backend/):
+    python benchmarks/bench_merge.py --sheets 20 --rows 50000 --baseline HEAD~1
+    python benchmarks/bench_merge.py --sheets 25 --rows 20000 --object-dtypes
+"""
+import argparse
+import os
+import pickle
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+import numpy as np
+from werkzeug.datastructures import FileStorage
+
+from synthetic import make_config, make_db, make_gaps_df, make_master_sheet, make_payer_sheet, to_upload
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def export_revision(revision, dest):
+    """Extract backend/ as it was at a git revision, returning its path"""
+    archive = subprocess.check_output(["git", "archive", revision, "backend"], cwd=os.path.dirname(BACKEND_DIR))
+    subprocess.run(["tar", "-x", "-C", dest], input=archive, check=True)
+    return os.path.join(dest, "backend")
+
+
+def sheet_contents(xlsx_bytes):
+    """
+    Cell values and number formats of every sheet. Compared instead of the raw parts,
+    which differ between shared and inline strings and carry a creation timestamp.
+    """
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(BytesIO(xlsx_bytes), read_only=True)
+    try:
+        return {
+            sheet.title: [[(cell.value, cell.number_format) for cell in row] for row in sheet.iter_rows()]
+            for sheet in workbook.worksheets
+        }
+    finally:
+        workbook.close()
+
+
+def run_worker(tree, inputs_path, output_path):
+    """Run one merge with the merging module from `tree`, printing the elapsed seconds"""
+    sys.path.insert(0, tree)
+    import merging
+
+    with open(inputs_path, "rb") as f:
+        inputs = pickle.load(f)
+    (master_data, master_name), sheet_uploads = inputs["master"], inputs["sheets"]
+    db = make_db(inputs["gaps"], inputs["configs"])
+    master = FileStorage(BytesIO(master_data), filename=master_name)
+    sheets = [(FileStorage(BytesIO(data), filename=name), str(config_id)) for (data, name), config_id in sheet_uploads]
+
+    start = time.perf_counter()
+    result = merging.merge_care_gap_sheets(master, sheets, db, False)
+    elapsed = time.perf_counter() - start
+
+    with open(output_path, "wb") as f:
+        f.write(result)
+    scale = 1 if sys.platform == "darwin" else 1024  # bytes on macOS, KiB on Linux
+    print(f"PEAK {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale}")
+    print(f"ELAPSED {elapsed}")
+
+
+def run(tree, inputs_path, output_path, env=None):
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker", tree, inputs_path, output_path],
+        capture_output=True, text=True, check=True, env={**os.environ, **(env or {})}
+    )
+    elapsed = float(completed.stdout.rsplit("ELAPSED ", 1)[1])
+    peak = int(completed.stdout.rsplit("PEAK ", 1)[1].split()[0])
+    with open(output_path, "rb") as f:
+        return elapsed, peak, f.read()
+
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == "--worker":
+        run_worker(*sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sheets", type=int, default=15)
+    parser.add_argument("--rows", type=int, default=20000, help="rows per payer sheet")
+    parser.add_argument("--master-rows", type=int, default=20000)
+    parser.add_argument("--format", choices=["csv", "xlsx"], default="csv", help="upload format (csv isolates merge cost from parsing)")
+    parser.add_argument("--baseline", default="HEAD~1", help="git revision to compare against")
+    parser.add_argument("--object-dtypes", action="store_true", help="compare against the current tree with COMPACT_DTYPES=false")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    configs = [make_config(i % 2 == 0, f"Payer {i}") for i in range(args.sheets)]
+    sheet_uploads = [(to_upload(make_payer_sheet(rng, args.rows, i % 2 == 0), f"payer_{i}", args.format), configs[i]["_id"]) for i in range(args.sheets)]
+    master_df = make_master_sheet(rng, args.master_rows)
+
+    workdir = tempfile.mkdtemp()
+    inputs_path = os.path.join(workdir, "inputs.pickle")
+    with open(inputs_path, "wb") as f:
+        pickle.dump({
+            "master": to_upload(master_df, "master", args.format),
+            "sheets": sheet_uploads,
+            "gaps": make_gaps_df(),
+            "configs": configs,
+        }, f)
+    if args.object_dtypes:
+        baseline_name = "COMPACT_DTYPES=false"
+        trees = {"baseline": BACKEND_DIR, "current": BACKEND_DIR}
+        envs = {"baseline": {"COMPACT_DTYPES": "false"}, "current": {"COMPACT_DTYPES": "true"}}
+    else:
+        baseline_name = args.baseline
+        trees = {"baseline": export_revision(args.baseline, workdir), "current": BACKEND_DIR}
+        envs = {}
+
+    print(f"{args.sheets} sheets x {args.rows} rows ({args.format}), master {args.master_rows} rows")
+    timings = {"baseline": [], "current": []}
+    peaks = {"baseline": [], "current": []}
+    outputs = {}
+    for _ in range(args.repeat):
+        for label, tree in trees.items():
+            elapsed, peak, outputs[label] = run(tree, inputs_path, os.path.join(workdir, f"{label}.xlsx"), envs.get(label))
+            timings[label].append(elapsed)
+            peaks[label].append(peak)
+
+    best = {label: min(values) for label, values in timings.items()}
+    peak = {label: min(values) / 2**20 for label, values in peaks.items()}
+    print(f"baseline ({baseline_name}): {best['baseline']:.2f}s, peak RSS {peak['baseline']:.0f} MB")
+    print(f"current: {best['current']:.2f}s ({best['baseline'] / best['current']:.2f}x), peak RSS {peak['current']:.0f} MB")
+    identical = sheet_contents(outputs["baseline"]) == sheet_contents(outputs["current"])
+    print(f"identical output: {identical}")
+    sys.exit(0 if identical else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Benchmark the shared reader layer against the previous full-workbook read.
+
+Writes a synthetic payer sheet with the mapped columns plus a spread of unused ones,
+then reads it (a) the old way, every column through pandas' default engine, and
+(b) through readers.read_table with the columns a config resolves to. Reports wall
+time and peak traced memory for each.
+
+Usage (from backend/):
+    python benchmarks/bench_readers.py --rows 100000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from readers import column_selector, excel_engine, read_table  # noqa: E402
+from merging import MAPPED_FIELDS  # noqa: E402
+
+FIELDS = {
+    "First Name": "First", "Last Name": "Last", "Full Name": "none", "Member ID": "Member Number",
+    "Care Gap": "Measure", "DOB": "Birth Date", "Doctor/Provider": "PCP", "Insurance": "Plan", "Notes": "Comments",
+}
+
+
+def make_sheet(rows, extra_columns):
+    rng = np.random.default_rng(0)
+    sheet = {
+        "First": rng.choice(["Ann", "Bob", "Cara", "Dev"], rows),
+        "Last": rng.choice(["Smith", "Jones", "Lee", "Patel"], rows),
+        "Member Number": rng.integers(10_000_000, 99_999_999, rows).astype(str),
+        "Measure": rng.choice(["BCS", "COL", "EED", "CBP"], rows),
+        "Birth Date": pd.Timestamp("1940-01-01") + pd.to_timedelta(rng.integers(0, 25_000, rows), unit="D"),
+        "PCP": rng.choice(["Dr. A", "Dr. B"], rows),
+        "Plan": "Payer",
+        "Comments": rng.choice(["", "called"], rows),
+    }
+    for i in range(extra_columns):
+        sheet[f"Unused {i}"] = rng.integers(0, 1000, rows) if i % 2 else rng.choice(["x", "y", "z"], rows)
+    return pd.DataFrame(sheet)
+
+
+def measure(label, read):
+    # Timed untraced; tracemalloc slows openpyxl's per-cell allocations several-fold
+    start = time.perf_counter()
+    frame = read()
+    elapsed = time.perf_counter() - start
+    del frame
+    tracemalloc.start()
+    frame = read()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<28} {elapsed:8.2f}s  peak {peak / 2**20:8.1f} MiB  {frame.shape[1]} columns")
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--extra-columns", type=int, default=12, help="unused columns in the sheet")
+    parser.add_argument("--format", choices=["xlsx", "csv"], default="xlsx")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), f"sheet.{args.format}")
+    sheet = make_sheet(args.rows, args.extra_columns)
+    if args.format == "csv":
+        sheet.to_csv(path, index=False)
+    else:
+        sheet.to_excel(path, index=False)
+    del sheet
+
+    print(f"{args.rows} rows x {8 + args.extra_columns} columns ({args.format}), engine: {excel_engine() or 'pandas default'}")
+    if args.format == "csv":
+        before = measure("full read (previous)", lambda: pd.read_csv(path))
+    else:
+        before = measure("full read (previous)", lambda: pd.read_excel(path))
+    usecols = column_selector(FIELDS[field] for field in MAPPED_FIELDS)
+    after = measure("reader layer, pruned", lambda: read_table(path, os.path.basename(path), usecols=usecols))
+    print(f"time {before[0] / after[0]:.2f}x faster, peak memory {after[1] / before[1]:.2f}x of previous")
+
+
+if __name__ == "__main__":
+    main()
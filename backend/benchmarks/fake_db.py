@@ -0,0 +1,161 @@
+"""
+In-memory stand-in for the pymongo database object.
+
+Implements the slice of the pymongo API the backend uses (equality, $in, $ne, $exists
+and $gt/$lt filters, inclusion/exclusion projections, sort/skip/limit, and $set, $unset,
+$inc and $setOnInsert updates) so merges and sorts can run without a MongoDB server.
+"""
+import copy
+from types import SimpleNamespace
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+
+def _matches(doc, query):
+    for key, condition in query.items():
+        value = doc.get(key)
+        if isinstance(condition, dict) and any(op.startswith("$") for op in condition):
+            for op, operand in condition.items():
+                if op == "$in" and value not in operand:
+                    return False
+                if op == "$nin" and value in operand:
+                    return False
+                if op == "$ne" and value == operand:
+                    return False
+                if op == "$exists" and (key in doc) != bool(operand):
+                    return False
+                if op == "$gt" and not (value is not None and value > operand):
+                    return False
+                if op == "$gte" and not (value is not None and value >= operand):
+                    return False
+                if op == "$lt" and not (value is not None and value < operand):
+                    return False
+                if op == "$lte" and not (value is not None and value <= operand):
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _project(doc, projection):
+    if not projection:
+        return copy.deepcopy(doc)
+    include = {key for key, flag in projection.items() if flag and key != "_id"}
+    if include:
+        result = {key: copy.deepcopy(doc[key]) for key in include if key in doc}
+        if projection.get("_id", 1) and "_id" in doc:
+            result["_id"] = doc["_id"]
+        return result
+    return {key: copy.deepcopy(value) for key, value in doc.items() if projection.get(key, 1)}
+
+
+class FakeCursor:
+    def __init__(self, docs, projection):
+        self._docs = docs
+        self._projection = projection
+
+    def sort(self, key, direction=1):
+        if isinstance(key, list):
+            for field, field_direction in reversed(key):
+                self._docs.sort(key=lambda doc: doc.get(field), reverse=field_direction < 0)
+        else:
+            self._docs.sort(key=lambda doc: doc.get(key), reverse=direction < 0)
+        return self
+
+    def skip(self, count):
+        self._docs = self._docs[count:]
+        return self
+
+    def limit(self, count):
+        if count:
+            self._docs = self._docs[:count]
+        return self
+
+    def __iter__(self):
+        return (_project(doc, self._projection) for doc in self._docs)
+
+
+class FakeCollection:
+    def __init__(self):
+        self.docs = []
+        self.indexes = []
+
+    def create_index(self, keys, **kwargs):
+        self.indexes.append((keys, kwargs))
+        return str(keys)
+
+    def insert_one(self, doc):
+        # _id is unique, as in MongoDB (only a caller-chosen _id can collide)
+        if "_id" in doc and any(existing["_id"] == doc["_id"] for existing in self.docs):
+            raise DuplicateKeyError(f"E11000 duplicate key error: _id {doc['_id']!r}")
+        doc.setdefault("_id", ObjectId())
+        self.docs.append(copy.deepcopy(doc))
+        return SimpleNamespace(inserted_id=doc["_id"])
+
+    def insert_many(self, docs):
+        return SimpleNamespace(inserted_ids=[self.insert_one(doc).inserted_id for doc in docs])
+
+    def find(self, query=None, projection=None):
+        return FakeCursor([doc for doc in self.docs if _matches(doc, query or {})], projection)
+
+    def find_one(self, query=None, projection=None):
+        for doc in self.find(query, projection):
+            return doc
+        return None
+
+    def count_documents(self, query):
+        return sum(1 for doc in self.docs if _matches(doc, query))
+
+    def update_one(self, query, update, upsert=False):
+        for doc in self.docs:
+            if _matches(doc, query):
+                self._apply(doc, update)
+                return SimpleNamespace(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            doc = {key: value for key, value in query.items() if not isinstance(value, dict)}
+            self._apply(doc, update)
+            doc.update(copy.deepcopy(update.get("$setOnInsert", {})))
+            inserted_id = self.insert_one(doc).inserted_id
+            return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=inserted_id)
+        return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None)
+
+    def find_one_and_update(self, query, update, upsert=False, return_document=False):
+        self.update_one(query, update, upsert=upsert)
+        return self.find_one(query)
+
+    @staticmethod
+    def _apply(doc, update):
+        for key, value in update.get("$set", {}).items():
+            doc[key] = copy.deepcopy(value)
+        for key in update.get("$unset", {}):
+            doc.pop(key, None)
+        for key, value in update.get("$inc", {}).items():
+            doc[key] = doc.get(key, 0) + value
+
+    def delete_one(self, query):
+        for index, doc in enumerate(self.docs):
+            if _matches(doc, query):
+                del self.docs[index]
+                return SimpleNamespace(deleted_count=1)
+        return SimpleNamespace(deleted_count=0)
+
+    def delete_many(self, query):
+        before = len(self.docs)
+        self.docs = [doc for doc in self.docs if not _matches(doc, query)]
+        return SimpleNamespace(deleted_count=before - len(self.docs))
+
+
+class FakeDB:
+    """Collections are created on first attribute access, like pymongo"""
+
+    def __init__(self):
+        self._collections = {}
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self._collections.setdefault(name, FakeCollection())
+
+    def __getitem__(self, name):
+        return getattr(self, name)
@@ -0,0 +1,236 @@
+"""
+Scripted end-to-end benchmark of the backend pipelines on synthetic data.
+
+Runs each stage (gaps upload, merge, buffered and streamed PDF sort) in its own
+interpreter so peak memory isn't inherited from earlier stages, and records wall time,
+peak RSS and throughput per stage. Results are written as JSON (one file per commit by
+default) so runs can be compared between commits:
+
+Usage (from backend/):
+    python benchmarks/run.py --sheets 10 --rows 20000 --pdfs 300
+    python benchmarks/run.py --compare benchmarks/results/<older commit>.json
+"""
+import argparse
+import json
+import os
+import pickle
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from io import BytesIO
+
+import numpy as np
+from werkzeug.datastructures import FileStorage
+
+from synthetic import make_config, make_db, make_gaps_df, make_master_sheet, make_payer_sheet, make_pdfs, to_upload
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+STAGES = ["gaps_save", "merge", "sort_buffered", "sort_stream"]
+STAGE_UNITS = {"gaps_save": "rows", "merge": "rows", "sort_buffered": "pdfs", "sort_stream": "pdfs"}
+
+
+class PeakRSS:
+    """
+    Samples resident memory while a stage runs. Uses /proc where available; elsewhere
+    falls back to ru_maxrss, which is the peak over the whole (fresh) process.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        self._proc = os.path.exists("/proc/self/statm")
+
+    def current(self):
+        if self._proc:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * self._page_size
+        scale = 1 if sys.platform == "darwin" else 1024  # bytes on macOS, KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.current())
+
+    def __enter__(self):
+        self.before = self.current()
+        self.peak = self.before
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def _uploads(pairs):
+    return [FileStorage(BytesIO(data), filename=name) for data, name in pairs]
+
+
+def run_stage(stage, inputs):
+    """Run one stage on the unpickled inputs, returning (result size in bytes, items processed)"""
+    db = make_db(inputs["gaps"], inputs["configs"])
+
+    if stage == "gaps_save":
+        from gaps_store import save_gaps
+        save_gaps(db, inputs["gaps_large"])
+        return 0, len(inputs["gaps_large"])
+
+    if stage == "merge":
+        from merging import merge_care_gap_sheets
+        master = _uploads([inputs["master"]])[0]
+        sheets = [(upload, str(config_id)) for upload, config_id in zip(_uploads(inputs["sheets"]), inputs["sheet_configs"])]
+        result = merge_care_gap_sheets(master, sheets, db, False)
+        return len(result), inputs["sheet_rows"]
+
+    from sorting import iter_sorted_zip, load_master, sort_pdfs
+    master = _uploads([inputs["master"]])[0]
+    pdfs = _uploads(inputs["pdfs"])
+    if stage == "sort_buffered":
+        return len(sort_pdfs(master, pdfs)), len(pdfs)
+    df, member_index = load_master(master)
+    return sum(len(chunk) for chunk in iter_sorted_zip(df, member_index, pdfs)), len(pdfs)
+
+
+def run_worker(stage, inputs_path):
+    """Subprocess entry point: time one stage and print its measurements as JSON"""
+    sys.path.insert(0, BACKEND_DIR)
+    with open(inputs_path, "rb") as f:
+        inputs = pickle.load(f)
+
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        output_bytes, items = run_stage(stage, inputs)
+        elapsed = time.perf_counter() - start
+
+    print("RESULT " + json.dumps({
+        "wall_seconds": round(elapsed, 4),
+        "peak_rss_mb": round(rss.peak / 2**20, 1),
+        "rss_before_mb": round(rss.before / 2**20, 1),
+        "items": items,
+        "unit": STAGE_UNITS[stage],
+        "items_per_second": round(items / elapsed, 1) if elapsed else None,
+        "output_bytes": output_bytes,
+    }))
+
+
+def build_inputs(args, path):
+    rng = np.random.default_rng(args.seed)
+    configs = [make_config(i % 2 == 0, f"Payer {i}") for i in range(args.sheets)]
+    sheets = [to_upload(make_payer_sheet(rng, args.rows, i % 2 == 0), f"payer_{i}", args.format) for i in range(args.sheets)]
+    master_df = make_master_sheet(rng, args.master_rows)
+    gaps = make_gaps_df()
+    # Longer gaps file for the upload stage (the real one lists every measure alias per payer)
+    gaps_large = gaps.sample(n=args.gaps_rows, replace=True, random_state=args.seed).reset_index(drop=True)
+    with open(path, "wb") as f:
+        pickle.dump({
+            "master": to_upload(master_df, "master", args.format),
+            "sheets": sheets,
+            "sheet_configs": [config["_id"] for config in configs],
+            "sheet_rows": args.sheets * args.rows,
+            "gaps": gaps,
+            "gaps_large": gaps_large,
+            "configs": configs,
+            "pdfs": make_pdfs(rng, master_df["Member ID"], args.pdfs, args.pdf_kb),
+        }, f)
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD", "--", "."], cwd=BACKEND_DIR).returncode != 0
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+
+def compare(current, previous_path):
+    with open(previous_path) as f:
+        previous = json.load(f)
+    print(f"\ncompared with {previous.get('commit')} ({previous_path}):")
+    if previous.get("params") != current["params"]:
+        print("  warning: parameters differ, numbers are not directly comparable")
+    for stage, result in current["stages"].items():
+        before = previous.get("stages", {}).get(stage)
+        if not before:
+            continue
+        time_ratio = before["wall_seconds"] / result["wall_seconds"] if result["wall_seconds"] else float("inf")
+        rss_ratio = result["peak_rss_mb"] / before["peak_rss_mb"] if before["peak_rss_mb"] else float("nan")
+        print(f"  {stage:<14} {time_ratio:5.2f}x faster   peak RSS {rss_ratio:5.2f}x of previous")
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--worker":
+        run_worker(*sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sheets", type=int, default=10)
+    parser.add_argument("--rows", type=int, default=20000, help="rows per payer sheet")
+    parser.add_argument("--master-rows", type=int, default=20000)
+    parser.add_argument("--gaps-rows", type=int, default=20000, help="rows in the uploaded gaps file")
+    parser.add_argument("--pdfs", type=int, default=200)
+    parser.add_argument("--pdf-kb", type=int, default=100)
+    parser.add_argument("--format", choices=["csv", "xlsx"], default="xlsx")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma-separated subset of: " + ", ".join(STAGES))
+    parser.add_argument("--repeat", type=int, default=1, help="keep the fastest of N runs per stage")
+    parser.add_argument("--output", help="results file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", help="previous results file to compare against")
+    args = parser.parse_args()
+
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    workdir = tempfile.mkdtemp()
+    inputs_path = os.path.join(workdir, "inputs.pickle")
+    build_inputs(args, inputs_path)
+
+    params = {key: value for key, value in vars(args).items() if key not in ("output", "compare", "stages", "repeat")}
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "params": params,
+        "stages": {},
+    }
+    for stage in stages:
+        runs = []
+        for _ in range(args.repeat):
+            completed = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--worker", stage, inputs_path],
+                capture_output=True, text=True
+            )
+            if completed.returncode != 0:
+                sys.stderr.write(completed.stderr)
+                sys.exit(f"stage {stage} failed")
+            runs.append(json.loads(completed.stdout.rsplit("RESULT ", 1)[1]))
+        result = min(runs, key=lambda run: run["wall_seconds"])
+        result["peak_rss_mb"] = max(run["peak_rss_mb"] for run in runs)
+        results["stages"][stage] = result
+        print(f"{stage:<14} {result['wall_seconds']:8.2f}s  peak RSS {result['peak_rss_mb']:8.1f} MB  "
+              f"{result['items_per_second'] or 0:12.1f} {result['unit']}/s")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
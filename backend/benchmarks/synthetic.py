@@ -0,0 +1,213 @@
+"""
+Synthetic (PHI-free) inputs for the merge and sort pipelines.
+
+Generates master sheets, payer care-gap sheets in both name layouts (a single
+"Last, First" column or separate First/Last columns), the matching insurance configs,
+a gaps file, and dummy PDFs named <memberid>_<n>.pdf whose first page also carries the
+member ID as text.
+
+Also usable on its own to write a dataset to disk for manual testing through the UI:
+    python benchmarks/synthetic.py --out /tmp/synthetic --sheets 5 --rows 20000 --pdfs 300
+"""
+import argparse
+import os
+from datetime import datetime, timezone
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from bson import ObjectId
+
+from fake_db import FakeDB
+
+GAP_HEADERS = ["Breast Cancer Screening", "Colorectal Cancer Screening", "Diabetes Eye Exam", "Controlling Blood Pressure"]
+GAP_LABELS = {
+    "Breast Cancer Screening": ["BCS", "Mammogram", "BCS-E"],
+    "Colorectal Cancer Screening": ["COL", "Colonoscopy", "COL-E", "FIT Test"],
+    "Diabetes Eye Exam": ["EED", "Eye Exam"],
+    "Controlling Blood Pressure": ["CBP", "BP Control"],
+}
+FIRST_NAMES = ["Ann", "Bob", "Cara", "Dev", "Eli", "Fay", "Gus"]
+LAST_NAMES = ["Smith", "Jones", "Lee", "Patel", "Garcia", "Kim"]
+MEMBER_ID_START = 10_000_000
+
+
+def make_gaps_df():
+    width = max(len(labels) for labels in GAP_LABELS.values())
+    return pd.DataFrame({header: labels + [None] * (width - len(labels)) for header, labels in GAP_LABELS.items()})
+
+
+def make_payer_sheet(rng, rows, full_name):
+    """Payer care-gap sheet; full_name picks the "Last, First" layout over First/Last columns"""
+    labels = [label for labels in GAP_LABELS.values() for label in labels] + ["Unmapped Measure"]
+    first = rng.choice(FIRST_NAMES, rows)
+    last = rng.choice(LAST_NAMES, rows)
+    sheet = {}
+    if full_name:
+        sheet["Patient Name"] = [f"{l}, {f} Q" for f, l in zip(first, last)]
+    else:
+        sheet["First"] = first
+        sheet["Last"] = last
+    sheet["Member Number"] = rng.integers(MEMBER_ID_START, MEMBER_ID_START + max(rows // 2, 1), rows).astype(str)
+    sheet["Measure"] = rng.choice(labels, rows)
+    sheet["Birth Date"] = pd.Timestamp("1940-01-01") + pd.to_timedelta(rng.integers(0, 25_000, rows), unit="D")
+    sheet["PCP"] = rng.choice(["Dr. A", "Dr. B", "Dr. C"], rows)
+    sheet["Comments"] = rng.choice(["", "called", "left vm"], rows)
+    return pd.DataFrame(sheet)
+
+
+def make_config(full_name, insurance_name):
+    """Insurance config matching make_payer_sheet (header case deliberately differs)"""
+    fields = {
+        "First Name": "none" if full_name else "first",
+        "Last Name": "none" if full_name else "LAST",
+        "Full Name": "Patient Name" if full_name else "none",
+        "Member ID": "member number",
+        "Care Gap": "Measure",
+        "DOB": "Birth Date",
+        "Doctor/Provider": "PCP",
+        "Insurance": insurance_name,
+        "Insurance Provided": "No",
+        "Notes": "Comments",
+    }
+    return {"_id": ObjectId(), "name": insurance_name, "fields": fields}
+
+
+def make_master_sheet(rng, rows):
+    """Master sheet in the merged output layout, with 6-digit Member IDs"""
+    return pd.DataFrame({
+        "First Name": rng.choice(["Ann", "Bob"], rows),
+        "Last Name": rng.choice(["Smith", "Lee"], rows),
+        "Member ID": rng.integers(100_000, 999_999, rows).astype(str),
+        "Care Gap": rng.choice(GAP_HEADERS, rows),
+        "DOB": pd.Timestamp("1950-01-01") + pd.to_timedelta(rng.integers(0, 20_000, rows), unit="D"),
+        "Insurance": "Payer 0",
+        "Doctor/Provider": "Dr. A",
+        "Notes": "",
+    })
+
+
+def make_pdf(member_id, size_kb, rng):
+    """
+    A small valid PDF whose first page reads "Member ID: <member_id>", padded with an
+    incompressible stream to roughly size_kb (real scans are already compressed).
+    """
+    text = f"BT /F1 12 Tf 72 720 Td (Member ID: {member_id}) Tj ET".encode()
+    padding = rng.bytes(max(size_kb * 1024 - 600, 0))
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R "
+        b"/Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length %d >>\nstream\n" % len(text) + text + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        b"<< /Length %d >>\nstream\n" % len(padding) + padding + b"\nendstream",
+    ]
+    out = BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+def make_pdfs(rng, member_ids, count, size_kb=100, unmatched_ratio=0.05, unnamed_ratio=0.0):
+    """
+    Dummy PDFs for sorting, as (bytes, filename) pairs like to_upload.
+
+    Most are named <memberid>_<n>.pdf for an ID from member_ids; unmatched_ratio of them
+    use an ID not in the master, and unnamed_ratio carry a master ID only in their text
+    (filename without an ID), for content-based routing.
+    """
+    member_ids = list(member_ids)
+    pdfs = []
+    for n in range(count):
+        roll = rng.random()
+        member_id = str(rng.choice(member_ids)) if member_ids else "000000"
+        if roll < unmatched_ratio:
+            member_id = f"X{rng.integers(0, 10**7):07d}"
+            filename = f"{member_id}_{n}.pdf"
+        elif roll < unmatched_ratio + unnamed_ratio:
+            filename = f"scan_{n}.pdf"
+        else:
+            filename = f"{member_id}_{n}.pdf"
+        pdfs.append((make_pdf(member_id, size_kb, rng), filename))
+    return pdfs
+
+
+def to_upload(df, filename, file_format):
+    """Serialize a sheet the way a user would upload it, as (bytes, filename)"""
+    buffer = BytesIO()
+    if file_format == "csv":
+        df.to_csv(buffer, index=False)
+    else:
+        df.to_excel(buffer, index=False)
+    return buffer.getvalue(), f"{filename}.{file_format}"
+
+
+def make_db(gaps_df, configs):
+    """
+    Fresh in-memory db holding the gaps file in the original single-document format,
+    which every revision can read (newer code migrates it on first access).
+    """
+    db = FakeDB()
+    db.system_files.insert_one({
+        "file_type": "gaps",
+        "data": gaps_df.to_dict('records'),
+        "columns": list(gaps_df.columns),
+        "uploaded_at": datetime.now(timezone.utc),
+    })
+    for config in configs:
+        db.insurance.insert_one(dict(config))
+    return db
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", required=True, help="directory to write the dataset to")
+    parser.add_argument("--sheets", type=int, default=5)
+    parser.add_argument("--rows", type=int, default=20000, help="rows per payer sheet")
+    parser.add_argument("--master-rows", type=int, default=20000)
+    parser.add_argument("--pdfs", type=int, default=200)
+    parser.add_argument("--pdf-kb", type=int, default=100)
+    parser.add_argument("--format", choices=["csv", "xlsx"], default="xlsx")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    import json
+
+    rng = np.random.default_rng(args.seed)
+    os.makedirs(os.path.join(args.out, "pdfs"), exist_ok=True)
+
+    master = make_master_sheet(rng, args.master_rows)
+    data, name = to_upload(master, "master", args.format)
+    with open(os.path.join(args.out, name), "wb") as f:
+        f.write(data)
+    data, name = to_upload(make_gaps_df(), "gaps", args.format)
+    with open(os.path.join(args.out, name), "wb") as f:
+        f.write(data)
+
+    configs = []
+    for i in range(args.sheets):
+        config = make_config(i % 2 == 0, f"Payer {i}")
+        configs.append({"name": config["name"], "fields": config["fields"]})
+        data, name = to_upload(make_payer_sheet(rng, args.rows, i % 2 == 0), f"payer_{i}", args.format)
+        with open(os.path.join(args.out, name), "wb") as f:
+            f.write(data)
+    with open(os.path.join(args.out, "configs.json"), "w") as f:
+        json.dump(configs, f, indent=2)
+
+    for data, filename in make_pdfs(rng, master["Member ID"], args.pdfs, args.pdf_kb):
+        with open(os.path.join(args.out, "pdfs", filename), "wb") as f:
+            f.write(data)
+    print(f"Wrote dataset to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from bson import ObjectId
+from gaps_store import get_gaps_meta, load_gap_lookup
+from readers import compile_column_plan, header_signature
+
+# Process-wide cache of the compiled gaps lookup and insurance configs.
+#
+# Entries are keyed by a version stamp read from MongoDB with a small projected query,
+# so a write from another process is still picked up. Writes through this process's
+# routes also invalidate directly.
+#
+# Gaps versions never change once stored, so their lookups are cached per version; a
+# new version based on a cached one is built by applying just its lookup delta.
+#
+# Column plans (which sheet column each config field resolves to) are cached per
+# config version and header signature, since a payer's headers rarely change.
+
+# Column plans kept (least recently used are dropped first)
+COLUMN_PLAN_CACHE_SIZE = int(os.getenv("COLUMN_PLAN_CACHE_SIZE", "1000"))
+# Gaps versions whose lookups are kept (the active one plus a few pinned by merges)
+GAPS_CACHE_VERSIONS = int(os.getenv("GAPS_CACHE_VERSIONS", "3"))
+
+_lock = threading.Lock()
+_gaps_entries: "OrderedDict[object, Dict[str, str]]" = OrderedDict()  # gaps version id -> lookup
+_config_entries = {}  # config id -> (version, config document)
+_plan_entries: "OrderedDict[tuple, Dict[str, Optional[str]]]" = OrderedDict()  # (config id, version, signature) -> plan
+_stats = {"gaps_hits": 0, "gaps_misses": 0, "config_hits": 0, "config_misses": 0, "plan_hits": 0, "plan_misses": 0}
+
+def gaps_stamp(doc):
+    """Each upload is stored as a new document, so its _id and upload time identify the version"""
+    return (doc.get('_id'), doc.get('uploaded_at'))
+
+def config_version(doc):
+    """Configs carry updated_at once edited, created_at before that"""
+    return (doc.get('updated_at'), doc.get('created_at'))
+
+def get_gaps(db, version: Optional[int] = None) -> Optional[Tuple[int, Dict[str, str]]]:
+    """
+    Get a gaps version's number and compiled gap name -> header lookup, loading it only
+    on first use.
+
+    Args:
+        db: MongoDB database connection
+        version: Version number to pin; None for the active version
+
+    Returns:
+        tuple or None: (version, lookup), or None if no gaps file has been uploaded (or
+                       that version isn't kept)
+    """
+    meta = get_gaps_meta(db, version)
+    if not meta:
+        return None
+
+    with _lock:
+        lookup = _gaps_entries.get(meta['_id'])
+        if lookup is not None:
+            _gaps_entries.move_to_end(meta['_id'])
+            _stats["gaps_hits"] += 1
+            return meta.get('version', 1), lookup
+        _stats["gaps_misses"] += 1
+        base_lookup = _gaps_entries.get(meta.get('base_id'))
+
+    lookup = load_gap_lookup(db, meta, base_lookup)
+
+    with _lock:
+        _gaps_entries[meta['_id']] = lookup
+        while len(_gaps_entries) > GAPS_CACHE_VERSIONS:
+            _gaps_entries.popitem(last=False)
+    return meta.get('version', 1), lookup
+
+def get_insurance_configs(db, config_ids: List[str]) -> Dict[str, dict]:
+    """
+    Get insurance config documents by ID, fetching only the ones that changed.
+
+    Args:
+        db: MongoDB database connection
+        config_ids: Config IDs as strings
+
+    Returns:
+        dict: config id -> config document (missing IDs are left out)
+    """
+    object_ids = list({ObjectId(config_id) for config_id in config_ids})
+    stamps = db.insurance.find({"_id": {"$in": object_ids}}, {"_id": 1, "created_at": 1, "updated_at": 1})
+
+    configs = {}
+    stale = []
+    with _lock:
+        for stamp in stamps:
+            config_id = str(stamp['_id'])
+            entry = _config_entries.get(config_id)
+            if entry is not None and entry[0] == config_version(stamp):
+                _stats["config_hits"] += 1
+                configs[config_id] = entry[1]
+            else:
+                _stats["config_misses"] += 1
+                stale.append(stamp['_id'])
+
+    if stale:
+        fetched = list(db.insurance.find({"_id": {"$in": stale}}))
+        with _lock:
+            for doc in fetched:
+                config_id = str(doc['_id'])
+                _config_entries[config_id] = (config_version(doc), doc)
+                configs[config_id] = doc
+
+    return configs
+
+def get_column_plan(config: dict, columns) -> Dict[str, Optional[str]]:
+    """
+    Column plan for a sheet: mapped field -> the sheet column it resolves to (None when
+    unmapped or missing), compiled once per config version and header row.
+
+    Args:
+        config: Insurance config document
+        columns: The sheet's header row
+    """
+    from merging import MAPPED_FIELDS
+
+    columns = list(columns)
+    key = (str(config.get('_id')), config_version(config), header_signature(columns))
+    with _lock:
+        plan = _plan_entries.get(key)
+        if plan is not None:
+            _plan_entries.move_to_end(key)
+            _stats["plan_hits"] += 1
+            return plan
+        _stats["plan_misses"] += 1
+
+    plan = compile_column_plan(config.get('fields', {}), columns, MAPPED_FIELDS)
+
+    with _lock:
+        _plan_entries[key] = plan
+        while len(_plan_entries) > COLUMN_PLAN_CACHE_SIZE:
+            _plan_entries.popitem(last=False)
+    return plan
+
+def invalidate_config(config_id: str):
+    """Drop a cached insurance config (call after it is edited or deleted)"""
+    with _lock:
+        _config_entries.pop(str(config_id), None)
+        for key in [key for key in _plan_entries if key[0] == str(config_id)]:
+            del _plan_entries[key]
+
+def cache_stats() -> Dict[str, int]:
+    """Hit/miss counters since the process started"""
+    with _lock:
+        stats = dict(_stats)
+        stats["configs_cached"] = len(_config_entries)
+        stats["gaps_cached"] = len(_gaps_entries)
+        stats["plans_cached"] = len(_plan_entries)
+    return stats
@@ -0,0 +1,92 @@
+import hashlib
+from typing import List, Optional, Tuple
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
+
+# Listing queries for insurance configs.
+#
+# Every write to the insurance collection bumps a version counter kept in a small
+# system_files document, so a listing's ETag can be checked against one tiny read
+# instead of re-querying (and re-sending) hundreds of configs with their field maps.
+# Listings page through configs in _id order with an opaque "after" cursor and can be
+# projected down to a few top-level fields (e.g. just names for dropdowns).
+
+VERSION_QUERY = {"file_type": "insurance_configs_version"}
+
+# Largest page a listing returns at once
+MAX_PAGE_SIZE = 500
+
+def bump_configs_version(db) -> int:
+    """Record a write to the insurance collection (call after insert/update/delete)"""
+    doc = db.system_files.find_one_and_update(VERSION_QUERY, {"$inc": {"version": 1}}, upsert=True,
+                                              return_document=ReturnDocument.AFTER)
+    return doc["version"]
+
+def get_configs_version(db) -> int:
+    doc = db.system_files.find_one(VERSION_QUERY, {"version": 1})
+    return doc["version"] if doc else 0
+
+def parse_fields(fields: Optional[str]) -> Optional[dict]:
+    """
+    Projection for a comma-separated ?fields= list (top-level names; _id is always
+    included). None or empty returns full documents.
+
+    Raises:
+        ValueError: A field name starting with "$" or containing "."
+    """
+    names = [name.strip() for name in (fields or "").split(",") if name.strip()]
+    if not names:
+        return None
+    for name in names:
+        if name.startswith("$") or "." in name:
+            raise ValueError(f"Invalid field '{name}'")
+    return {name: 1 for name in names}
+
+def parse_cursor(after: Optional[str]) -> Optional[ObjectId]:
+    """
+    Raises:
+        ValueError: Not a cursor returned by list_configs
+    """
+    if not after:
+        return None
+    try:
+        return ObjectId(after)
+    except (InvalidId, TypeError):
+        raise ValueError("Invalid cursor")
+
+def listing_etag(version: int, *params) -> str:
+    """ETag value (unquoted; sent as a weak tag) for a listing: the collection version plus the listing parameters"""
+    digest = hashlib.sha1(repr(params).encode()).hexdigest()[:16]
+    return f"{version}-{digest}"
+
+def list_configs(db, projection: Optional[dict] = None, limit: Optional[int] = None,
+                 after: Optional[ObjectId] = None) -> Tuple[List[dict], Optional[str]]:
+    """
+    One page of insurance configs in _id order.
+
+    Args:
+        db: MongoDB database connection
+        projection: Fields to return (see parse_fields); None returns whole documents
+        limit: Page size (capped at MAX_PAGE_SIZE); None returns every config after the cursor
+        after: Cursor from the previous page
+
+    Returns:
+        tuple: (configs with string _ids, cursor for the next page or None on the last page)
+    """
+    query = {"_id": {"$gt": after}} if after is not None else {}
+    cursor = db.insurance.find(query, projection).sort("_id", 1)
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        # One extra document tells whether another page follows
+        cursor = cursor.limit(limit + 1)
+
+    configs = list(cursor)
+    next_cursor = None
+    if limit is not None and len(configs) > limit:
+        configs = configs[:limit]
+        next_cursor = str(configs[-1]["_id"])
+
+    for config in configs:
+        config["_id"] = str(config["_id"])
+    return configs, next_cursor
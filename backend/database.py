@@ -0,0 +1,119 @@
+import os
+import threading
+from typing import Optional
+
+# MongoDB connection, opened on first use.
+#
+# Nothing connects at import: the client is created by the first get_db() call in each
+# process, and pymongo opens sockets on the first operation, so a worker starts serving
+# without waiting on a round trip to the cluster. A client created before a fork (e.g. in
+# the gunicorn master with preload_app) is never reused in the child; the child makes its own.
+
+MONGO_URI = os.getenv("MONGO_URI")
+MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "configs")
+# Connections per worker process (routes, job threads and parse callbacks share them)
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "10"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+# How long an operation waits for a reachable server before failing
+MONGO_TIMEOUT_MS = int(os.getenv("MONGO_TIMEOUT_MS", "10000"))
+
+# Indexes ensured at boot: collection -> list of (key spec, options)
+INDEXES = {
+    # Gaps metadata, the config listing version and legacy gaps documents are looked up by type
+    "system_files": [([("file_type", 1)], {})],
+    # Configs are picked and searched by name
+    "insurance": [([("name", 1)], {})],
+    # Gaps versions' row, lookup and delta chunks are read back in order per version
+    "gaps_chunks": [([("gaps_id", 1), ("kind", 1), ("seq", 1)], {})],
+    # Master store appends look up both dedup keys; exports read rows in seq order
+    "master_rows": [
+        ([("store_id", 1), ("key_id", 1)], {}),
+        ([("store_id", 1), ("key_dob", 1)], {}),
+        ([("store_id", 1), ("seq", 1)], {}),
+    ],
+}
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+_db = None
+
+def _new_client():
+    from pymongo import MongoClient
+    return MongoClient(
+        MONGO_URI,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+        connectTimeoutMS=MONGO_TIMEOUT_MS,
+        connect=False,
+    )
+
+def get_db():
+    """
+    The application database, creating this process's client on first use.
+
+    The client connects lazily, so an unreachable cluster only shows up when an
+    operation's server selection times out (ServerSelectionTimeoutError, a
+    ConnectionFailure); the app turns either into a 503.
+
+    Raises:
+        ConnectionFailure: MONGO_URI isn't set or the client can't be created
+    """
+    from pymongo.errors import ConnectionFailure
+
+    global _client, _client_pid, _db
+    if _db is not None and _client_pid == os.getpid():
+        return _db
+    if not MONGO_URI:
+        raise ConnectionFailure("MONGO_URI not found in environment variables.")
+
+    with _lock:
+        if _db is None or _client_pid != os.getpid():
+            try:
+                # An inherited client belongs to the parent; just drop the reference
+                _client = _new_client()
+                _client_pid = os.getpid()
+                _db = _client[MONGO_DB_NAME]
+            except Exception as e:
+                print(f"Error connecting to MongoDB: {e}")
+                _client = _client_pid = _db = None
+                raise ConnectionFailure(str(e)) from e
+        return _db
+
+def close_db():
+    """Close this process's client (the next get_db() opens a new one)"""
+    global _client, _client_pid, _db
+    with _lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = _client_pid = _db = None
+
+def ensure_indexes(db):
+    """Create the indexes in INDEXES that don't exist yet (existing ones are left as they are)"""
+    for collection, indexes in INDEXES.items():
+        for keys, options in indexes:
+            db[collection].create_index(keys, **options)
+
+def bootstrap_indexes() -> bool:
+    """
+    Ensure indexes with a short-lived client of its own, so nothing stays open across a
+    fork. Run once at boot (the gunicorn master runs it before starting workers).
+
+    Returns:
+        bool: Whether the indexes were ensured
+    """
+    if not MONGO_URI:
+        print("MONGO_URI not found in environment variables.")
+        return False
+    client = None
+    try:
+        client = _new_client()
+        ensure_indexes(client[MONGO_DB_NAME])
+        return True
+    except Exception as e:
+        print(f"Could not ensure MongoDB indexes: {e}")
+        return False
+    finally:
+        if client is not None:
+            client.close()
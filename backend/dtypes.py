@@ -0,0 +1,104 @@
+import os
+from typing import Callable, List, Optional
+import numpy as np
+import pandas as pd
+from pandas.api.types import CategoricalDtype, infer_dtype, union_categoricals
+
+# Compact column representations for the merge pipeline.
+#
+# Parsed sheets hold one Python object per cell. Columns with few distinct values (care
+# gaps, insurance, providers, notes, and the constants a config fills in) are kept as
+# categoricals instead: an integer code per row plus each distinct value once, so text
+# conversions (str(), upper(), truncating IDs) run once per distinct value rather than
+# once per row. Name columns, which are mostly distinct, become Arrow-backed strings
+# when the optional pyarrow package is installed. The written cells are the same either way.
+
+# Set COMPACT_DTYPES=false to keep plain object columns (e.g. to compare memory use)
+COMPACT_DTYPES = os.getenv("COMPACT_DTYPES", "true").lower() == "true"
+
+_arrow_strings = None
+
+def arrow_strings() -> bool:
+    """Whether pyarrow is installed for Arrow-backed strings (detected once per process)"""
+    global _arrow_strings
+    if _arrow_strings is None:
+        try:
+            import pyarrow  # noqa: F401
+            _arrow_strings = True
+        except ImportError:
+            _arrow_strings = False
+    return _arrow_strings
+
+def is_categorical(values: pd.Series) -> bool:
+    return isinstance(values.dtype, CategoricalDtype)
+
+def _from_codes(codes: np.ndarray, categories, index) -> pd.Series:
+    return pd.Series(pd.Categorical.from_codes(codes, categories), index=index)
+
+def as_category(values: pd.Series) -> pd.Series:
+    """A low-cardinality column as a categorical (values unchanged)"""
+    if not COMPACT_DTYPES or is_categorical(values):
+        return values
+    return values.astype("category")
+
+def as_text(values: pd.Series) -> pd.Series:
+    """
+    Same values as values.astype(str) (missing values become "nan"), converting each
+    distinct value once and keeping the result categorical.
+    """
+    if not COMPACT_DTYPES:
+        return values.astype(str)
+    if is_categorical(values):
+        values = values.astype(object)
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    # Distinct values can share a string (1 and "1"), so the strings are factorized again
+    text_codes, categories = pd.factorize(pd.Index(uniques).astype(str))
+    return _from_codes(text_codes[codes], categories, values.index)
+
+def as_names(values: pd.Series) -> pd.Series:
+    """Mostly-distinct text as Arrow-backed strings; left as is without pyarrow or when not all text"""
+    if not COMPACT_DTYPES or not arrow_strings() or values.dtype != object:
+        return values
+    if infer_dtype(values, skipna=True) not in ("string", "empty"):
+        return values
+    return values.astype("string[pyarrow]")
+
+def constant(value, index) -> pd.Series:
+    """A column repeating one value (a single-category categorical)"""
+    if not COMPACT_DTYPES or pd.isna(value):
+        return pd.Series(value, index=index)
+    return _from_codes(np.zeros(len(index), dtype=np.int8), [value], index)
+
+def map_values(values: pd.Series, func: Callable) -> pd.Series:
+    """
+    values.map(func), calling func once per distinct value of a categorical. func
+    returning None marks the row missing.
+    """
+    if not is_categorical(values):
+        return values.map(func)
+    mapped = [func(category) for category in values.cat.categories]
+    mapped_codes, categories = pd.factorize(pd.Index(mapped, dtype=object))
+    codes = values.cat.codes.to_numpy()
+    return _from_codes(np.where(codes >= 0, mapped_codes[codes], -1), categories, values.index)
+
+def _object_categories(values: pd.Series) -> pd.Categorical:
+    categorical = values.array if is_categorical(values) else pd.Categorical(values)
+    if categorical.categories.dtype != object:
+        categorical = categorical.rename_categories(categorical.categories.astype(object))
+    return categorical
+
+def concat_column(pieces: List[pd.Series]) -> pd.Series:
+    """
+    Stack one column's pieces (new index). Categorical pieces are combined into one
+    categorical rather than falling back to objects when their categories differ.
+    """
+    if not any(is_categorical(piece) for piece in pieces):
+        return pd.concat(pieces, ignore_index=True)
+    return pd.Series(union_categoricals([_object_categories(piece) for piece in pieces]))
+
+def concat_frames(frames: List[pd.DataFrame], columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """pd.concat(frames, ignore_index=True) for frames sharing columns, keeping categorical columns compact"""
+    columns = list(frames[0].columns) if columns is None else columns
+    if not COMPACT_DTYPES:
+        return pd.concat(frames, ignore_index=True)
+    return pd.DataFrame({col: concat_column([frame[col] for frame in frames]) for col in columns})
@@ -0,0 +1,387 @@
+import os
+import re
+import unicodedata
+import warnings
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+
+# Near-duplicate detection for merged care gap rows.
+#
+# The exact dedup (merging.dedup_merge) misses the same patient and gap written
+# differently by two payers: case and spacing, nicknames, DOBs read as dates from one
+# file and as text from another, punctuation in member IDs. This stage normalizes those
+# fields and compares rows pairwise, but only within blocks of rows that already share
+# the care gap and either the DOB or a phonetic last-name key, so the cost follows the
+# block sizes rather than rows squared. Blocks larger than FUZZY_MAX_BLOCK_SIZE are
+# skipped (and counted) rather than compared.
+#
+# A pair is a duplicate when the names are similar enough (Jaro-Winkler of first and
+# last names, either order) and the rows share the DOB (FUZZY_NAME_THRESHOLD) or only the
+# member ID (FUZZY_ID_THRESHOLD, stricter since the DOB disagrees). Only new rows are
+# removed, each in favour of the earliest row it matches that is itself kept, and every
+# removal is listed on a review sheet.
+
+# Name similarity (0-1) needed when the rows share a DOB
+FUZZY_NAME_THRESHOLD = float(os.getenv("FUZZY_NAME_THRESHOLD", "0.9"))
+# Name similarity needed when they share only the member ID
+FUZZY_ID_THRESHOLD = float(os.getenv("FUZZY_ID_THRESHOLD", "0.95"))
+# Rows in one block beyond which the block isn't compared (pairs grow with its square)
+FUZZY_MAX_BLOCK_SIZE = int(os.getenv("FUZZY_MAX_BLOCK_SIZE", "200"))
+
+REVIEW_SHEET_NAME = 'Fuzzy Duplicates'
+
+REVIEW_COLUMNS = [
+    "Match Score", "Matched On", "Blocked By", "Care Gap", "Kept Sheet Row", "Kept From",
+    "Kept First Name", "Kept Last Name", "Kept Member ID", "Kept DOB", "Kept Insurance",
+    "Removed First Name", "Removed Last Name", "Removed Member ID", "Removed DOB", "Removed Insurance",
+]
+
+# Common nicknames -> the name they're matched as
+NICKNAMES = {
+    "abby": "abigail", "alex": "alexander", "andy": "andrew", "drew": "andrew",
+    "becky": "rebecca", "ben": "benjamin", "beth": "elizabeth", "betty": "elizabeth",
+    "liz": "elizabeth", "lizzie": "elizabeth", "eliza": "elizabeth", "bill": "william",
+    "billy": "william", "will": "william", "willy": "william", "bob": "robert",
+    "bobby": "robert", "rob": "robert", "robbie": "robert", "cathy": "katherine",
+    "catherine": "katherine", "kathy": "katherine", "kate": "katherine", "katie": "katherine",
+    "charlie": "charles", "chuck": "charles", "chris": "christopher", "dan": "daniel",
+    "danny": "daniel", "dave": "david", "deb": "deborah", "debbie": "deborah",
+    "dick": "richard", "rich": "richard", "richie": "richard", "rick": "richard",
+    "ricky": "richard", "don": "donald", "ed": "edward", "eddie": "edward",
+    "greg": "gregory", "jack": "john", "johnny": "john", "jon": "john",
+    "jen": "jennifer", "jenny": "jennifer", "jerry": "gerald", "jim": "james",
+    "jimmy": "james", "jamie": "james", "joe": "joseph", "joey": "joseph",
+    "ken": "kenneth", "kenny": "kenneth", "larry": "lawrence", "maggie": "margaret",
+    "peggy": "margaret", "matt": "matthew", "mike": "michael", "mikey": "michael",
+    "nick": "nicholas", "patty": "patricia", "ron": "ronald", "ronnie": "ronald",
+    "sam": "samuel", "stephen": "steven", "steve": "steven", "sue": "susan",
+    "susie": "susan", "tim": "timothy", "tom": "thomas", "tommy": "thomas",
+    "tony": "anthony", "vicky": "victoria",
+}
+
+NAME_SUFFIXES = {"jr", "sr", "ii", "iii", "iv"}
+
+# DOB text formats tried before pandas' (slower) format inference
+DOB_FORMATS = ["%m/%d/%Y", "%Y-%m-%d", "%Y-%m-%d %H:%M:%S", "%m-%d-%Y"]
+
+SOUNDEX_CODES = {letter: str(code) for code, letters in
+                 enumerate(["", "bfpv", "cgjkqsxz", "dt", "l", "mn", "r"]) for letter in letters}
+
+class FuzzyOptions:
+    def __init__(self, name_threshold: float = 0.9, id_threshold: float = 0.95):
+        self.name_threshold = name_threshold
+        self.id_threshold = id_threshold
+
+    def key(self) -> str:
+        """Identifies the options in result cache keys"""
+        return f"{self.name_threshold}-{self.id_threshold}"
+
+def fuzzy_options(name_threshold=None, id_threshold=None) -> FuzzyOptions:
+    """
+    Validate requested thresholds (default FUZZY_NAME_THRESHOLD and FUZZY_ID_THRESHOLD).
+
+    Raises:
+        ValueError: A threshold that isn't a number in (0, 1]
+    """
+    thresholds = []
+    for value, default in ((name_threshold, FUZZY_NAME_THRESHOLD), (id_threshold, FUZZY_ID_THRESHOLD)):
+        try:
+            value = float(value) if value not in (None, "") else default
+        except (TypeError, ValueError):
+            raise ValueError("Fuzzy dedup thresholds must be numbers between 0 and 1.")
+        if not 0 < value <= 1:
+            raise ValueError("Fuzzy dedup thresholds must be numbers between 0 and 1.")
+        thresholds.append(value)
+    return FuzzyOptions(*thresholds)
+
+def _name_tokens(value) -> List[str]:
+    """Lowercase ASCII words of a name, without suffixes (Jr, III, ...)"""
+    text = unicodedata.normalize("NFKD", str(value)).encode("ascii", "ignore").decode().lower()
+    return [token for token in re.split(r"[^a-z]+", text) if token and token not in NAME_SUFFIXES]
+
+def first_name_key(value) -> str:
+    """First word of a first name, nicknames replaced by the full name"""
+    tokens = _name_tokens(value)
+    return NICKNAMES.get(tokens[0], tokens[0]) if tokens else ""
+
+def last_name_key(value) -> str:
+    """A last name with case, accents, spaces and punctuation removed (De La Cruz -> delacruz)"""
+    return "".join(_name_tokens(value))
+
+def soundex(name: str) -> str:
+    """American Soundex code of a normalized name ("" for an empty one)"""
+    if not name:
+        return ""
+    code = name[0]
+    previous = SOUNDEX_CODES.get(name[0], "")
+    for letter in name[1:]:
+        digit = SOUNDEX_CODES.get(letter, "")
+        if digit and digit != previous:
+            code += digit
+        if letter not in "hw":
+            previous = digit
+    return (code + "000")[:4]
+
+def dob_key(value) -> str:
+    """
+    A DOB as YYYY-MM-DD, whether it was read as a date or as text (01/02/1980,
+    1980-01-02, 19800102, ...). Text that isn't a date is kept as is, lowercased.
+    """
+    if isinstance(value, (datetime, date)):
+        return value.strftime("%Y-%m-%d")
+    text = str(value).strip()
+    for fmt in DOB_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            pass
+    if re.fullmatch(r"\d{8}(\.0)?", text):
+        parsed = pd.to_datetime(text[:8], format="%Y%m%d", errors="coerce")
+    else:
+        with warnings.catch_warnings():
+            # "Could not infer format" for each distinct string
+            warnings.simplefilter("ignore")
+            try:
+                parsed = pd.to_datetime(text, errors="coerce")
+            except (ValueError, OverflowError):
+                parsed = pd.NaT
+    return text.lower() if pd.isna(parsed) else parsed.strftime("%Y-%m-%d")
+
+def member_id_key(value) -> str:
+    """A member ID uppercased, without punctuation or a float's ".0", cut to 6 characters like the merge"""
+    text = str(value).strip().upper()
+    if text.isalnum():
+        return "" if text in ("NAN", "NONE") else text[:6]
+    if re.fullmatch(r"\d+\.0", text):
+        text = text[:-2]
+    return re.sub(r"[^0-9A-Z]", "", text)[:6]
+
+@lru_cache(maxsize=2**16)
+def jaro_winkler(a: str, b: str) -> float:
+    """Jaro-Winkler similarity of two strings (0 when either is empty)"""
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    window = max(0, max(len(a), len(b)) // 2 - 1)
+    matched_b = [False] * len(b)
+    a_matches = []
+    for i, letter in enumerate(a):
+        for j in range(max(0, i - window), min(len(b), i + window + 1)):
+            if not matched_b[j] and b[j] == letter:
+                matched_b[j] = True
+                a_matches.append(letter)
+                break
+    matches = len(a_matches)
+    if matches == 0:
+        return 0.0
+    b_matches = [letter for letter, matched in zip(b, matched_b) if matched]
+    transpositions = sum(x != y for x, y in zip(a_matches, b_matches)) / 2
+    jaro = (matches / len(a) + matches / len(b) + (matches - transpositions) / matches) / 3
+    prefix = 0
+    for x, y in zip(a[:4], b[:4]):
+        if x != y:
+            break
+        prefix += 1
+    return jaro + prefix * 0.1 * (1 - jaro)
+
+def _first_similarity(a: str, b: str) -> float:
+    if not a and not b:
+        return 1.0
+    if (len(a) == 1 or len(b) == 1) and a[:1] == b[:1]:
+        # An initial against the full name
+        return 0.9
+    return jaro_winkler(a, b)
+
+def name_similarity(first_a: str, last_a: str, first_b: str, last_b: str) -> float:
+    """Mean of first- and last-name similarity, also trying the names swapped"""
+    score = (_first_similarity(first_a, first_b) + jaro_winkler(last_a, last_b)) / 2
+    if first_a and first_b:
+        score = max(score, (jaro_winkler(first_a, last_b) + jaro_winkler(last_a, first_b)) / 2)
+    return score
+
+def _jaro_winkler_bound(counts: np.ndarray, lengths: np.ndarray, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Upper bound of jaro_winkler for each pair of names a[k], b[k] (rows of counts): the
+    letters two names have in common bound their matches, and the prefix bonus is taken
+    at its largest.
+    """
+    common = np.minimum(counts[a], counts[b]).sum(axis=1)
+    jaro = (common / np.maximum(lengths[a], 1) + common / np.maximum(lengths[b], 1) + 1) / 3
+    return np.where(common > 0, jaro + 0.4 * (1 - jaro), 0.0)
+
+def _name_similarity_bound(first: np.ndarray, last: np.ndarray, i: np.ndarray, j: np.ndarray) -> np.ndarray:
+    """Upper bound of name_similarity for rows i[k] and j[k], computed for all pairs at once"""
+    codes, names = pd.factorize(np.concatenate([first, last]))
+    counts = np.zeros((len(names), 26), dtype=np.uint8)
+    for row, name in enumerate(names):
+        if name:
+            counts[row] = np.bincount(np.frombuffer(name.encode(), dtype=np.uint8) - ord("a"), minlength=26)
+    lengths = counts.sum(axis=1)
+    first_codes, last_codes = codes[:len(first)], codes[len(first):]
+    fi, fj, li, lj = first_codes[i], first_codes[j], last_codes[i], last_codes[j]
+
+    # Empty first names and initials score up to 1
+    first_bound = np.where((lengths[fi] <= 1) | (lengths[fj] <= 1), 1.0, _jaro_winkler_bound(counts, lengths, fi, fj))
+    straight = (first_bound + _jaro_winkler_bound(counts, lengths, li, lj)) / 2
+    swapped = (_jaro_winkler_bound(counts, lengths, fi, lj) + _jaro_winkler_bound(counts, lengths, li, fj)) / 2
+    return np.maximum(straight, np.where((lengths[fi] > 0) & (lengths[fj] > 0), swapped, 0.0))
+
+def _normalized(values: pd.Series, func: Callable) -> np.ndarray:
+    """func applied once per distinct value (missing values map to an empty string)"""
+    codes, uniques = pd.factorize(values)
+    mapped = np.array([func(value) for value in uniques] + [""], dtype=object)
+    return mapped[codes]
+
+def _block_codes(keys: List[np.ndarray]) -> np.ndarray:
+    """Integer code per row, equal for rows whose keys are all equal"""
+    codes = None
+    for values in keys:
+        value_codes, uniques = pd.factorize(values)
+        if codes is None:
+            codes = value_codes
+        else:
+            codes, _ = pd.factorize(codes * (len(uniques) + 1) + value_codes)
+    return codes
+
+def _candidate_pairs(codes: np.ndarray, eligible: np.ndarray, protected_rows: int,
+                     max_block: int) -> Tuple[List[Tuple[int, int]], int]:
+    """
+    (earlier row, new row) pairs within each block of eligible rows.
+
+    Returns:
+        tuple: (pairs, blocks skipped for being larger than max_block)
+    """
+    positions = np.flatnonzero(eligible)
+    if len(positions) == 0:
+        return [], 0
+    # Rows grouped by block, in row order within each block
+    order = positions[np.argsort(codes[positions], kind="stable")]
+    boundaries = np.flatnonzero(np.diff(codes[order])) + 1
+    starts = np.concatenate([[0], boundaries])
+    ends = np.concatenate([boundaries, [len(order)]])
+    # Only blocks of two or more rows that include a new row can produce a pair
+    sizes = ends - starts
+    compared = (sizes >= 2) & (order[ends - 1] >= protected_rows)
+    oversized = compared & (sizes > max_block)
+    pairs = []
+    for start, end in zip(starts[compared & ~oversized], ends[compared & ~oversized]):
+        rows = order[start:end].tolist()
+        for n, j in enumerate(rows):
+            if j >= protected_rows:
+                pairs.extend((i, j) for i in rows[:n])
+    return pairs, int(oversized.sum())
+
+def empty_review() -> pd.DataFrame:
+    return pd.DataFrame(columns=REVIEW_COLUMNS)
+
+def fuzzy_dedup(frame: pd.DataFrame, protected_rows: int, options: Optional[FuzzyOptions] = None,
+                max_block: Optional[int] = None) -> Tuple[pd.DataFrame, pd.DataFrame, Dict[str, int]]:
+    """
+    Remove near-duplicate rows from a merged frame.
+
+    Args:
+        frame: Rows with the master columns, master rows first (as dedup_merge returns them)
+        protected_rows: Leading rows never removed (the master's)
+        options: Thresholds (see fuzzy_options); None uses the defaults
+        max_block: Largest block compared; defaults to FUZZY_MAX_BLOCK_SIZE
+
+    Returns:
+        tuple: (rows kept, review sheet with one row per removed row and the row it was
+               merged into, counters: fuzzy_duplicates_dob, fuzzy_duplicates_id,
+               fuzzy_candidate_pairs, fuzzy_blocks_skipped)
+    """
+    options = options or fuzzy_options()
+    max_block = FUZZY_MAX_BLOCK_SIZE if max_block is None else max_block
+    stats = {"fuzzy_duplicates_dob": 0, "fuzzy_duplicates_id": 0, "fuzzy_candidate_pairs": 0, "fuzzy_blocks_skipped": 0}
+    if len(frame) - protected_rows < 1 or len(frame) < 2:
+        return frame, empty_review(), stats
+
+    gap = _normalized(frame["Care Gap"], lambda value: str(value).strip().upper())
+    first = _normalized(frame["First Name"], first_name_key)
+    last = _normalized(frame["Last Name"], last_name_key)
+    dob = _normalized(frame["DOB"], dob_key)
+    member = _normalized(frame["Member ID"], member_id_key)
+    phonetic = _normalized(frame["Last Name"], lambda value: soundex(last_name_key(value)))
+    initial = _normalized(frame["First Name"], lambda value: first_name_key(value)[:1])
+
+    # Block by care gap and DOB, then by care gap and how the last name sounds (with the
+    # first initial), which catches DOBs that disagree or didn't parse. A pair found by
+    # both passes is compared once.
+    passes = [
+        ("DOB", [gap, dob], dob != ""),
+        ("Last name sound", [gap, phonetic, initial], phonetic != ""),
+    ]
+    candidates = {}
+    for label, keys, eligible in passes:
+        pairs, skipped = _candidate_pairs(_block_codes(keys), eligible, protected_rows, max_block)
+        stats["fuzzy_blocks_skipped"] += skipped
+        for pair in pairs:
+            candidates.setdefault(pair, label)
+    stats["fuzzy_candidate_pairs"] = len(candidates)
+
+    if not candidates:
+        return frame, empty_review(), stats
+    pairs = np.array(list(candidates), dtype=np.int64)
+    labels = list(candidates.values())
+    i, j = pairs[:, 0], pairs[:, 1]
+
+    # Pairs sharing neither the DOB nor the member ID, or whose names can't reach the
+    # threshold (by letters in common), are dropped before any names are compared
+    same_dob = (dob[i] == dob[j]) & (dob[i] != "")
+    same_id = (member[i] == member[j]) & (member[i] != "")
+    threshold = np.where(same_dob, options.name_threshold, options.id_threshold)
+    bound = _name_similarity_bound(first, last, i, j)
+    compared = np.flatnonzero((same_dob | same_id) & (bound >= threshold - 1e-9))
+
+    matches = []
+    for n in compared.tolist():
+        a, b = i[n], j[n]
+        score = name_similarity(first[a], last[a], first[b], last[b])
+        if score >= threshold[n]:
+            matched_on = "DOB + Member ID" if same_dob[n] and same_id[n] else "DOB" if same_dob[n] else "Member ID"
+            matches.append((int(b), -score, int(a), matched_on, labels[n]))
+
+    # Rows in order; each is merged into its best-scoring earlier match that is itself kept
+    removed = np.zeros(len(frame), dtype=bool)
+    merged_pairs = []
+    for j, negative_score, i, matched_on, label in sorted(matches):
+        if removed[j] or removed[i]:
+            continue
+        removed[j] = True
+        merged_pairs.append((i, j, -negative_score, matched_on, label))
+        stats["fuzzy_duplicates_dob" if "DOB" in matched_on else "fuzzy_duplicates_id"] += 1
+
+    if not merged_pairs:
+        return frame, empty_review(), stats
+
+    kept_rows = np.array([pair[0] for pair in merged_pairs])
+    removed_rows = np.array([pair[1] for pair in merged_pairs])
+    # Where each kept row ends up in the written sheet (header is row 1)
+    sheet_rows = kept_rows - np.cumsum(removed)[kept_rows] + 2
+
+    def values(col, rows):
+        return frame[col].take(rows).to_numpy(dtype=object)
+
+    review = pd.DataFrame({
+        "Match Score": [round(pair[2], 3) for pair in merged_pairs],
+        "Matched On": [pair[3] for pair in merged_pairs],
+        "Blocked By": [pair[4] for pair in merged_pairs],
+        "Care Gap": values("Care Gap", kept_rows),
+        "Kept Sheet Row": sheet_rows,
+        "Kept From": np.where(kept_rows < protected_rows, "Master", "New data"),
+        "Kept First Name": values("First Name", kept_rows),
+        "Kept Last Name": values("Last Name", kept_rows),
+        "Kept Member ID": values("Member ID", kept_rows),
+        "Kept DOB": values("DOB", kept_rows),
+        "Kept Insurance": values("Insurance", kept_rows),
+        "Removed First Name": values("First Name", removed_rows),
+        "Removed Last Name": values("Last Name", removed_rows),
+        "Removed Member ID": values("Member ID", removed_rows),
+        "Removed DOB": values("DOB", removed_rows),
+        "Removed Insurance": values("Insurance", removed_rows),
+    })
+    return frame.take(np.flatnonzero(~removed)), review, stats
@@ -0,0 +1,365 @@
+import os
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+from bson import ObjectId
+import pandas as pd
+from merging import compile_gap_lookup
+
+# Versioned, chunked storage for the gaps file.
+#
+# The sheet used to live in a single system_files document as one `data` array, which
+# runs into MongoDB's 16 MB document limit as the gap catalog grows. Now:
+#   - system_files keeps a small metadata document per version (version number, row
+#     count, columns, change counts, chunk counts)
+#   - gaps_chunks holds each version's data in bounded chunks, linked to its metadata
+#     document by gaps_id and ordered by seq
+#   - a gaps_active document points at the version merges use
+# An upload is diffed against the active version. Usually only the delta is stored:
+# rows that changed or were added (by position, on the new columns), the new row count
+# and columns, and the gap lookup entries that changed. Every GAPS_SNAPSHOT_EVERY
+# versions (or when most rows changed) a full snapshot is stored instead, so loading a
+# version replays a bounded chain. The pointer only moves once the new version is fully
+# written, so there is never a moment with no gaps file, and older versions stay
+# loadable for reproducing earlier merges.
+# Info lookups only read the metadata documents; loads stream the chunks in order.
+
+GAPS_CHUNK_ROWS = int(os.getenv("GAPS_CHUNK_ROWS", "1000"))
+LOOKUP_CHUNK_PAIRS = int(os.getenv("GAPS_LOOKUP_CHUNK_PAIRS", "5000"))
+# Deltas stored in a row before the next version is a full snapshot
+GAPS_SNAPSHOT_EVERY = int(os.getenv("GAPS_SNAPSHOT_EVERY", "10"))
+# Versions kept loadable (plus the snapshot the oldest of them is built from)
+GAPS_KEEP_VERSIONS = int(os.getenv("GAPS_KEEP_VERSIONS", "20"))
+
+# Projection for metadata reads; never pulls the legacy `data` array
+META_PROJECTION = {"data": 0, "gap_lookup": 0}
+
+ACTIVE_QUERY = {"file_type": "gaps_active"}
+
+CHANGE_COUNTS = ["rows_added", "rows_removed", "rows_changed", "columns_added", "columns_removed",
+                 "mappings_added", "mappings_changed", "mappings_removed"]
+
+class GapsVersionConflict(Exception):
+    """Another upload switched the active version while this one was being stored"""
+    pass
+
+def _chunked(items: List, size: int) -> Iterator[List]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def _write_chunks(db, gaps_id, rows: List[dict], lookup: Dict[str, str]) -> Dict[str, int]:
+    """Insert row and lookup chunks for a snapshot version, returning the chunk counts"""
+    chunks = db.gaps_chunks
+
+    row_chunks = 0
+    for seq, batch in enumerate(_chunked(rows, GAPS_CHUNK_ROWS)):
+        chunks.insert_one({"gaps_id": gaps_id, "kind": "rows", "seq": seq, "rows": batch})
+        row_chunks += 1
+
+    lookup_chunks = 0
+    pairs = [[gap_name, header] for gap_name, header in lookup.items()]
+    for seq, batch in enumerate(_chunked(pairs, LOOKUP_CHUNK_PAIRS)):
+        chunks.insert_one({"gaps_id": gaps_id, "kind": "lookup", "seq": seq, "pairs": batch})
+        lookup_chunks += 1
+
+    return {"row_chunks": row_chunks, "lookup_chunks": lookup_chunks}
+
+def _write_delta_chunks(db, gaps_id, rows: List[list], pairs: List[list]) -> Dict[str, int]:
+    """Insert a delta version's changed rows ([index, row]) and lookup changes ([gap, header or None])"""
+    chunks = db.gaps_chunks
+
+    row_chunks = 0
+    for seq, batch in enumerate(_chunked(rows, GAPS_CHUNK_ROWS)):
+        chunks.insert_one({"gaps_id": gaps_id, "kind": "row_delta", "seq": seq, "rows": batch})
+        row_chunks += 1
+
+    lookup_chunks = 0
+    for seq, batch in enumerate(_chunked(pairs, LOOKUP_CHUNK_PAIRS)):
+        chunks.insert_one({"gaps_id": gaps_id, "kind": "lookup_delta", "seq": seq, "pairs": batch})
+        lookup_chunks += 1
+
+    return {"row_chunks": row_chunks, "lookup_chunks": lookup_chunks}
+
+def _cell(value):
+    """Missing cells (NaN from pandas or Mongo) compare and store as None"""
+    return None if value is None or (isinstance(value, float) and value != value) else value
+
+def _records(gaps_df) -> List[dict]:
+    return [{col: _cell(value) for col, value in row.items()} for row in gaps_df.to_dict('records')]
+
+def diff_gaps(base_rows: List[dict], base_columns: List, base_lookup: Dict[str, str],
+              rows: List[dict], columns: List, lookup: Dict[str, str]) -> Tuple[List[list], List[list], Dict[str, int]]:
+    """
+    Row/column and lookup diff between two gaps versions.
+
+    Rows are compared by position on the new columns, so a label added under one header
+    changes a single row and a removed column changes none.
+
+    Returns:
+        tuple: (changed or added rows as [index, row], lookup changes as [gap, header]
+               with None for a removed gap, change counts)
+    """
+    row_changes = []
+    rows_changed = 0
+    for index, row in enumerate(rows):
+        if index >= len(base_rows):
+            row_changes.append([index, row])
+        elif any(_cell(base_rows[index].get(col)) != row[col] for col in columns):
+            row_changes.append([index, row])
+            rows_changed += 1
+
+    pairs = [[gap_name, header] for gap_name, header in lookup.items() if base_lookup.get(gap_name) != header]
+    pairs += [[gap_name, None] for gap_name in base_lookup if gap_name not in lookup]
+
+    counts = {
+        "rows_added": max(0, len(rows) - len(base_rows)),
+        "rows_removed": max(0, len(base_rows) - len(rows)),
+        "rows_changed": rows_changed,
+        "columns_added": len([col for col in columns if col not in base_columns]),
+        "columns_removed": len([col for col in base_columns if col not in columns]),
+        "mappings_added": len([gap_name for gap_name in lookup if gap_name not in base_lookup]),
+        "mappings_changed": len([gap_name for gap_name in lookup if gap_name in base_lookup and base_lookup[gap_name] != lookup[gap_name]]),
+        "mappings_removed": len([gap_name for gap_name in base_lookup if gap_name not in lookup]),
+    }
+    return row_changes, pairs, counts
+
+def save_gaps(db, gaps_df) -> dict:
+    """
+    Store an uploaded gaps file as a new version (a delta against the active version
+    where that's smaller) and make it the active one.
+
+    An upload identical to the active version doesn't create a new version.
+
+    Args:
+        db: MongoDB database connection
+        gaps_df: Gaps DataFrame as uploaded
+
+    Returns:
+        dict: Metadata of the active version afterwards, with "unchanged" set when the
+              upload matched it
+
+    Raises:
+        GapsVersionConflict: Another upload became active first
+    """
+    rows = _records(gaps_df)
+    columns = list(gaps_df.columns)
+    lookup = compile_gap_lookup(gaps_df)
+
+    base = get_gaps_meta(db)
+    if base is not None:
+        base_rows = load_gaps_rows(db, base)
+        row_changes, pairs, counts = diff_gaps(base_rows, base.get('columns', []), load_gap_lookup(db, base),
+                                               rows, columns, lookup)
+        if not row_changes and not counts["rows_removed"] and columns == base.get('columns'):
+            return {**base, "unchanged": True}
+        version = base.get('version', 1) + 1
+        # A snapshot every so often bounds the chain a load replays; so does a mostly rewritten file
+        depth = base.get('delta_depth', 0) + 1
+        snapshot = depth > GAPS_SNAPSHOT_EVERY or len(row_changes) > len(rows) // 2
+    else:
+        counts = {name: 0 for name in CHANGE_COUNTS}
+        counts.update(rows_added=len(rows), columns_added=len(columns), mappings_added=len(lookup))
+        version, depth, snapshot = 1, 0, True
+
+    gaps_id = ObjectId()
+    if snapshot:
+        chunk_counts = _write_chunks(db, gaps_id, rows, lookup)
+        depth = 0
+    else:
+        chunk_counts = _write_delta_chunks(db, gaps_id, row_changes, pairs)
+
+    meta = {
+        "_id": gaps_id,
+        "file_type": "gaps",
+        "storage": "chunked",
+        "version": version,
+        "base_id": None if snapshot else base['_id'],
+        "base_version": base.get('version', 1) if base is not None else None,
+        "snapshot": snapshot,
+        "delta_depth": depth,
+        "columns": columns,
+        "row_count": len(rows),
+        "changes": counts,
+        **chunk_counts,
+        "uploaded_at": datetime.now(timezone.utc)
+    }
+    db.system_files.insert_one(dict(meta))
+
+    # Switch the active version only if it's still the one this upload was diffed against
+    if base is None:
+        switched = db.system_files.update_one(
+            ACTIVE_QUERY, {"$setOnInsert": {"gaps_id": gaps_id, "version": version}}, upsert=True
+        ).upserted_id is not None
+    else:
+        switched = db.system_files.update_one(
+            {**ACTIVE_QUERY, "gaps_id": base['_id']}, {"$set": {"gaps_id": gaps_id, "version": version}}
+        ).matched_count == 1
+    if not switched:
+        _delete_versions(db, [gaps_id])
+        raise GapsVersionConflict("Another gaps file upload finished first. Upload again to apply your changes on top of it.")
+
+    print(f"Gaps file version {version} stored as a {'snapshot' if snapshot else 'delta'}: "
+          + ", ".join(f"{name} {count}" for name, count in counts.items()))
+    _retire_old_versions(db, version)
+    return meta
+
+def _delete_versions(db, gaps_ids: List):
+    db.gaps_chunks.delete_many({"gaps_id": {"$in": gaps_ids}})
+    db.system_files.delete_many({"_id": {"$in": gaps_ids}})
+
+def _retire_old_versions(db, active_version: int):
+    """Drop versions older than GAPS_KEEP_VERSIONS, keeping what the oldest kept version is built from"""
+    oldest = db.system_files.find_one({"file_type": "gaps", "version": max(1, active_version - GAPS_KEEP_VERSIONS + 1)},
+                                      META_PROJECTION)
+    while oldest is not None and oldest.get('base_id') is not None:
+        oldest = db.system_files.find_one({"_id": oldest['base_id']}, META_PROJECTION)
+    if oldest is None:
+        return
+    retired = [doc['_id'] for doc in db.system_files.find(
+        {"file_type": "gaps", "version": {"$lt": oldest.get('version', 1)}}, {"_id": 1})]
+    if retired:
+        _delete_versions(db, retired)
+
+def migrate_legacy_gaps(db) -> bool:
+    """
+    Convert a single-document gaps file (`data` array) to the chunked layout in place.
+
+    The metadata document keeps its _id and uploaded_at, so its version stamp is unchanged.
+
+    Returns:
+        bool: True if a legacy document was migrated
+    """
+    legacy = db.system_files.find_one({"file_type": "gaps", "storage": {"$exists": False}})
+    if not legacy:
+        return False
+
+    rows = legacy.get('data', [])
+    if 'gap_lookup' in legacy:
+        lookup = dict(legacy['gap_lookup'])
+    else:
+        lookup = compile_gap_lookup(pd.DataFrame(rows))
+
+    # Clear partial chunks from an interrupted earlier attempt
+    db.gaps_chunks.delete_many({"gaps_id": legacy['_id']})
+    counts = _write_chunks(db, legacy['_id'], rows, lookup)
+
+    db.system_files.update_one(
+        {"_id": legacy['_id']},
+        {
+            "$set": {"storage": "chunked", "row_count": len(rows), **counts},
+            "$unset": {"data": "", "gap_lookup": ""}
+        }
+    )
+    print(f"Migrated legacy gaps file to {counts['row_chunks']} row chunks and {counts['lookup_chunks']} lookup chunks")
+    return True
+
+def _activate_legacy(db) -> Optional[dict]:
+    """
+    Point gaps_active at a gaps file uploaded before versioning (as version 1),
+    migrating a legacy single-document upload first.
+    """
+    meta = db.system_files.find_one({"file_type": "gaps"}, META_PROJECTION)
+    if not meta:
+        return None
+    if meta.get('storage') != "chunked":
+        migrate_legacy_gaps(db)
+    if 'version' not in meta:
+        db.system_files.update_one({"_id": meta['_id']}, {"$set": {"version": 1, "snapshot": True, "delta_depth": 0}})
+    db.system_files.update_one(ACTIVE_QUERY, {"$setOnInsert": {"gaps_id": meta['_id'], "version": meta.get('version', 1)}},
+                               upsert=True)
+    return db.system_files.find_one({"file_type": "gaps", "_id": meta['_id']}, META_PROJECTION)
+
+def get_gaps_meta(db, version: Optional[int] = None) -> Optional[dict]:
+    """
+    Get a gaps version's metadata document (no row data).
+
+    Args:
+        db: MongoDB database connection
+        version: Version number; None for the active version
+
+    Returns:
+        dict or None: Metadata, or None if no gaps file has been uploaded (or that
+                      version isn't kept)
+    """
+    if version is not None:
+        return db.system_files.find_one({"file_type": "gaps", "version": version}, META_PROJECTION)
+    active = db.system_files.find_one(ACTIVE_QUERY)
+    if active is None:
+        return _activate_legacy(db)
+    return db.system_files.find_one({"_id": active['gaps_id']}, META_PROJECTION)
+
+def _version_chain(db, meta: dict) -> List[dict]:
+    """Metadata from the snapshot a version is built on up to the version itself"""
+    chain = [meta]
+    while chain[-1].get('base_id') is not None:
+        base = db.system_files.find_one({"_id": chain[-1]['base_id']}, META_PROJECTION)
+        if base is None:
+            raise Exception(f"Gaps version {chain[-1].get('version')} is missing its base version.")
+        chain.append(base)
+    return chain[::-1]
+
+def apply_lookup_delta(lookup: Dict[str, str], pairs) -> Dict[str, str]:
+    """A copy of lookup with a delta's changed entries set and removed ones dropped"""
+    lookup = dict(lookup)
+    for gap_name, header in pairs:
+        if header is None:
+            lookup.pop(gap_name, None)
+        else:
+            lookup[gap_name] = header
+    return lookup
+
+def load_lookup_delta(db, meta: dict) -> List[list]:
+    """A delta version's lookup changes, [gap, header or None] each"""
+    pairs = []
+    for chunk in db.gaps_chunks.find({"gaps_id": meta['_id'], "kind": "lookup_delta"}).sort("seq", 1):
+        pairs.extend(chunk['pairs'])
+    return pairs
+
+def load_gap_lookup(db, meta: dict, base_lookup: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """
+    Load the compiled gap name -> header lookup for a gaps version.
+
+    Args:
+        meta: The version's metadata document
+        base_lookup: The lookup of the version a delta is based on, when the caller has
+                     it; then only the delta is read
+    """
+    if base_lookup is not None and meta.get('base_id') is not None:
+        return apply_lookup_delta(base_lookup, load_lookup_delta(db, meta))
+
+    chain = _version_chain(db, meta)
+    lookup = {}
+    for chunk in db.gaps_chunks.find({"gaps_id": chain[0]['_id'], "kind": "lookup"}).sort("seq", 1):
+        lookup.update((gap_name, header) for gap_name, header in chunk['pairs'])
+    for delta in chain[1:]:
+        lookup = apply_lookup_delta(lookup, load_lookup_delta(db, delta))
+    return lookup
+
+def load_gaps_rows(db, meta: dict) -> List[dict]:
+    """Rebuild a gaps version's rows (on its own columns) from its snapshot and deltas"""
+    chain = _version_chain(db, meta)
+    rows = []
+    for chunk in db.gaps_chunks.find({"gaps_id": chain[0]['_id'], "kind": "rows"}).sort("seq", 1):
+        rows.extend(chunk['rows'])
+    for delta in chain[1:]:
+        columns = delta.get('columns', [])
+        rows = [{col: _cell(row.get(col)) for col in columns} for row in rows[:delta['row_count']]]
+        for chunk in db.gaps_chunks.find({"gaps_id": delta['_id'], "kind": "row_delta"}).sort("seq", 1):
+            for index, row in chunk['rows']:
+                if index < len(rows):
+                    rows[index] = row
+                else:
+                    rows.append(row)
+    return rows
+
+def load_gaps_df(db, meta: dict):
+    """Rebuild a gaps version as a DataFrame"""
+    return pd.DataFrame(load_gaps_rows(db, meta), columns=meta.get('columns'))
+
+if __name__ == '__main__':
+    # One-off migration: python gaps_store.py
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    load_dotenv()
+    migrated = migrate_legacy_gaps(MongoClient(os.getenv("MONGO_URI"))['configs'])
+    print("Migrated legacy gaps file." if migrated else "No legacy gaps file to migrate.")
@@ -1,4 +1,5 @@
 import multiprocessing
+import os
 
 # Worker settings
 workers = 1  # Use only 1 worker on free tier to save memory
@@ -10,9 +11,30 @@ keepalive = 2
 # Memory and performance
 max_requests = 100  # Restart workers after N requests to prevent memory leaks
 max_requests_jitter = 20
-preload_app = False  # Don't preload to save memory
+# Import and warm the app once in the master; restarted workers fork from it ready to serve
+# instead of importing pandas & co. again (pages stay shared copy-on-write)
+preload_app = os.getenv("PRELOAD_APP", "true").lower() == "true"
 
 # Logging
 accesslog = '-'
 errorlog = '-'
 loglevel = 'info'
+
+# Hooks
+def on_starting(server):
+    # Once per deploy, in the master: workers never wait on index builds
+    from dotenv import load_dotenv
+    load_dotenv()
+    from database import bootstrap_indexes
+    bootstrap_indexes()
+
+def pre_fork(server, worker):
+    if preload_app:
+        # Keep the collector away from the preloaded objects the worker shares with the master
+        from startup import freeze
+        freeze()
+
+def post_fork(server, worker):
+    if preload_app:
+        from startup import worker_started
+        worker_started()
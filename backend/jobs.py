@@ -0,0 +1,225 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+# Background job queue for merges and PDF sorts.
+#
+# Submitting a job spools its uploads to a per-job directory and returns an ID right
+# away; the work runs on a small thread pool so the request worker stays free for other
+# users (and /api/health). Job state is kept in memory and mirrored to job.json in the
+# job directory, so status survives until the files are cleaned up and a restart can
+# mark interrupted jobs as failed instead of leaving them "running" forever.
+
+JOBS_DIR = os.getenv("JOBS_DIR", os.path.join(tempfile.gettempdir(), "nch-jobs"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", str(60 * 60)))  # Results contain PHI; don't keep them around
+
+_lock = threading.RLock()
+_jobs: Dict[str, "Job"] = {}
+_executor = None
+_loaded = False
+
+class StoredUpload:
+    """An upload spooled to the job directory, readable like werkzeug's FileStorage"""
+
+    def __init__(self, path: str, filename: str):
+        self.path = path
+        self.filename = filename
+        self._handle = None
+
+    def _file(self):
+        if self._handle is None:
+            self._handle = open(self.path, 'rb')
+        return self._handle
+
+    def read(self, *args):
+        return self._file().read(*args)
+
+    def seek(self, *args):
+        return self._file().seek(*args)
+
+    def tell(self):
+        return self._file().tell()
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+class Job:
+    def __init__(self, kind: str, download_name: str, mimetype: str, job_id: Optional[str] = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.kind = kind
+        self.download_name = download_name
+        self.mimetype = mimetype
+        self.status = "queued"
+        self.progress = {}
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.dir = os.path.join(JOBS_DIR, self.id)
+        self.result_path = os.path.join(self.dir, "result")
+        self.pid = os.getpid()
+        self._uploads = []
+
+    def store_upload(self, file_storage) -> StoredUpload:
+        """Spool an incoming upload to disk so it outlives the request"""
+        upload_dir = os.path.join(self.dir, "uploads")
+        os.makedirs(upload_dir, exist_ok=True)
+        path = os.path.join(upload_dir, str(len(self._uploads)))
+        source = getattr(file_storage, 'path', None)
+        if source is not None:
+            # Already on disk (e.g. an upload session's file): link it rather than copy
+            try:
+                os.link(source, path)
+            except OSError:
+                shutil.copyfile(source, path)
+        else:
+            file_storage.save(path)
+        stored = StoredUpload(path, file_storage.filename)
+        self._uploads.append(stored)
+        return stored
+
+    def update_progress(self, **counters):
+        """Record progress counters (rows read, sheets merged, PDFs routed, ...)"""
+        with _lock:
+            self.progress.update(counters)
+            self.updated_at = time.time()
+
+    def to_dict(self) -> dict:
+        with _lock:
+            return {
+                "id": self.id,
+                "kind": self.kind,
+                "status": self.status,
+                "progress": dict(self.progress),
+                "error": self.error,
+                "download_name": self.download_name,
+                "mimetype": self.mimetype,
+                "created_at": self.created_at,
+                "updated_at": self.updated_at,
+                "pid": self.pid,
+            }
+
+    def save(self):
+        os.makedirs(self.dir, exist_ok=True)
+        with open(os.path.join(self.dir, "job.json"), 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    def _set_status(self, status: str, error: Optional[str] = None):
+        with _lock:
+            self.status = status
+            self.error = error
+            self.updated_at = time.time()
+        self.save()
+
+    def _close_uploads(self):
+        for stored in self._uploads:
+            stored.close()
+
+def _process_alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except (OSError, TypeError):
+        return False
+    return True
+
+def _load_job_record(job_id: str) -> Optional[Job]:
+    """Rebuild a job from its job.json (written by this or another worker process)"""
+    try:
+        with open(os.path.join(JOBS_DIR, job_id, "job.json")) as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    job = Job(record["kind"], record["download_name"], record["mimetype"], job_id=job_id)
+    job.status = record["status"]
+    job.progress = record.get("progress", {})
+    job.error = record.get("error")
+    job.created_at = record.get("created_at", job.created_at)
+    job.updated_at = record.get("updated_at", job.updated_at)
+    job.pid = record.get("pid")
+    return job
+
+def _load_existing_jobs():
+    """Pick up job records left by previous worker processes"""
+    global _loaded
+    if _loaded:
+        return
+    _loaded = True
+    if not os.path.isdir(JOBS_DIR):
+        return
+    for job_id in os.listdir(JOBS_DIR):
+        job = _load_job_record(job_id)
+        if job is None:
+            continue
+        # The process running it is gone (e.g. restarted after max_requests)
+        if job.status in ("queued", "running") and not _process_alive(job.pid):
+            job.status = "failed"
+            job.error = "Interrupted by a server restart. Please resubmit."
+            job.save()
+        _jobs[job_id] = job
+
+def _expire_old_jobs():
+    cutoff = time.time() - JOB_TTL_SECONDS
+    with _lock:
+        expired = [job for job in _jobs.values() if job.status in ("done", "failed") and job.updated_at < cutoff]
+        for job in expired:
+            del _jobs[job.id]
+    for job in expired:
+        shutil.rmtree(job.dir, ignore_errors=True)
+
+def create_job(kind: str, download_name: str, mimetype: str) -> Job:
+    """Register a new job; spool its uploads with job.store_upload before starting it"""
+    with _lock:
+        _load_existing_jobs()
+    _expire_old_jobs()
+    job = Job(kind, download_name, mimetype)
+    job.save()
+    with _lock:
+        _jobs[job.id] = job
+    return job
+
+def start_job(job: Job, work: Callable[[Job], None]):
+    """
+    Run work(job) on the job pool.
+
+    work writes its output to job.result_path and reports progress through
+    job.update_progress; an exception marks the job failed.
+    """
+    global _executor
+
+    def run():
+        job._set_status("running")
+        try:
+            work(job)
+            job._set_status("done")
+        except Exception as e:
+            print(f"Job {job.id} ({job.kind}) failed: {e}")
+            import traceback
+            traceback.print_exc()
+            job._set_status("failed", "Job failed.")
+        finally:
+            job._close_uploads()
+            shutil.rmtree(os.path.join(job.dir, "uploads"), ignore_errors=True)
+
+    with _lock:
+        # Created lazily so no threads exist before a preforking server forks
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+        executor = _executor
+    executor.submit(run)
+
+def get_job(job_id: str) -> Optional[Job]:
+    """Look up a job, falling back to its record on disk if another process created it"""
+    with _lock:
+        _load_existing_jobs()
+        job = _jobs.get(job_id)
+    if job is None and job_id.isalnum():
+        job = _load_job_record(job_id)
+    return job
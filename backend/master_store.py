@@ -0,0 +1,410 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+from bson import ObjectId
+import pandas as pd
+from merging import DOB_KEY, ID_KEY, MASTER_COLUMNS, MERGED_SHEET_NAME
+from writers import spool_table
+
+# Server-side master store for incremental merges.
+#
+# Instead of re-uploading and re-parsing the whole master workbook on every merge, the
+# merged rows live on the server together with hashed versions of the two dedup keys:
+#   - key_id:  (Care Gap, First Name, Member ID, Last Name)
+#   - key_dob: (Care Gap, First Name, DOB, Last Name)
+# Both are indexed (see database.INDEXES, created at boot), so appending a batch only
+# looks up the incoming rows' keys and inserts the truly new ones; the workbook is built
+# only when someone exports it.
+#
+# Rows are kept in MongoDB by default (system_files holds a metadata document, master_rows
+# the rows), or in a local SQLite file when MASTER_STORE_PATH is set.
+#
+# An append checks keys and then inserts, so two appends running at once could both
+# insert the same new row. Writers are serialized across workers and instances: on
+# MongoDB by a lease document in the locks collection (it expires, so a crashed worker
+# can't hold it forever), on SQLite by an flock on a file next to the database.
+
+MASTER_STORE_PATH = os.getenv("MASTER_STORE_PATH", "")
+MASTER_STORE_BATCH = int(os.getenv("MASTER_STORE_BATCH", "1000"))
+
+# How long a writer's lease lasts; longer than any single append or replace
+MASTER_STORE_LOCK_SECONDS = int(os.getenv("MASTER_STORE_LOCK_SECONDS", "600"))
+
+# How long a writer waits for another writer's lease before giving up
+MASTER_STORE_LOCK_WAIT_SECONDS = float(os.getenv("MASTER_STORE_LOCK_WAIT_SECONDS", "120"))
+
+# Writers in the same process also queue on a thread lock, so they don't poll the lease
+_append_lock = threading.Lock()
+
+class MasterStoreBusy(Exception):
+    """Another writer held the master store for longer than MASTER_STORE_LOCK_WAIT_SECONDS"""
+    pass
+
+def _key_text(value) -> str:
+    """
+    Canonical text of a key value. Keys compare by text, so a Member ID a workbook parsed
+    as a number still matches the same ID read as text from a payer sheet.
+    """
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return "\x00"
+    if isinstance(value, datetime):
+        return pd.Timestamp(value).isoformat()
+    return str(value)
+
+def hash_key(values: Iterable) -> int:
+    """64-bit hash of a composite key, as a signed int (fits a BSON/SQLite integer)"""
+    text = "\x1f".join(_key_text(value) for value in values)
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'big', signed=True)
+
+def row_keys(df: pd.DataFrame) -> Tuple[List[int], List[int]]:
+    """Hashed ID and DOB keys for each row of a frame with the master columns"""
+    key_ids = [hash_key(values) for values in zip(*(df[col] for col in ID_KEY))]
+    key_dobs = [hash_key(values) for values in zip(*(df[col] for col in DOB_KEY))]
+    return key_ids, key_dobs
+
+def _records(df: pd.DataFrame) -> List[dict]:
+    """Rows as plain Python values (NaN/NaT become None)"""
+    frame = df[MASTER_COLUMNS].astype(object)
+    return frame.where(frame.notna(), None).to_dict('records')
+
+class MasterStore:
+    """
+    Backend-independent dedup logic; subclasses provide key lookups and row storage.
+
+    Rows are deduplicated with the same "disjoint" rule as a workbook merge: a row is
+    dropped if its ID key was seen before, then among the remaining rows if its DOB key
+    was seen before, with stored rows counting as seen first.
+    """
+
+    backend = None
+
+    def _select(self, key_ids: List[int], key_dobs: List[int], lookup) -> Tuple[List[int], Dict[str, int]]:
+        """
+        Positions of the rows to insert, plus counts of the rows each key rule removed.
+
+        lookup(field, keys) returns the subset of keys already stored.
+        """
+        survivors = []
+        seen = lookup("key_id", key_ids)
+        for position, key in enumerate(key_ids):
+            if key not in seen:
+                seen.add(key)
+                survivors.append(position)
+
+        keep = []
+        seen = lookup("key_dob", [key_dobs[position] for position in survivors])
+        for position in survivors:
+            if key_dobs[position] not in seen:
+                seen.add(key_dobs[position])
+                keep.append(position)
+
+        return keep, {
+            "received": len(key_ids),
+            "inserted": len(keep),
+            "duplicates_id": len(key_ids) - len(survivors),
+            "duplicates_dob": len(survivors) - len(keep),
+        }
+
+    def append(self, df: pd.DataFrame) -> Dict[str, int]:
+        """
+        Insert the rows of df whose keys aren't in the store yet, keeping df's order.
+
+        Returns:
+            dict: received, inserted, duplicates_id, duplicates_dob and the new row_count
+        """
+        key_ids, key_dobs = row_keys(df)
+        records = _records(df)
+        with _append_lock, self.write_lock():
+            keep, stats = self._select(key_ids, key_dobs, self.existing_keys)
+            self.insert([records[i] for i in keep], [key_ids[i] for i in keep], [key_dobs[i] for i in keep])
+            stats["row_count"] = self.info()["row_count"]
+        return stats
+
+    def replace(self, df: pd.DataFrame) -> Dict[str, int]:
+        """Replace the store's contents with the rows of df, deduplicated the same way"""
+        key_ids, key_dobs = row_keys(df)
+        records = _records(df)
+        with _append_lock, self.write_lock():
+            keep, stats = self._select(key_ids, key_dobs, lambda field, keys: set())
+            self.replace_rows([records[i] for i in keep], [key_ids[i] for i in keep], [key_dobs[i] for i in keep])
+            stats["row_count"] = len(keep)
+        return stats
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """All stored rows in insertion order"""
+        return pd.DataFrame(list(self.iter_rows()), columns=MASTER_COLUMNS)
+
+    def export(self, fmt: str = "xlsx", enable_to_be_removed: bool = False) -> str:
+        """
+        Write the master sheet, laid out like a merge's output, to a temporary file.
+
+        Returns:
+            str: Path of the file; the caller removes it
+        """
+        masterFrame = self.to_dataframe()
+        if enable_to_be_removed:
+            masterFrame['To be removed'] = ""
+        return spool_table(masterFrame, fmt, sheet_name=MERGED_SHEET_NAME)
+
+    # Backend interface
+    @contextmanager
+    def write_lock(self):
+        """Hold off other processes' writers; the default assumes a single writer process"""
+        yield
+
+    def existing_keys(self, field: str, keys: List[int]) -> Set[int]:
+        raise NotImplementedError
+
+    def insert(self, records: List[dict], key_ids: List[int], key_dobs: List[int]):
+        raise NotImplementedError
+
+    def replace_rows(self, records: List[dict], key_ids: List[int], key_dobs: List[int]):
+        raise NotImplementedError
+
+    def iter_rows(self) -> Iterator[dict]:
+        raise NotImplementedError
+
+    def info(self) -> dict:
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+def _batches(items: List, size: int) -> Iterator[List]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+class MongoMasterStore(MasterStore):
+    """
+    Rows in master_rows, tagged with the store version they belong to and a sequence
+    number for export order. A replace writes a new version before retiring the old one,
+    like gaps uploads.
+    """
+
+    backend = "mongo"
+
+    def __init__(self, db):
+        self.db = db
+
+    def _meta(self) -> dict:
+        meta = self.db.system_files.find_one({"file_type": "master_store"})
+        if meta is None:
+            self.db.system_files.update_one(
+                {"file_type": "master_store"},
+                {"$setOnInsert": {"store_id": ObjectId(), "row_count": 0, "next_seq": 0, "updated_at": datetime.now(timezone.utc)}},
+                upsert=True
+            )
+            meta = self.db.system_files.find_one({"file_type": "master_store"})
+        return meta
+
+    @contextmanager
+    def write_lock(self):
+        """
+        Hold the master store's lease in the locks collection.
+
+        Raises:
+            MasterStoreBusy: If another writer kept it for MASTER_STORE_LOCK_WAIT_SECONDS
+        """
+        from pymongo.errors import DuplicateKeyError
+
+        owner = uuid.uuid4().hex
+        give_up = time.monotonic() + MASTER_STORE_LOCK_WAIT_SECONDS
+        while True:
+            now = datetime.now(timezone.utc)
+            try:
+                # Takes the lease when there is none or it has expired; a live lease
+                # doesn't match, so the upsert collides with its _id
+                self.db.locks.update_one(
+                    {"_id": "master_store", "expires_at": {"$lt": now}},
+                    {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=MASTER_STORE_LOCK_SECONDS)}},
+                    upsert=True
+                )
+                break
+            except DuplicateKeyError:
+                if time.monotonic() >= give_up:
+                    raise MasterStoreBusy("The master store is being updated by another merge. Please try again shortly.")
+                time.sleep(0.2)
+        try:
+            yield
+        finally:
+            self.db.locks.delete_one({"_id": "master_store", "owner": owner})
+
+    def existing_keys(self, field, keys):
+        store_id = self._meta()["store_id"]
+        found = set()
+        for batch in _batches(list(set(keys)), MASTER_STORE_BATCH):
+            for doc in self.db.master_rows.find({"store_id": store_id, field: {"$in": batch}}, {field: 1, "_id": 0}):
+                found.add(doc[field])
+        return found
+
+    def _insert_docs(self, store_id, first_seq, records, key_ids, key_dobs):
+        docs = [
+            {"store_id": store_id, "seq": first_seq + offset, "key_id": key_id, "key_dob": key_dob, "row": record}
+            for offset, (record, key_id, key_dob) in enumerate(zip(records, key_ids, key_dobs))
+        ]
+        for batch in _batches(docs, MASTER_STORE_BATCH):
+            self.db.master_rows.insert_many(batch)
+
+    def _last_seq(self, store_id) -> int:
+        last = list(self.db.master_rows.find({"store_id": store_id}, {"seq": 1, "_id": 0}).sort("seq", -1).limit(1))
+        return last[0]["seq"] if last else -1
+
+    def insert(self, records, key_ids, key_dobs):
+        if not records:
+            return
+        store_id = self._meta()["store_id"]
+        # Number on from the rows actually stored, then count only what was inserted
+        first_seq = self._last_seq(store_id) + 1
+        inserted = len(records)
+        try:
+            self._insert_docs(store_id, first_seq, records, key_ids, key_dobs)
+        except Exception:
+            inserted = self.db.master_rows.count_documents({"store_id": store_id, "seq": {"$gte": first_seq}})
+            raise
+        finally:
+            self.db.system_files.update_one(
+                {"file_type": "master_store"},
+                {"$inc": {"row_count": inserted},
+                 "$set": {"next_seq": first_seq + inserted, "updated_at": datetime.now(timezone.utc)}}
+            )
+
+    def replace_rows(self, records, key_ids, key_dobs):
+        store_id = ObjectId()
+        self._insert_docs(store_id, 0, records, key_ids, key_dobs)
+        self.db.system_files.update_one(
+            {"file_type": "master_store"},
+            {"$set": {"store_id": store_id, "row_count": len(records), "next_seq": len(records),
+                      "updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+        self.db.master_rows.delete_many({"store_id": {"$ne": store_id}})
+
+    def iter_rows(self):
+        store_id = self._meta()["store_id"]
+        for doc in self.db.master_rows.find({"store_id": store_id}, {"row": 1, "_id": 0}).sort("seq", 1):
+            yield doc["row"]
+
+    def info(self):
+        meta = self._meta()
+        return {"backend": self.backend, "row_count": meta.get("row_count", 0), "updated_at": meta.get("updated_at")}
+
+    def clear(self):
+        self.replace_rows([], [], [])
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    raise TypeError(f"Cannot store {type(value).__name__} in the master store")
+
+def _decode_value(obj):
+    if set(obj) == {"$date"}:
+        return datetime.fromisoformat(obj["$date"])
+    return obj
+
+class SQLiteMasterStore(MasterStore):
+    """Rows in a local SQLite file; rowid order is insertion order"""
+
+    backend = "file"
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS master_rows (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "key_id INTEGER NOT NULL, key_dob INTEGER NOT NULL, row TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS master_rows_key_id ON master_rows (key_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS master_rows_key_dob ON master_rows (key_dob)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+
+    def _connect(self):
+        # A connection per call; request and job threads don't share one
+        return sqlite3.connect(self.path, timeout=30)
+
+    @contextmanager
+    def write_lock(self):
+        """
+        Hold an exclusive flock on the database's lock file.
+
+        Raises:
+            MasterStoreBusy: If another writer kept it for MASTER_STORE_LOCK_WAIT_SECONDS
+        """
+        import fcntl
+
+        give_up = time.monotonic() + MASTER_STORE_LOCK_WAIT_SECONDS
+        with open(self.path + ".lock", "a") as lock_file:
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= give_up:
+                        raise MasterStoreBusy("The master store is being updated by another merge. Please try again shortly.")
+                    time.sleep(0.2)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _touch(self, conn):
+        conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('updated_at', ?)",
+                     (datetime.now(timezone.utc).isoformat(),))
+
+    def _insert_rows(self, conn, records, key_ids, key_dobs):
+        conn.executemany(
+            "INSERT INTO master_rows (key_id, key_dob, row) VALUES (?, ?, ?)",
+            ((key_id, key_dob, json.dumps(record, default=_encode_value))
+             for record, key_id, key_dob in zip(records, key_ids, key_dobs))
+        )
+
+    def existing_keys(self, field, keys):
+        if field not in ("key_id", "key_dob"):
+            raise ValueError(f"Unknown key field {field}")
+        found = set()
+        with self._connect() as conn:
+            for batch in _batches(list(set(keys)), 500):  # Stay under SQLite's bound parameter limit
+                placeholders = ",".join("?" * len(batch))
+                found.update(key for (key,) in conn.execute(f"SELECT {field} FROM master_rows WHERE {field} IN ({placeholders})", batch))
+        return found
+
+    def insert(self, records, key_ids, key_dobs):
+        with self._connect() as conn:
+            self._insert_rows(conn, records, key_ids, key_dobs)
+            self._touch(conn)
+
+    def replace_rows(self, records, key_ids, key_dobs):
+        # One transaction, so readers see either the old rows or the new ones
+        with self._connect() as conn:
+            conn.execute("DELETE FROM master_rows")
+            self._insert_rows(conn, records, key_ids, key_dobs)
+            self._touch(conn)
+
+    def iter_rows(self):
+        conn = self._connect()
+        try:
+            for (row,) in conn.execute("SELECT row FROM master_rows ORDER BY seq"):
+                yield json.loads(row, object_hook=_decode_value)
+        finally:
+            conn.close()
+
+    def info(self):
+        with self._connect() as conn:
+            (row_count,) = conn.execute("SELECT COUNT(*) FROM master_rows").fetchone()
+            updated_at = conn.execute("SELECT value FROM meta WHERE name = 'updated_at'").fetchone()
+        return {"backend": self.backend, "row_count": row_count, "updated_at": updated_at[0] if updated_at else None}
+
+    def clear(self):
+        self.replace_rows([], [], [])
+
+def get_master_store(db) -> MasterStore:
+    """The configured master store: a local SQLite file if MASTER_STORE_PATH is set, else MongoDB"""
+    if MASTER_STORE_PATH:
+        return SQLiteMasterStore(MASTER_STORE_PATH)
+    if db is None:
+        raise Exception("Database connection is down.")
+    return MongoMasterStore(db)
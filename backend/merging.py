@@ -1,191 +1,438 @@
+import os
+import numpy as np
 import pandas as pd
-from typing import List, Dict, Tuple
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import Callable, List, Dict, Optional, Tuple
+from dtypes import as_category, as_names, as_text, concat_column, concat_frames, constant, map_values
+from fuzzy_dedup import REVIEW_SHEET_NAME, FuzzyOptions, fuzzy_dedup
+from metrics import stage
+from readers import column_selector, read_table
+from uploads import materialize, upload_source
+from writers import spool_table
 
-def merge_care_gap_sheets(master_file, care_gap_files_with_configs: List[Tuple], db, enable_to_be_removed: bool) -> bytes:
+# Processes used to parse uploaded workbooks in parallel; 1 parses serially in-process,
+# which keeps only one parsed upload's raw bytes in memory at a time
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", "1"))
+
+_parse_pool = None
+_parse_pool_workers = 0
+
+# Config fields that name a column in the payer sheet
+MAPPED_FIELDS = ["First Name", "Last Name", "Full Name", "Member ID", "Care Gap", "DOB", "Doctor/Provider", "Insurance", "Notes"]
+# Sheets missing any of these contribute no rows
+REQUIRED_FIELDS = ["Care Gap", "Member ID", "DOB"]
+
+# Columns of the merged master sheet, in output order
+MASTER_COLUMNS = ["First Name", "Last Name", "Member ID", "Care Gap", "DOB", "Insurance", "Doctor/Provider", "Notes"]
+
+MERGED_SHEET_NAME = 'Merged Care Gaps'
+
+# Composite keys for "disjoint" dedup: a row is a duplicate if either key was seen before
+ID_KEY = ['Care Gap', 'First Name', 'Member ID', 'Last Name']
+DOB_KEY = ['Care Gap', 'First Name', 'DOB', 'Last Name']
+
+def _parse_upload(filename: str, source, columns: Optional[List] = None):
     """
-    Merge multiple care gap sheets into the master sheet.
+    Parse one uploaded Excel/CSV file from a path, a binary stream or raw bytes (as
+    handed to a parse process).
+    
+    columns (header names, matched case-insensitively) prunes the read to just those
+    columns; None reads everything. Names rather than a callable so this pickles.
+    """
+    if isinstance(source, bytes):
+        source = BytesIO(source)
+    usecols = column_selector(columns) if columns is not None else None
+    return read_table(source, filename, usecols=usecols)
+
+def _get_parse_pool(workers: int):
+    """Process pool shared across merges, created on first parallel parse"""
+    global _parse_pool, _parse_pool_workers
+    if _parse_pool is None or _parse_pool_workers != workers:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        if _parse_pool is not None:
+            _parse_pool.shutdown(wait=False)
+        # forkserver children don't inherit the web worker's threads or Mongo sockets
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        _parse_pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        _parse_pool_workers = workers
+    return _parse_pool
+
+def _discard_parse_pool(pool):
+    """Drop a pool that lost a worker (e.g. killed for memory) so the next parallel parse starts a new one"""
+    global _parse_pool
+    if _parse_pool is pool:
+        _parse_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _read_serial(files: List, columns: List[Optional[List]]) -> List[pd.DataFrame]:
+    frames = []
+    for file, file_columns in zip(files, columns):
+        with stage("parse") as parse:
+            frames.append(_parse_upload(file.filename, upload_source(file), file_columns))
+            parse["rows"] = len(frames[-1])
+    return frames
+
+def read_uploads(files: List, workers: Optional[int] = None, columns: Optional[List[Optional[List]]] = None) -> List[pd.DataFrame]:
+    """
+    Parse uploaded Excel/CSV files, in parallel when more than one worker is configured.
     
     Args:
-        master_file: The master Excel file (file object or path)
-        care_gap_files_with_configs: List of tuples [(file, config_id), (file, config_id), ...]
-        db: MongoDB database connection to fetch configs
-        enable_to_be_removed: Boolean flag to enable "to be removed" logic
+        files: File objects with .filename (FileStorage, or anything with read/seek;
+               spooled uploads exposing .path are parsed straight from disk). Serial
+               parses read the upload's stream in place; parse processes get a path, or
+               else a copy of the bytes charged to the request's upload memory budget
+        workers: Number of parse processes; defaults to PARSE_WORKERS, 1 means serial
+        columns: Optional per-file lists of header names to keep (None entries read all columns)
     
     Returns:
-        bytes: The merged Excel file as bytes for download
+        list: DataFrames in the same order as files
+    
+    If a parse process dies mid-merge, the pool is replaced on the next parallel parse
+    and this merge falls back to parsing serially.
     """
-    from bson import ObjectId
-    from io import BytesIO
+    workers = PARSE_WORKERS if workers is None else workers
+    columns = columns if columns is not None else [None] * len(files)
     
-    # Fetch gaps file from database
-    gaps_doc = db.system_files.find_one({"file_type": "gaps"})
-    if not gaps_doc:
-        raise Exception("Gaps file not found in database. Please upload it in Settings.")
+    if workers <= 1 or len(files) <= 1:
+        return _read_serial(files, columns)
     
-    gaps = pd.DataFrame(gaps_doc['data'])
+    pool = _get_parse_pool(workers)
+    try:
+        futures = []
+        for file, file_columns in zip(files, columns):
+            path = getattr(file, 'path', None)
+            if path is None:
+                with stage("upload_read"):
+                    data = materialize(file)
+                futures.append(pool.submit(_parse_upload, file.filename, data, file_columns))
+                del data
+            else:
+                futures.append(pool.submit(_parse_upload, file.filename, path, file_columns))
+        
+        # Collect in submission order so sheet order (and keep='first' dedup) is unchanged
+        with stage("parse") as parse:
+            frames = [future.result() for future in futures]
+            parse["rows"] = sum(len(frame) for frame in frames)
+        return frames
+    except BrokenProcessPool:
+        print("Parse pool lost a worker; replacing it and parsing this merge serially")
+        _discard_parse_pool(pool)
+        return _read_serial(files, columns)
+
+def compile_gap_lookup(gaps) -> Dict[str, str]:
+    """
+    Compile the gaps sheet into an uppercase gap name -> header lookup.
     
-    # Read master file (handle FileStorage object)
-    # Support both Excel and CSV
-    if master_file.filename.endswith('.csv'):
-        master = pd.read_csv(BytesIO(master_file.read()))
-    else:
-        master = pd.read_excel(BytesIO(master_file.read()))
-    master_file.seek(0)  # Reset file pointer
+    Columns are scanned left to right, so when a value appears under several headers
+    the first column wins.
     
-    # Handle "To be removed" logic if enabled
-    if enable_to_be_removed and 'To be removed' in master.columns:
-        mask = master["To be removed"].astype(str).str.contains("y", case=False, na=False)
-        master = master.loc[~mask].copy()
-        master = master.drop(columns=['To be removed'])
+    Args:
+        gaps: Gaps DataFrame (one column per header, gap names as values)
     
-    cols = ["First Name", "Last Name", "Member ID", "Care Gap", "DOB", "Insurance", "Doctor/Provider", "Notes"]
+    Returns:
+        dict: Uppercased gap name -> header
+    """
+    lookup = {}
+    for col in gaps.columns:
+        for value in gaps[col].dropna():
+            lookup.setdefault(str(value).upper(), col)
+    return lookup
+
+def key_codes(frames: List[pd.DataFrame], subset: List[str]) -> np.ndarray:
+    """
+    Integer key per row of the stacked frames: equal keys <=> equal subset values.
     
-    # If master has the right columns, use it; otherwise start fresh
-    if all(col in master.columns for col in cols):
-        masterFrame = master[cols].copy()
-        print(f"Starting with {len(masterFrame)} rows from master file")
-    else:
-        masterFrame = pd.DataFrame(columns=cols)
-        print("Master file doesn't have expected columns, starting fresh")
+    Values compare the way DataFrame.drop_duplicates compares them (each column is
+    factorized, all missing values are equal); the per-column codes are folded pairwise
+    and re-factorized, so the combined key stays exact and never overflows.
+    """
+    keys = None
+    for col in subset:
+        codes, uniques = pd.factorize(concat_column([frame[col] for frame in frames]))
+        codes = codes + 1  # Missing values (-1) get a code of their own
+        if keys is None:
+            keys = codes
+        else:
+            keys, _ = pd.factorize(keys * (len(uniques) + 1) + codes)
+    return keys
+
+def _first_occurrences(keys: np.ndarray) -> np.ndarray:
+    """Positions of the first row with each key, in row order"""
+    _, first = np.unique(keys, return_index=True)
+    first.sort()
+    return first
+
+def disjoint_select(id_keys: np.ndarray, dob_keys: np.ndarray) -> Tuple[np.ndarray, int, int]:
+    """
+    Apply the disjoint rule to rows in order: drop a row whose ID key was seen before,
+    then, among the rows left, one whose DOB key was seen before (keep='first' for both).
+    
+    Returns:
+        tuple: (positions kept, rows removed by the ID key, rows removed by the DOB key)
+    """
+    after_id = _first_occurrences(id_keys)
+    kept = after_id[_first_occurrences(dob_keys[after_id])]
+    return kept, len(id_keys) - len(after_id), len(after_id) - len(kept)
+
+def dedup_new_rows(newDataFrame: pd.DataFrame) -> Tuple[pd.DataFrame, Dict[str, int]]:
+    """Drop duplicates within new data; returns the rows kept and the rows removed per key rule"""
+    kept, by_id, by_dob = disjoint_select(key_codes([newDataFrame], ID_KEY), key_codes([newDataFrame], DOB_KEY))
+    return newDataFrame.take(kept), {"new_duplicates_id": by_id, "new_duplicates_dob": by_dob}
+
+def dedup_merge(masterFrame: pd.DataFrame, newDataFrame: pd.DataFrame) -> Tuple[pd.DataFrame, Dict[str, int], int]:
+    """
+    Deduplicate new data and append it to master in one stage.
     
-    # Create array of dataframes and fetch configs
+    Same result as dropping duplicates (ID key, then DOB key) within the new data,
+    appending it to master and dropping duplicates (ID key, then DOB key) again with
+    master rows first, but both keys are computed once, as integers, for all rows.
+    
+    Returns:
+        tuple: (merged frame, rows removed per key rule within new data and against master,
+               how many of the merged frame's leading rows came from master)
+    """
+    frames = [masterFrame, newDataFrame]
+    id_keys = key_codes(frames, ID_KEY)
+    dob_keys = key_codes(frames, DOB_KEY)
+    
+    # Within new data
+    new_positions = np.arange(len(masterFrame), len(id_keys))
+    new_kept, new_by_id, new_by_dob = disjoint_select(id_keys[new_positions], dob_keys[new_positions])
+    print(f"New data after deduplication: {len(new_kept)} rows")
+    
+    # Against master, whose rows come first
+    candidates = np.concatenate([np.arange(len(masterFrame)), new_positions[new_kept]])
+    kept, master_by_id, master_by_dob = disjoint_select(id_keys[candidates], dob_keys[candidates])
+    
+    merged = concat_frames([masterFrame, newDataFrame.take(new_kept)]).take(kept)
+    return merged, {
+        "new_duplicates_id": new_by_id,
+        "new_duplicates_dob": new_by_dob,
+        "master_duplicates_id": master_by_id,
+        "master_duplicates_dob": master_by_dob,
+    }, int(np.count_nonzero(kept < len(masterFrame)))
+
+def build_new_rows(sheet_frames: List[pd.DataFrame], care_gap_files_with_configs: List[Tuple], configs_by_id: Dict[str, dict],
+                   gap_lookup: Dict[str, str], report: Callable, rows_read: int = 0, dedup: bool = True) -> pd.DataFrame:
+    """
+    Turn parsed payer sheets into new master rows: project each sheet onto the master
+    columns through its config, map care gaps to their headers (dropping unmapped ones),
+    and (with dedup) drop duplicates within the new data.
+    
+    Args:
+        sheet_frames: Parsed payer sheets, in the same order as care_gap_files_with_configs
+        care_gap_files_with_configs: List of tuples [(file, config_id), ...]
+        configs_by_id: config id -> config document
+        gap_lookup: Uppercased gap name -> header
+        report: Progress callback taking keyword counters
+        rows_read: Rows already read (the master's), for progress counts
+        dedup: False leaves deduplication to the caller (see dedup_merge)
+    
+    Returns:
+        pd.DataFrame: New rows with the master columns
+    """
+    cols = MASTER_COLUMNS
+    
+    from cache import get_column_plan
+    
+    # Create array of dataframes and match their configs
     all_dfs = []
     configs_list = []
+    config_docs = []
     total_rows = 0 
     
-    for file, config_id in care_gap_files_with_configs:
-        # Read the Excel/CSV file (handle FileStorage object)
-        if file.filename.endswith('.csv'):
-            temp = pd.read_csv(BytesIO(file.read()))
-        else:
-            temp = pd.read_excel(BytesIO(file.read()))
-        file.seek(0)  # Reset file pointer
+    for temp, (file, config_id) in zip(sheet_frames, care_gap_files_with_configs):
         all_dfs.append(temp)
         total_rows += len(temp)
+        report(rows_read=rows_read + total_rows, sheets_read=len(all_dfs))
         
-        # Fetch the config from MongoDB
-        config = db.insurance.find_one({"_id": ObjectId(config_id)})
+        # Look up the config (fetched in one batch by the caller)
+        config = configs_by_id.get(str(config_id))
         if config:
             configs_list.append(config['fields'])  # Get the fields dict
+            config_docs.append(config)
     
     # Convert configs list to DataFrame matching original script structure
     masterCols = pd.DataFrame(configs_list)
     
-    # Create temporary frame for new data only
-    newDataFrame = pd.DataFrame(columns=cols)
+    # Project each sheet onto the mapped columns; concatenated once after the loop
+    subset_frames = []
 
-    # Helper function to find column case-insensitively
-    def find_column(df, col_name):
-        """Find column in dataframe case-insensitively"""
-        if pd.isna(col_name) or str(col_name).lower() == "none":
-            return None
-        
-        col_name_lower = str(col_name).lower().strip()
+    with stage("column_mapping") as mapping:
+        # Process each dataframe
+        for idx, df in enumerate(all_dfs):
+            # Resolve the config's columns against this sheet's headers (cached per config
+            # version and header row; exact match first, then case-insensitive)
+            plan = get_column_plan(config_docs[idx], df.columns)
+            first_col = plan["First Name"]
+            last_col = plan["Last Name"]
+            id_col = plan["Member ID"]
+            gap_col = plan["Care Gap"]
+            dob_col = plan["DOB"]
+            doctor_col = plan["Doctor/Provider"]
+            insurance_col = plan["Insurance"]
+            check_insurance = masterCols["Insurance Provided"][idx]
+            note_col = plan["Notes"]
+            name_col = plan["Full Name"]
         
-        # Try exact match first
-        if col_name in df.columns:
-            return col_name
+            # Sheets without a care gap, member ID and DOB contribute nothing
+            if any(plan[field] is None for field in REQUIRED_FIELDS):
+                continue
         
-        # Try case-insensitive match
-        for col in df.columns:
-            if str(col).lower().strip() == col_name_lower:
-                return col
+            # Check for first/last or fullname
+            has_full_name = name_col is not None
         
-        return None
-
-    # Process each dataframe
-    for idx, df in enumerate(all_dfs):
-        # Extract column names from masterCols DataFrame (same as original)
-        first_col = find_column(df, masterCols["First Name"][idx])
-        last_col = find_column(df, masterCols["Last Name"][idx])
-        id_col = find_column(df, masterCols["Member ID"][idx])
-        gap_col = find_column(df, masterCols["Care Gap"][idx])
-        dob_col = find_column(df, masterCols["DOB"][idx])
-        doctor_col = find_column(df, masterCols["Doctor/Provider"][idx])
-        insurance_col = find_column(df, masterCols["Insurance"][idx])
-        check_insurance = masterCols["Insurance Provided"][idx]
-        note_col = find_column(df, masterCols["Notes"][idx])
-        name_col = find_column(df, masterCols["Full Name"][idx])
+            # Split full names vectorized, otherwise take the mapped columns as-is
+            if has_full_name:
+                name_parts = df[name_col].str.split(',')
+                first = as_names(name_parts.str[1].str.strip().str.split().str[0])
+                last = as_names(name_parts.str[0].str.strip())
+            else:
+                first = as_names(df[first_col]) if first_col is not None else constant("", df.index)
+                last = as_names(df[last_col]) if last_col is not None else constant("", df.index)
         
-        # Check for first/last or fullname
-        has_full_name = name_col is not None
+            # Handle insurance
+            if check_insurance == "No":
+                insurance = constant(masterCols["Insurance"][idx], df.index)
+            else:
+                insurance = as_category(df[insurance_col]) if insurance_col is not None else constant("N/A", df.index)
         
-        # Process all rows at once where possible
-        if has_full_name:
-            # Process full names
-            df_copy = df.copy()
-            df_copy['First'] = df_copy[name_col].str.split(',').str[1].str.strip().str.split().str[0]
-            df_copy['Last'] = df_copy[name_col].str.split(',').str[0].str.strip()
-        else:
-            df_copy = df.copy()
-            df_copy['First'] = df[first_col] if first_col is not None else ""
-            df_copy['Last'] = df[last_col] if last_col is not None else ""
-        
-        # Handle insurance
-        if check_insurance == "No":
-            df_copy['Insurance'] = masterCols["Insurance"][idx]
-        else:
-            df_copy['Insurance'] = df[insurance_col] if insurance_col is not None else "N/A"
+            # Handle doctor/provider and notes
+            doctor = as_category(df[doctor_col]) if doctor_col is not None else constant("N/A", df.index)
+            notes = as_category(df[note_col]) if note_col is not None else constant("N/A", df.index)
         
-        # Handle doctor/provider
-        df_copy['Doctor'] = df[doctor_col] if doctor_col is not None else "N/A"
+            # Derived columns shadow same-named sheet columns, as they did when written onto a copy
+            derived = {"First": first, "Last": last, "Insurance": insurance, "Doctor": doctor, "Notes": notes}
         
-        # Handle notes
-        df_copy['Notes'] = df[note_col] if note_col is not None else "N/A"
+            def source(col):
+                return derived[col] if col in derived else df[col]
         
-        # Check if care gap exists
-        if gap_col is not None and id_col is not None and dob_col is not None:
-            subset_df = pd.DataFrame({
-                "First Name": df_copy['First'],
-                "Last Name": df_copy['Last'],
-                "Member ID": df_copy[id_col].astype(str),
-                "Care Gap": df_copy[gap_col].astype(str),
-                "DOB": df_copy[dob_col],
-                "Insurance": df_copy['Insurance'],
-                "Doctor/Provider": df_copy['Doctor'],
-                "Notes": df_copy['Notes']
-            })
-            
-            # Concat to NEW data frame, not master
-            newDataFrame = pd.concat([newDataFrame, subset_df], ignore_index=True)
-    
-    # Remove nonmapped entries from NEW data only
-    def find_header(gap_name, df=gaps):
-        # Iterate through each column
-        gap_name = f"{gap_name}"
-
-        for col in df.columns:
-            # Check each value in the column
-            for value in df[col].dropna():
-                # If gap name is found
-                if gap_name.upper() == str(value).upper():
-                    return col
-        return "X"
-    
-    def reduce(id):
-        id = f"{id}"
-        return id[0:6]
-    
-    # Process new data
-    care_gaps = newDataFrame['Care Gap'].unique()
-    header_mapping = {gap: find_header(gap) for gap in care_gaps}
-
-    newDataFrame['Care Gap'] = newDataFrame['Care Gap'].map(header_mapping)
-    newDataFrame = newDataFrame[newDataFrame['Care Gap'] != "X"]
-    newDataFrame.loc[:, 'Member ID'] = newDataFrame['Member ID'].apply(lambda x: reduce(x))
+            subset_frames.append(pd.DataFrame({
+                "First Name": first,
+                "Last Name": last,
+                "Member ID": as_text(source(id_col)),
+                "Care Gap": as_text(source(gap_col)),
+                "DOB": source(dob_col),
+                "Insurance": insurance,
+                "Doctor/Provider": doctor,
+                "Notes": notes
+            }))
+            report(sheets_merged=idx + 1)
+    
+        # Single concat of all new data (not master)
+        newDataFrame = concat_frames(subset_frames, cols) if subset_frames else pd.DataFrame(columns=cols)
+        del subset_frames
+        mapping["rows"] = len(newDataFrame)
+    
+    # Remove nonmapped entries from NEW data only (single lookup per row)
+    with stage("gap_mapping", rows=len(newDataFrame)):
+        newDataFrame['Care Gap'] = map_values(newDataFrame['Care Gap'], lambda gap: gap_lookup.get(gap.upper()))
+        newDataFrame['Member ID'] = map_values(newDataFrame['Member ID'], lambda member_id: member_id[:6])
+        newDataFrame = newDataFrame[newDataFrame['Care Gap'].notna()]
     
     # Remove duplicates within new data
-    newDataFrame = newDataFrame.drop_duplicates(subset=['Care Gap', 'First Name', 'Member ID', 'Last Name'], keep='first')
-    newDataFrame = newDataFrame.drop_duplicates(subset=['Care Gap', 'First Name', 'DOB', 'Last Name'], keep='first')
+    if dedup:
+        with stage("dedup", rows=len(newDataFrame)):
+            newDataFrame, removed = dedup_new_rows(newDataFrame)
+        report(**removed)
+    
+    return newDataFrame
 
-    print(f"New data after deduplication: {len(newDataFrame)} rows")
+def build_merged_frame(master_file, care_gap_files_with_configs: List[Tuple], db, enable_to_be_removed: bool,
+                       progress: Optional[Callable] = None, parse_workers: Optional[int] = None,
+                       fuzzy: Optional[FuzzyOptions] = None, review: Optional[Callable] = None,
+                       gaps_version: Optional[int] = None) -> pd.DataFrame:
+    """
+    Merge multiple care gap sheets into the master sheet.
+    
+    Args:
+        master_file: The master Excel file (file object or path)
+        care_gap_files_with_configs: List of tuples [(file, config_id), (file, config_id), ...]
+        db: MongoDB database connection to fetch configs
+        enable_to_be_removed: Boolean flag to enable "to be removed" logic
+        progress: Optional callback taking keyword counters (rows_read, sheets_read, sheets_merged,
+                  rows removed per dedup rule, ...)
+        parse_workers: Processes for parsing the uploads (defaults to PARSE_WORKERS; 1 is serial)
+        fuzzy: Also remove near-duplicate new rows with these thresholds (see fuzzy_dedup);
+               None keeps the exact dedup only
+        review: Optional callback given the fuzzy stage's review sheet (the merged pairs)
+        gaps_version: Gaps file version to map gaps with; None uses the active one. The
+                      version used is reported as the gaps_version counter
+    
+    Returns:
+        pd.DataFrame: The merged sheet (write it out with writers.write_table / spool_table)
+    """
+    from cache import get_gaps, get_insurance_configs
+    
+    def report(**counters):
+        if progress is not None:
+            progress(**counters)
+    
+    with stage("config_fetch"):
+        # Fetch the compiled gaps lookup (cached per gaps version)
+        gaps = get_gaps(db, gaps_version)
+        if gaps is None:
+            raise Exception("Gaps file not found in database. Please upload it in Settings.")
+        gaps_version, gap_lookup = gaps
+        report(gaps_version=gaps_version)
+        
+        # Fetch all configs in one cached, batched lookup
+        configs_by_id = get_insurance_configs(db, [config_id for _, config_id in care_gap_files_with_configs])
+    
+    cols = MASTER_COLUMNS
+    
+    # Only read the columns the merge can use: the output columns from master, the
+    # config-mapped ones from each sheet. A missing config shifts which config each
+    # sheet is matched with below, so prune nothing in that case.
+    configs = [configs_by_id.get(str(config_id)) for _, config_id in care_gap_files_with_configs]
+    if all(configs):
+        sheet_columns = [[config['fields'].get(field) for field in MAPPED_FIELDS] for config in configs]
+        columns = [cols + ['To be removed']] + sheet_columns
+    else:
+        columns = None
+    
+    # Read master file and all care gap sheets (Excel or CSV), in parallel if configured
+    parsed = read_uploads([master_file] + [file for file, _ in care_gap_files_with_configs], parse_workers, columns)
+    master = parsed[0]
+    report(rows_read=len(master), sheets_total=len(care_gap_files_with_configs))
+    
+    # Handle "To be removed" logic if enabled
+    if enable_to_be_removed and 'To be removed' in master.columns:
+        mask = master["To be removed"].astype(str).str.contains("y", case=False, na=False)
+        master = master.loc[~mask].copy()
+        master = master.drop(columns=['To be removed'])
+    
+    # If master has the right columns, use it; otherwise start fresh
+    if all(col in master.columns for col in cols):
+        masterFrame = master[cols].copy()
+        print(f"Starting with {len(masterFrame)} rows from master file")
+    else:
+        masterFrame = pd.DataFrame(columns=cols)
+        print("Master file doesn't have expected columns, starting fresh")
+    
+    newDataFrame = build_new_rows(parsed[1:], care_gap_files_with_configs, configs_by_id, gap_lookup, report,
+                                  rows_read=len(master), dedup=False)
+    del parsed
     
-    # Append new data to master, keeping master's existing rows
-    masterFrame = pd.concat([masterFrame, newDataFrame], ignore_index=True)
+    # Append new data to master, keeping master's existing rows, with disjoint
+    # deduplication (DOB and Member ID) within the new data and against master
+    with stage("dedup", rows=len(masterFrame) + len(newDataFrame)):
+        masterFrame, removed, master_rows = dedup_merge(masterFrame, newDataFrame)
+    del newDataFrame
+    print("Duplicates removed: " + ", ".join(f"{name} {count}" for name, count in removed.items()))
+    report(**removed)
     
-    # Use disjoint deduplication - DOB and Member ID
-    masterFrame = masterFrame.drop_duplicates(subset=['Care Gap', 'First Name', 'Member ID', 'Last Name'], keep='first')
-    masterFrame = masterFrame.drop_duplicates(subset=['Care Gap', 'First Name', 'DOB', 'Last Name'], keep='first')
+    # Near-duplicates of the rows kept so far (new rows only; master rows stay)
+    if fuzzy is not None:
+        with stage("fuzzy_dedup", rows=len(masterFrame)):
+            masterFrame, review_sheet, fuzzy_removed = fuzzy_dedup(masterFrame, master_rows, fuzzy)
+        print("Fuzzy duplicates removed: " + ", ".join(f"{name} {count}" for name, count in fuzzy_removed.items()))
+        report(**fuzzy_removed)
+        if review is not None:
+            review(review_sheet)
 
     # Add "To be removed" column back
     if enable_to_be_removed:
@@ -193,9 +440,100 @@ def merge_care_gap_sheets(master_file, care_gap_files_with_configs: List[Tuple],
 
     print(f"Final merged data: {len(masterFrame)} rows (added {len(masterFrame) - len(master) if len(master) > 0 else len(masterFrame)} new rows)")
 
-    # Return as bytes for download
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        masterFrame.to_excel(writer, index=False, sheet_name='Merged Care Gaps')
-    output.seek(0)
-    return output.read()
+    report(rows_merged=len(masterFrame))
+    return masterFrame
+
+def merge_care_gap_sheets(master_file, care_gap_files_with_configs: List[Tuple], db, enable_to_be_removed: bool,
+                          progress: Optional[Callable] = None, parse_workers: Optional[int] = None,
+                          fuzzy: Optional[FuzzyOptions] = None, gaps_version: Optional[int] = None) -> bytes:
+    """
+    Merge care gap sheets into the master sheet and return the workbook as bytes.
+    
+    Routes and jobs write build_merged_frame's result to a file instead, which keeps a
+    single copy of the output out of memory; this is for callers that need the bytes.
+    With fuzzy, the workbook gets a second sheet reviewing the near-duplicates removed.
+    """
+    review_sheets = {}
+    masterFrame = build_merged_frame(master_file, care_gap_files_with_configs, db, enable_to_be_removed,
+                                     progress=progress, parse_workers=parse_workers, fuzzy=fuzzy,
+                                     review=lambda sheet: review_sheets.update({REVIEW_SHEET_NAME: sheet}),
+                                     gaps_version=gaps_version)
+    path = spool_table(masterFrame, "xlsx", sheet_name=MERGED_SHEET_NAME, extra_sheets=review_sheets)
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        os.unlink(path)
+
+def append_to_master_store(store, care_gap_files_with_configs: List[Tuple], db,
+                           progress: Optional[Callable] = None, parse_workers: Optional[int] = None,
+                           gaps_version: Optional[int] = None) -> Dict[str, int]:
+    """
+    Merge care gap sheets into the server-side master store instead of a master workbook.
+    
+    Only the payer sheets are parsed; their rows go through the same projection, gap
+    mapping and dedup as merge_care_gap_sheets, then the store inserts the ones whose
+    keys it hasn't seen, so the cost follows the incoming rows rather than the master.
+    
+    Args:
+        store: Master store (see master_store.get_master_store)
+        care_gap_files_with_configs: List of tuples [(file, config_id), ...]
+        db: MongoDB database connection to fetch configs
+        progress: Optional callback taking keyword counters
+        parse_workers: Processes for parsing the uploads (defaults to PARSE_WORKERS; 1 is serial)
+        gaps_version: Gaps file version to map gaps with; None uses the active one
+    
+    Returns:
+        dict: Counters from the store's append (received, inserted, duplicates per key rule, ...)
+    """
+    from cache import get_gaps, get_insurance_configs
+    
+    def report(**counters):
+        if progress is not None:
+            progress(**counters)
+    
+    with stage("config_fetch"):
+        gaps = get_gaps(db, gaps_version)
+        if gaps is None:
+            raise Exception("Gaps file not found in database. Please upload it in Settings.")
+        gaps_version, gap_lookup = gaps
+        report(gaps_version=gaps_version)
+        
+        configs_by_id = get_insurance_configs(db, [config_id for _, config_id in care_gap_files_with_configs])
+    configs = [configs_by_id.get(str(config_id)) for _, config_id in care_gap_files_with_configs]
+    columns = [[config['fields'].get(field) for field in MAPPED_FIELDS] for config in configs] if all(configs) else None
+    
+    parsed = read_uploads([file for file, _ in care_gap_files_with_configs], parse_workers, columns)
+    report(rows_read=0, sheets_total=len(care_gap_files_with_configs))
+    newDataFrame = build_new_rows(parsed, care_gap_files_with_configs, configs_by_id, gap_lookup, report)
+    del parsed
+    
+    with stage("store_write", rows=len(newDataFrame)):
+        stats = store.append(newDataFrame)
+    print(f"Master store: {stats['inserted']} of {stats['received']} new rows inserted ({stats['row_count']} total)")
+    report(rows_merged=stats['row_count'])
+    return stats
+
+def import_master_workbook(store, master_file, enable_to_be_removed: bool) -> Dict[str, int]:
+    """
+    Seed (or reset) the master store from a master workbook.
+    
+    The workbook goes through the same "To be removed" handling and dedup as the master
+    side of merge_care_gap_sheets; later merges only need the payer sheets.
+    
+    Returns:
+        dict: Counters from the store's replace (received, inserted, duplicates per key rule, row_count)
+    """
+    cols = MASTER_COLUMNS
+    master = read_uploads([master_file], columns=[cols + ['To be removed']])[0]
+    
+    if enable_to_be_removed and 'To be removed' in master.columns:
+        mask = master["To be removed"].astype(str).str.contains("y", case=False, na=False)
+        master = master.loc[~mask]
+    
+    if not all(col in master.columns for col in cols):
+        raise Exception("Master file doesn't have the expected columns.")
+    
+    stats = store.replace(master[cols])
+    print(f"Master store: imported {stats['inserted']} of {stats['received']} master rows")
+    return stats
@@ -0,0 +1,348 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional
+
+# Per-stage instrumentation of the merge and sort pipelines.
+#
+# Code marks its stages with `with stage("parse") as s: ...` (setting s["rows"] when it
+# knows a row count). Inside a request trace (see trace / Trace) each stage's wall time,
+# CPU time of the calling thread, peak RSS while it ran and rows are added up per request,
+# logged as one JSON line when the request finishes, and folded into per-stage
+# histograms. /api/metrics renders those in Prometheus text format.
+#
+# Aggregates are per worker process and reset when gunicorn recycles a worker
+# (max_requests); Prometheus treats that as a counter reset.
+
+# Print one JSON line per traced request
+METRICS_LOG = os.getenv("METRICS_LOG", "true").lower() == "true"
+
+# Histogram bucket upper bounds, in seconds (the request timeout is 300s)
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# How often VmRSS is sampled while stages run, where the kernel's high-water mark can't be reset
+METRICS_RSS_SAMPLE_SECONDS = float(os.getenv("METRICS_RSS_SAMPLE_SECONDS", "0.05"))
+
+_lock = threading.Lock()
+_current: ContextVar[Optional["Trace"]] = ContextVar("metrics_trace", default=None)
+
+class Histogram:
+    def __init__(self, buckets=SECONDS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for n, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[n] += 1
+        self.sum += value
+        self.count += 1
+
+# (pipeline, stage) -> aggregates
+_stage_seconds: Dict[tuple, Histogram] = {}
+_stage_cpu: Dict[tuple, float] = {}
+_stage_rows: Dict[tuple, int] = {}
+_stage_peak_rss: Dict[tuple, int] = {}
+# pipeline -> request duration histogram; (pipeline, status) -> count
+_request_seconds: Dict[str, Histogram] = {}
+_requests: Dict[tuple, int] = {}
+
+# A stage's peak RSS is the most memory the process held while that stage was open, not
+# the lifetime high-water mark (ru_maxrss), which would repeat the first large stage's
+# figure for every later stage and request. On Linux the kernel's high-water mark (VmHWM)
+# is reset at each stage entry by writing "5" to /proc/self/clear_refs and read back at
+# exit; where that isn't permitted, a thread samples VmRSS while any stage is open.
+# Memory is per process, so every stage open at the time (nested stages, stages on other
+# threads) is credited with what is read, and the mark is read before each reset so an
+# outer stage keeps the peak it reached before an inner one started.
+
+class _StagePeak:
+    __slots__ = ("bytes",)
+
+    def __init__(self, value: int):
+        self.bytes = value
+
+_peak_lock = threading.Lock()
+_open_peaks: List[_StagePeak] = []
+_process_peak = 0  # highest mark read before a reset dropped it
+_clear_refs: Optional[bool] = None  # whether resetting VmHWM works here (None: not tried yet)
+_sampler: Optional[threading.Thread] = None
+
+def _status_bytes(field: str) -> Optional[int]:
+    """A memory field of /proc/self/status in bytes, or None without procfs"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def _reset_hwm() -> bool:
+    global _clear_refs
+    if _clear_refs is False:
+        return False
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        _clear_refs = True
+    except OSError:
+        _clear_refs = False
+    return _clear_refs
+
+def _fold(value: Optional[int]):
+    """Credit a reading to every open stage (call with _peak_lock held)"""
+    global _process_peak
+    if value is None:
+        return
+    _process_peak = max(_process_peak, value)
+    for peak in _open_peaks:
+        peak.bytes = max(peak.bytes, value)
+
+def _sample_rss():
+    global _sampler
+    while True:
+        with _peak_lock:
+            if not _open_peaks:
+                _sampler = None
+                return
+            _fold(_status_bytes("VmRSS"))
+        time.sleep(METRICS_RSS_SAMPLE_SECONDS)
+
+def _open_peak() -> _StagePeak:
+    global _sampler
+    with _peak_lock:
+        _fold(_status_bytes("VmHWM"))
+        peak = _StagePeak(_status_bytes("VmRSS") or 0)
+        _open_peaks.append(peak)
+        if not _reset_hwm() and peak.bytes and (_sampler is None or not _sampler.is_alive()):
+            _sampler = threading.Thread(target=_sample_rss, name="rss-sampler", daemon=True)
+            _sampler.start()
+    return peak
+
+def _close_peak(peak: _StagePeak) -> int:
+    """The stage's peak RSS in bytes (the process high-water mark without procfs)"""
+    with _peak_lock:
+        _fold(_status_bytes("VmHWM" if _clear_refs else "VmRSS"))
+        _open_peaks.remove(peak)
+    return peak.bytes or peak_rss_bytes()
+
+def peak_rss_bytes() -> int:
+    """High-water mark of this process's resident memory since it started"""
+    scale = 1 if sys.platform == "darwin" else 1024  # bytes on macOS, KiB on Linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, _process_peak, _status_bytes("VmHWM") or 0)
+
+def _observe_stage(pipeline: str, name: str, totals: Dict):
+    key = (pipeline, name)
+    with _lock:
+        _stage_seconds.setdefault(key, Histogram()).observe(totals["wall_seconds"])
+        _stage_cpu[key] = _stage_cpu.get(key, 0.0) + totals["cpu_seconds"]
+        _stage_rows[key] = _stage_rows.get(key, 0) + (totals["rows"] or 0)
+        _stage_peak_rss[key] = max(_stage_peak_rss.get(key, 0), totals["peak_rss_bytes"])
+
+class Trace:
+    """Stage timings for one request (or job) through a pipeline"""
+
+    def __init__(self, pipeline: str, **fields):
+        self.pipeline = pipeline
+        self.fields = fields
+        self.stages: Dict[str, Dict] = {}
+        self.started = time.perf_counter()
+        self.cpu_started = time.thread_time()
+        self.finished = False
+
+    def add(self, name: str, wall: float, cpu: float, rows: Optional[int], peak_rss: int):
+        totals = self.stages.setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "rows": None, "peak_rss_bytes": 0, "calls": 0})
+        totals["wall_seconds"] += wall
+        totals["cpu_seconds"] += cpu
+        if rows is not None:
+            totals["rows"] = (totals["rows"] or 0) + rows
+        totals["peak_rss_bytes"] = max(totals["peak_rss_bytes"], peak_rss)
+        totals["calls"] += 1
+
+    def finish(self, status: str = "ok"):
+        """Fold the request's stages into the aggregates and log them (once)"""
+        if self.finished:
+            return
+        self.finished = True
+        elapsed = time.perf_counter() - self.started
+
+        for name, totals in self.stages.items():
+            _observe_stage(self.pipeline, name, totals)
+        with _lock:
+            _request_seconds.setdefault(self.pipeline, Histogram()).observe(elapsed)
+            _requests[(self.pipeline, status)] = _requests.get((self.pipeline, status), 0) + 1
+
+        if METRICS_LOG:
+            record = {
+                "event": "pipeline_metrics",
+                "pipeline": self.pipeline,
+                "status": status,
+                "wall_seconds": round(elapsed, 4),
+                "cpu_seconds": round(time.thread_time() - self.cpu_started, 4),
+                "peak_rss_mb": round(max((totals["peak_rss_bytes"] for totals in self.stages.values()), default=0) / 2**20, 1),
+                **self.fields,
+                "stages": {
+                    name: {
+                        "wall_seconds": round(totals["wall_seconds"], 4),
+                        "cpu_seconds": round(totals["cpu_seconds"], 4),
+                        "rows": totals["rows"],
+                        "peak_rss_mb": round(totals["peak_rss_bytes"] / 2**20, 1),
+                        "calls": totals["calls"],
+                    }
+                    for name, totals in self.stages.items()
+                },
+            }
+            print(json.dumps(record), flush=True)
+
+@contextmanager
+def trace(pipeline: str, **fields):
+    """Trace the stages run inside the block as one request"""
+    current = Trace(pipeline, **fields)
+    token = _current.set(current)
+    status = "error"
+    try:
+        yield current
+        status = "ok"
+    finally:
+        _current.reset(token)
+        current.finish(status)
+
+@contextmanager
+def use_trace(current: Trace):
+    """Make an existing trace current for the block without finishing it"""
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+
+def traced_chunks(current: Trace, chunks: Iterable[bytes]):
+    """
+    Run a streamed response's generator under a trace, finishing the trace when the
+    stream ends (or the client goes away).
+    """
+    status = "error"
+    iterator = iter(chunks)
+    try:
+        while True:
+            token = _current.set(current)
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                status = "ok"
+                return
+            finally:
+                _current.reset(token)
+            yield chunk
+    finally:
+        # Let stages still open in the generator close under the trace
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            token = _current.set(current)
+            try:
+                close()
+            finally:
+                _current.reset(token)
+        current.finish(status)
+
+def annotate(**fields):
+    """Add fields to the current trace's log line (no-op outside a trace)"""
+    current = _current.get()
+    if current is not None:
+        current.fields.update(fields)
+
+@contextmanager
+def stage(name: str, rows: Optional[int] = None):
+    """
+    Time a pipeline stage. Yields a dict; set its "rows" once the count is known.
+
+    Stages run outside a trace go straight into the aggregates under pipeline "other".
+    """
+    info = {"rows": rows}
+    peak = _open_peak()
+    started = time.perf_counter()
+    cpu_started = time.thread_time()
+    try:
+        yield info
+    finally:
+        wall = time.perf_counter() - started
+        cpu = time.thread_time() - cpu_started
+        peak_rss = _close_peak(peak)
+        current = _current.get()
+        if current is not None:
+            current.add(name, wall, cpu, info["rows"], peak_rss)
+        else:
+            _observe_stage("other", name, {"wall_seconds": wall, "cpu_seconds": cpu, "rows": info["rows"], "peak_rss_bytes": peak_rss})
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+def _histogram_lines(metric: str, histogram: Histogram, **labels) -> list:
+    lines = []
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        lines.append(f"{metric}_bucket{_labels(**labels, le=bound)} {count}")
+    lines.append(f"{metric}_bucket{_labels(**labels, le='+Inf')} {histogram.count}")
+    lines.append(f"{metric}_sum{_labels(**labels)} {histogram.sum:.6f}")
+    lines.append(f"{metric}_count{_labels(**labels)} {histogram.count}")
+    return lines
+
+def render_prometheus() -> str:
+    """All aggregates in Prometheus text exposition format"""
+    with _lock:
+        lines = [
+            "# HELP care_gaps_stage_seconds Wall time per pipeline stage and request",
+            "# TYPE care_gaps_stage_seconds histogram",
+        ]
+        for (pipeline, name), histogram in sorted(_stage_seconds.items()):
+            lines += _histogram_lines("care_gaps_stage_seconds", histogram, pipeline=pipeline, stage=name)
+
+        lines += [
+            "# HELP care_gaps_stage_cpu_seconds_total CPU time spent in each pipeline stage (calling thread)",
+            "# TYPE care_gaps_stage_cpu_seconds_total counter",
+        ]
+        for (pipeline, name), value in sorted(_stage_cpu.items()):
+            lines.append(f"care_gaps_stage_cpu_seconds_total{_labels(pipeline=pipeline, stage=name)} {value:.6f}")
+
+        lines += [
+            "# HELP care_gaps_stage_rows_total Rows processed by each pipeline stage",
+            "# TYPE care_gaps_stage_rows_total counter",
+        ]
+        for (pipeline, name), value in sorted(_stage_rows.items()):
+            lines.append(f"care_gaps_stage_rows_total{_labels(pipeline=pipeline, stage=name)} {value}")
+
+        lines += [
+            "# HELP care_gaps_stage_peak_rss_bytes Highest resident memory reached while each stage was running",
+            "# TYPE care_gaps_stage_peak_rss_bytes gauge",
+        ]
+        for (pipeline, name), value in sorted(_stage_peak_rss.items()):
+            lines.append(f"care_gaps_stage_peak_rss_bytes{_labels(pipeline=pipeline, stage=name)} {value}")
+
+        lines += [
+            "# HELP care_gaps_request_seconds Wall time per traced request",
+            "# TYPE care_gaps_request_seconds histogram",
+        ]
+        for pipeline, histogram in sorted(_request_seconds.items()):
+            lines += _histogram_lines("care_gaps_request_seconds", histogram, pipeline=pipeline)
+
+        lines += [
+            "# HELP care_gaps_requests_total Traced requests by outcome",
+            "# TYPE care_gaps_requests_total counter",
+        ]
+        for (pipeline, status), count in sorted(_requests.items()):
+            lines.append(f"care_gaps_requests_total{_labels(pipeline=pipeline, status=status)} {count}")
+
+    lines += [
+        "# HELP care_gaps_process_peak_rss_bytes Peak resident memory of this worker process",
+        "# TYPE care_gaps_process_peak_rss_bytes gauge",
+        f"care_gaps_process_peak_rss_bytes {peak_rss_bytes()}",
+    ]
+    return "\n".join(lines) + "\n"
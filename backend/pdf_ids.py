@@ -0,0 +1,272 @@
+import hashlib
+import itertools
+import os
+import queue
+import re
+import signal
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import Dict, List, Optional
+
+# Member ID extraction from PDF contents, for PDFs whose filename doesn't lead to a
+# master row.
+#
+# The first pages' text is extracted with PyPDF2 in a process pool (one process per
+# core by default), each file under its own time limit so a malformed PDF can't stall
+# the batch. Results are cached by content hash, so a PDF uploaded again isn't parsed
+# a second time; timeouts and failures aren't cached, so a PDF that failed while the box
+# was busy is tried again on its next upload. Workers report when they start a file, so
+# a file's deadline runs from its own start rather than from when it was queued. A worker
+# still busy past its deadline is killed; the pool it broke (or one whose worker died,
+# e.g. killed for memory) is replaced and the files it lost are retried once on the new
+# pool.
+
+# Processes used for text extraction (defaults to one per core)
+PDF_TEXT_WORKERS = int(os.getenv("PDF_TEXT_WORKERS", "0")) or os.cpu_count() or 1
+# Seconds allowed to extract one PDF's text
+PDF_TEXT_TIMEOUT = int(os.getenv("PDF_TEXT_TIMEOUT", "10"))
+# Pages read from the start of each PDF
+PDF_TEXT_PAGES = int(os.getenv("PDF_TEXT_PAGES", "2"))
+# Content hashes whose extracted tokens are kept
+PDF_TEXT_CACHE_SIZE = int(os.getenv("PDF_TEXT_CACHE_SIZE", "10000"))
+
+# Shortest token considered as a member ID
+MIN_ID_LENGTH = 4
+_TOKEN = re.compile(r"[A-Za-z0-9][A-Za-z0-9-]*")
+
+_lock = threading.Lock()
+_cache: "OrderedDict[str, List[str]]" = OrderedDict()
+_stats = {"pdf_text_hits": 0, "pdf_text_misses": 0, "pdf_text_timeouts": 0, "pdf_text_errors": 0, "pdf_text_pool_restarts": 0}
+
+_pool = None
+# Queue the pool's workers report started files on (in a worker: the one it writes to)
+_pool_starts = None
+# Task token -> (worker pid, wall-clock start), collected from the workers' reports
+_started: Dict[int, tuple] = {}
+_tokens = itertools.count()
+# How often a wait wakes up to check started files against their deadlines
+_POLL_SECONDS = 0.5
+
+class _ExtractionTimeout(Exception):
+    pass
+
+def _on_alarm(signum, frame):
+    raise _ExtractionTimeout()
+
+def extract_tokens(data: Optional[bytes] = None, path: Optional[str] = None,
+                   pages: int = PDF_TEXT_PAGES, timeout: int = PDF_TEXT_TIMEOUT) -> Optional[List[str]]:
+    """
+    Candidate member IDs (normalized, in reading order) from a PDF's first pages.
+
+    Runs in a pool process. The time limit is enforced with SIGALRM where available.
+
+    Returns:
+        list or None: Tokens, or None if the PDF timed out
+    """
+    from PyPDF2 import PdfReader
+
+    use_alarm = hasattr(signal, "SIGALRM") and threading.current_thread() is threading.main_thread()
+    if use_alarm:
+        previous = signal.signal(signal.SIGALRM, _on_alarm)
+        signal.alarm(timeout)
+    try:
+        reader = PdfReader(path if path is not None else BytesIO(data))
+        text = " ".join(page.extract_text() or "" for page in reader.pages[:pages])
+    except _ExtractionTimeout:
+        return None
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, previous)
+
+    tokens = []
+    seen = set()
+    for token in _TOKEN.findall(text):
+        token = token.lower()
+        if len(token) >= MIN_ID_LENGTH and token not in seen:
+            seen.add(token)
+            tokens.append(token)
+    return tokens
+
+def _init_worker(starts):
+    global _pool_starts
+    _pool_starts = starts
+
+def _extract_reported(token: int, data: Optional[bytes] = None, path: Optional[str] = None) -> Optional[List[str]]:
+    """extract_tokens, after telling the parent which worker started the file and when"""
+    _pool_starts.put((token, os.getpid(), time.time()))
+    return extract_tokens(data, path=path)
+
+def _get_pool():
+    """
+    Process pool shared across sorts, created on first use.
+
+    Returns:
+        tuple: (pool, queue its workers report started files on)
+    """
+    global _pool, _pool_starts
+    with _lock:
+        if _pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # forkserver children don't inherit the web worker's threads or Mongo sockets
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            _pool_starts = context.Queue()
+            _pool = ProcessPoolExecutor(max_workers=PDF_TEXT_WORKERS, mp_context=context,
+                                        initializer=_init_worker, initargs=(_pool_starts,))
+        return _pool, _pool_starts
+
+def _discard_pool(pool):
+    """Drop a broken pool so the next _get_pool creates a new one"""
+    global _pool
+    with _lock:
+        if _pool is pool:
+            _pool = None
+        _stats["pdf_text_pool_restarts"] += 1
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _collect_starts(starts):
+    """Move the workers' start reports into _started (any thread may collect another's)"""
+    while True:
+        try:
+            token, pid, started = starts.get_nowait()
+        except queue.Empty:
+            return
+        with _lock:
+            _started[token] = (pid, started)
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def _cached(digest: str) -> Optional[List[str]]:
+    with _lock:
+        tokens = _cache.get(digest)
+        if tokens is not None:
+            _cache.move_to_end(digest)
+            _stats["pdf_text_hits"] += 1
+        else:
+            _stats["pdf_text_misses"] += 1
+        return tokens
+
+def _remember(digest: str, tokens: List[str]):
+    with _lock:
+        _cache[digest] = tokens
+        _cache.move_to_end(digest)
+        while len(_cache) > PDF_TEXT_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def extract_tokens_many(sources: List[Dict]) -> List[List[str]]:
+    """
+    Extract candidate member IDs from several PDFs in parallel.
+
+    Args:
+        sources: One dict per PDF with its content under "data" (bytes, or any bytes-like
+                 view when "path" is given: the file is on disk and workers read it themselves)
+
+    Returns:
+        list: Tokens per PDF, in the same order (empty for unreadable or timed-out PDFs)
+    """
+    results: List[Optional[List[str]]] = [None] * len(sources)
+    digests = [content_hash(source["data"]) for source in sources]
+    pending = []
+    for position, digest in enumerate(digests):
+        tokens = _cached(digest)
+        if tokens is not None:
+            results[position] = tokens
+        else:
+            pending.append(position)
+
+    # A second pass retries the files lost when a worker died
+    for _ in range(2):
+        if not pending:
+            break
+        pool, starts = _get_pool()
+        futures = {}
+        lost = []
+        broken = stuck = False
+        for position in pending:
+            source = sources[position]
+            token = next(_tokens)
+            try:
+                if source.get("path") is not None:
+                    future = pool.submit(_extract_reported, token, path=source["path"])
+                else:
+                    future = pool.submit(_extract_reported, token, source["data"])
+            except BrokenProcessPool:
+                broken = True
+                lost.append(position)
+                continue
+            futures[future] = (position, token)
+
+        running = set(futures)
+        while running:
+            done, running = wait(running, timeout=_POLL_SECONDS, return_when=FIRST_COMPLETED)
+            for future in done:
+                position, token = futures[future]
+                tokens = None
+                try:
+                    tokens = future.result()
+                    if tokens is None:
+                        with _lock:
+                            _stats["pdf_text_timeouts"] += 1
+                except BrokenProcessPool:
+                    broken = True
+                    lost.append(position)
+                    continue
+                except Exception as e:
+                    print(f"Could not read text from PDF: {e}")
+                    with _lock:
+                        _stats["pdf_text_errors"] += 1
+                results[position] = tokens or []
+                # Only successful extractions are cached; failures get another try next upload
+                if tokens is not None:
+                    _remember(digests[position], tokens)
+
+            # Backstop in case the alarm can't interrupt a worker: a file still running
+            # well past its own start is given up on and its worker killed. That breaks
+            # the pool, and the files sharing it come back as lost
+            _collect_starts(starts)
+            now = time.time()
+            for future in list(running):
+                position, token = futures[future]
+                with _lock:
+                    pid, started = _started.get(token, (None, None))
+                if started is None or now - started < PDF_TEXT_TIMEOUT * 2:
+                    continue
+                stuck = True
+                running.discard(future)
+                results[position] = []
+                with _lock:
+                    _stats["pdf_text_timeouts"] += 1
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+        with _lock:
+            for position, token in futures.values():
+                _started.pop(token, None)
+        if broken or stuck:
+            print(f"PDF text pool {'has a stuck worker' if stuck else 'lost a worker'}; replacing it")
+            _discard_pool(pool)
+        pending = lost
+
+    for position in pending:
+        print("Could not read text from PDF: the extraction process died twice")
+        with _lock:
+            _stats["pdf_text_errors"] += 1
+        results[position] = []
+
+    return results
+
+def pdf_text_stats() -> Dict[str, int]:
+    """Hit/miss/timeout counters since the process started"""
+    with _lock:
+        stats = dict(_stats)
+        stats["pdf_text_cached"] = len(_cache)
+    return stats
@@ -0,0 +1,102 @@
+import hashlib
+import os
+from typing import Callable, Dict, Iterable, List, Optional
+import pandas as pd
+
+# Shared reader layer for uploaded Excel/CSV files.
+#
+# Picks the fastest Excel engine installed (calamine, via the optional python-calamine
+# package, parses several times faster than openpyxl) and pushes column pruning down to
+# the parser so unused columns never become DataFrame columns.
+
+# Set READER_ENGINE to force an engine (e.g. "openpyxl") instead of auto-detecting
+READER_ENGINE = os.getenv("READER_ENGINE", "").strip().lower()
+
+_engine = ""
+
+def excel_engine() -> Optional[str]:
+    """
+    Fastest available Excel engine, detected once per process.
+
+    Returns None without calamine, letting pandas pick by extension (openpyxl for .xlsx,
+    xlrd for .xls) as before.
+    """
+    global _engine
+    if _engine == "":
+        if READER_ENGINE:
+            _engine = READER_ENGINE
+        else:
+            try:
+                import python_calamine  # noqa: F401
+                _engine = "calamine"
+            except ImportError:
+                _engine = None
+    return _engine
+
+def normalize_header(name) -> str:
+    """Header normalization used for case-insensitive column matching"""
+    return str(name).lower().strip()
+
+def is_unmapped(name) -> bool:
+    """Config fields left blank or set to "none" don't map to any column"""
+    return name is None or pd.isna(name) or normalize_header(name) == "none"
+
+def column_selector(names: Iterable) -> Optional[Callable]:
+    """
+    Build a usecols callable keeping every column whose header matches one of names
+    case-insensitively (the same rule resolve_column uses, so resolution on the
+    pruned frame picks the same column it would have on the full one).
+
+    Returns:
+        callable or None: None when no names are mapped (nothing could be resolved)
+    """
+    wanted = {normalize_header(name) for name in names if not is_unmapped(name)}
+    if not wanted:
+        return None
+    return lambda header: normalize_header(header) in wanted
+
+def header_signature(columns: Iterable) -> str:
+    """
+    Hash identifying a sheet's header row, for caching column plans. Taken over the
+    headers as read: normalization happens when resolving, and an exact-case match wins
+    over a case-insensitive one, so headers differing only in case get separate plans.
+    """
+    return hashlib.sha1("\x1f".join(str(col) for col in columns).encode()).hexdigest()
+
+def resolve_column(columns: List, name) -> Optional[str]:
+    """
+    The column a config field names: an exact match first, else the first header that
+    matches case-insensitively. None when the field is unmapped or no header matches.
+    """
+    if is_unmapped(name):
+        return None
+    if name in columns:
+        return name
+    wanted = normalize_header(name)
+    for col in columns:
+        if normalize_header(col) == wanted:
+            return col
+    return None
+
+def compile_column_plan(fields: Dict, columns: Iterable, field_names: Iterable[str]) -> Dict[str, Optional[str]]:
+    """Resolve every one of field_names through a config's fields against a header row"""
+    columns = list(columns)
+    return {field: resolve_column(columns, fields.get(field)) for field in field_names}
+
+def read_table(source, filename: str, usecols=None, dtype=None, nrows: Optional[int] = None):
+    """
+    Read an uploaded Excel/CSV file.
+
+    Args:
+        source: Path or binary file-like object
+        filename: Original upload name (the extension picks CSV vs Excel)
+        usecols: Optional column selector (see column_selector)
+        dtype: Optional dtype (or per-column dtypes) to parse with
+        nrows: Optional number of data rows to read (0 reads just the header row)
+
+    Returns:
+        pd.DataFrame
+    """
+    if filename.endswith('.csv'):
+        return pd.read_csv(source, usecols=usecols, dtype=dtype, nrows=nrows)
+    return pd.read_excel(source, engine=excel_engine(), usecols=usecols, dtype=dtype, nrows=nrows)
@@ -0,0 +1,248 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional, Tuple
+from cache import config_version, gaps_stamp, get_insurance_configs
+from gaps_store import get_gaps_meta
+from uploads import upload_view
+
+# Disk cache of finished merge and sort outputs, so resubmitting the same request
+# (e.g. after a browser timeout) returns the stored result instead of redoing the work.
+#
+# Keys are a hash of everything the output depends on: the content of every uploaded
+# file (and its name), the insurance config and gaps file versions, and the request's
+# flags. Entries live as files under RESULT_CACHE_DIR, shared by all worker processes;
+# each has a JSON sidecar with response metadata. Outputs contain PHI, so entries expire
+# RESULT_CACHE_TTL_SECONDS after they were written, and the least recently used ones are
+# evicted once the cache is over RESULT_CACHE_MAX_MB.
+
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "nch-results"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_MB", "1024")) * 2**20
+RESULT_CACHE_TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", str(60 * 60)))
+RESULT_CACHE_ENABLED = RESULT_CACHE_MAX_BYTES > 0 and RESULT_CACHE_TTL_SECONDS > 0
+
+_lock = threading.Lock()
+_stats = {"result_hits": 0, "result_misses": 0, "result_stores": 0, "result_evictions": 0}
+
+def hash_upload(file) -> str:
+    """sha256 of an upload's content (FileStorage, or a spooled upload with .path)"""
+    with upload_view(file) as view:
+        return hashlib.sha256(view).hexdigest()
+
+def _key(parts) -> str:
+    return hashlib.sha256(json.dumps(parts, default=str, sort_keys=True).encode()).hexdigest()
+
+def merge_key(db, master_file, care_gap_files_with_configs: List[Tuple], enable_to_be_removed: bool, fmt: str,
+              fuzzy: Optional[str] = None, gaps_version: Optional[int] = None) -> str:
+    """Cache key for a merge: uploads, config and gaps versions (the pinned one, else the active one), and flags"""
+    config_ids = [config_id for _, config_id in care_gap_files_with_configs]
+    configs = get_insurance_configs(db, config_ids)
+    meta = get_gaps_meta(db, gaps_version)
+    return _key({
+        "kind": "merge",
+        "master": [master_file.filename, hash_upload(master_file)],
+        "sheets": [[care_file.filename, hash_upload(care_file), config_id] for care_file, config_id in care_gap_files_with_configs],
+        "configs": {config_id: config_version(configs[config_id]) if config_id in configs else None for config_id in config_ids},
+        "gaps": gaps_stamp(meta) if meta else None,
+        "enable_to_be_removed": enable_to_be_removed,
+        "format": fmt,
+        "fuzzy": fuzzy,
+    })
+
+def sort_key(master_file, pdf_files, **flags) -> str:
+    """Cache key for a PDF sort: the master, every PDF (name and content), and flags"""
+    return _key({
+        "kind": "sort",
+        "master": [master_file.filename, hash_upload(master_file)],
+        "pdfs": [[pdf.filename, hash_upload(pdf)] for pdf in pdf_files],
+        "flags": flags,
+    })
+
+def _data_path(key: str) -> str:
+    return os.path.join(RESULT_CACHE_DIR, key + ".result")
+
+def _meta_path(key: str) -> str:
+    return os.path.join(RESULT_CACHE_DIR, key + ".json")
+
+def _remove(key: str):
+    for path in (_data_path(key), _meta_path(key)):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+def open_result(key: str) -> Optional[Tuple[object, Dict]]:
+    """
+    Open a cached result for reading.
+
+    Returns:
+        tuple or None: (open binary file, metadata dict), or None on a miss or expired entry
+    """
+    if not RESULT_CACHE_ENABLED:
+        return None
+    try:
+        f = open(_data_path(key), 'rb')
+    except FileNotFoundError:
+        with _lock:
+            _stats["result_misses"] += 1
+        return None
+
+    stat = os.fstat(f.fileno())
+    if stat.st_mtime < time.time() - RESULT_CACHE_TTL_SECONDS:
+        f.close()
+        _remove(key)
+        with _lock:
+            _stats["result_misses"] += 1
+            _stats["result_evictions"] += 1
+        return None
+
+    try:
+        with open(_meta_path(key)) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        meta = {}
+    # Access time marks recency for LRU eviction; mtime stays the write time for the TTL
+    try:
+        os.utime(_data_path(key), (time.time(), stat.st_mtime))
+    except OSError:
+        pass
+    with _lock:
+        _stats["result_hits"] += 1
+    return f, meta
+
+def copy_result(key: str, dest_path: str) -> Optional[Dict]:
+    """Copy a cached result to dest_path, returning its metadata (None on a miss)"""
+    cached = open_result(key)
+    if cached is None:
+        return None
+    f, meta = cached
+    with f, open(dest_path, 'wb') as dest:
+        shutil.copyfileobj(f, dest)
+    return meta
+
+def _tmp_path() -> str:
+    os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+    return os.path.join(RESULT_CACHE_DIR, f".tmp-{uuid.uuid4().hex}")
+
+def _commit(key: str, tmp_path: str, meta: Optional[Dict]):
+    """Move a fully written temp file into place; readers never see a partial entry"""
+    with open(_meta_path(key) + ".tmp", 'w') as f:
+        json.dump(meta or {}, f)
+    os.replace(_meta_path(key) + ".tmp", _meta_path(key))
+    os.replace(tmp_path, _data_path(key))
+    with _lock:
+        _stats["result_stores"] += 1
+    evict()
+
+def store_file(key: str, path: str, meta: Optional[Dict] = None):
+    """Store a copy of the result file at path (the original is left in place)"""
+    if not RESULT_CACHE_ENABLED or os.path.getsize(path) > RESULT_CACHE_MAX_BYTES:
+        return
+    tmp_path = _tmp_path()
+    try:
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            shutil.copyfile(path, tmp_path)
+        _commit(key, tmp_path, meta)
+    except OSError as e:
+        print(f"Could not cache result: {e}")
+        _discard(tmp_path)
+
+def store_bytes(key: str, data: bytes, meta: Optional[Dict] = None):
+    """Store an in-memory result"""
+    if not RESULT_CACHE_ENABLED or len(data) > RESULT_CACHE_MAX_BYTES:
+        return
+    tmp_path = _tmp_path()
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        _commit(key, tmp_path, meta)
+    except OSError as e:
+        print(f"Could not cache result: {e}")
+        _discard(tmp_path)
+
+def tee_chunks(key: str, chunks: Iterable[bytes], meta: Optional[Dict] = None):
+    """
+    Pass a streamed result through while writing it to the cache. The entry is only
+    stored if the stream runs to the end (not if the client disconnects part way).
+    """
+    if not RESULT_CACHE_ENABLED:
+        yield from chunks
+        return
+    tmp_path = _tmp_path()
+    complete = False
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        complete = True
+    finally:
+        if complete and os.path.getsize(tmp_path) <= RESULT_CACHE_MAX_BYTES:
+            try:
+                _commit(key, tmp_path, meta)
+            except OSError as e:
+                print(f"Could not cache result: {e}")
+                _discard(tmp_path)
+        else:
+            _discard(tmp_path)
+
+def _discard(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def _entries() -> List[Tuple[str, os.stat_result]]:
+    entries = []
+    try:
+        names = os.listdir(RESULT_CACHE_DIR)
+    except FileNotFoundError:
+        return entries
+    for name in names:
+        if not name.endswith(".result"):
+            continue
+        try:
+            entries.append((name[:-len(".result")], os.stat(os.path.join(RESULT_CACHE_DIR, name))))
+        except FileNotFoundError:
+            pass
+    return entries
+
+def evict():
+    """Drop expired entries, then least recently used ones until the cache fits its size limit"""
+    cutoff = time.time() - RESULT_CACHE_TTL_SECONDS
+    live = []
+    evicted = 0
+    for key, stat in _entries():
+        if stat.st_mtime < cutoff:
+            _remove(key)
+            evicted += 1
+        else:
+            live.append((key, stat))
+
+    total = sum(stat.st_size for _, stat in live)
+    for key, stat in sorted(live, key=lambda entry: entry[1].st_atime):
+        if total <= RESULT_CACHE_MAX_BYTES:
+            break
+        _remove(key)
+        total -= stat.st_size
+        evicted += 1
+
+    if evicted:
+        with _lock:
+            _stats["result_evictions"] += evicted
+
+def result_cache_stats() -> Dict[str, int]:
+    """Hit/miss/eviction counters since the process started, plus current cache size"""
+    entries = _entries()
+    with _lock:
+        stats = dict(_stats)
+    stats["results_cached"] = len(entries)
+    stats["result_cache_bytes"] = sum(stat.st_size for _, stat in entries)
+    return stats
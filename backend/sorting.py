@@ -1,85 +1,326 @@
 import pandas as pd
-from typing import List, Dict
+from typing import Callable, List, Dict, Optional
 from pathlib import Path
 import shutil
 import os
-import zipfile
 from io import BytesIO
 import gc  # Garbage collection
+from archive import CompressionPolicy, compression_policy, iter_archive, new_archive_stats
+from metrics import annotate, stage
+from readers import normalize_header, read_table
+from uploads import UploadBudgetExceeded, materialize, upload_source, upload_view
 
-def sort_pdfs(master_file, pdf_files):
+# Master sheet headers (case-insensitive, comma-separated) whose values the member index
+# is built from; every other column is only searched by the substring fallback
+SORT_ID_COLUMNS = os.getenv(
+    "SORT_ID_COLUMNS",
+    "member id,member number,member #,member no,subscriber,subscriber id,subscriber number,"
+    "mrn,medical record number,mbi,medicare id,medicaid id,hicn,patient id,policy number,id"
+)
+
+_sort_id_headers = frozenset(normalize_header(name) for name in SORT_ID_COLUMNS.split(",") if name.strip())
+
+def normalize_member_id(value) -> str:
+    """Normalize a member ID (or any cell value) for index lookups"""
+    return str(value).strip().lower()
+
+def find_member_id_column(df):
+    """Find the Member ID column case-insensitively, or None if the sheet has none"""
+    for col in df.columns:
+        if normalize_header(col) == "member id":
+            return col
+    return None
+
+def is_id_column(header) -> bool:
+    """Whether a master sheet column holds member identifiers (one of SORT_ID_COLUMNS)"""
+    return normalize_header(header) in _sort_id_headers
+
+def is_sort_column(header) -> bool:
+    """
+    Columns the member index covers: Insurance and Care Gap (as before) plus the ID
+    columns. The substring fallback still scans the whole sheet.
+    """
+    return normalize_header(header) in ("insurance", "care gap") or is_id_column(header)
+
+def build_member_index(df) -> Dict[str, int]:
+    """
+    Build a one-time index over the master sheet mapping normalized values to row positions.
+    
+    The Member ID column is indexed first so its values win over the same value appearing
+    in any other column. Within a column the first (top-most) row wins.
+    
+    Args:
+        df: Master care gap DataFrame
+    
+    Returns:
+        dict: normalized value -> positional row index into df
+    """
+    index = {}
+    id_col = find_member_id_column(df)
+    ordered_cols = ([id_col] if id_col is not None else []) + [col for col in df.columns if col != id_col]
+    
+    for col in ordered_cols:
+        values = df[col].reset_index(drop=True)
+        values = values[values.notna()]
+        keys = values.astype(str).str.strip().str.lower()
+        for position, key in zip(keys.index, keys):
+            if key and key not in index:
+                index[key] = position
+    
+    return index
+
+def build_id_index(df) -> Dict[str, int]:
+    """
+    Member index over the ID columns only, for matching text pulled out of PDFs
+    (words in a PDF could otherwise match an Insurance, Care Gap or name value).
+    """
+    return build_member_index(df[[col for col in df.columns if is_id_column(col)]])
+
+def content_positions(member_index: Dict[str, int], tokens_per_pdf: List[List[str]]) -> List[Optional[int]]:
+    """First master row matched by any of each PDF's extracted tokens (None if none match)"""
+    positions = []
+    for tokens in tokens_per_pdf:
+        positions.append(next((member_index[token] for token in tokens if token in member_index), None))
+    return positions
+
+def find_member_row(df, member_index: Dict[str, int], member_id: str, str_df_holder: Dict, stats: Dict, substring_fallback: bool = True):
+    """
+    Resolve a member ID to its master row, trying the index first.
+    
+    On an index miss the original substring scan over every cell is used as a fallback
+    (when enabled). The string-cast copy of the sheet it needs is built once per sort and
+    kept in str_df_holder so repeated misses don't re-cast the whole frame.
+    
+    Returns:
+        pd.Series or None: The first matching row
+    """
+    position = member_index.get(normalize_member_id(member_id))
+    if position is not None:
+        stats["index_hits"] += 1
+        return df.iloc[position]
+    
+    if substring_fallback and member_id:
+        if "df" not in str_df_holder:
+            str_df_holder["df"] = df.astype(str)
+        str_df = str_df_holder["df"]
+        mask = str_df.apply(lambda x: x.str.contains(member_id, case=False, na=False)).any(axis=1)
+        matching_rows = df[mask]
+        if not matching_rows.empty:
+            stats["fallback_hits"] += 1
+            return matching_rows.iloc[0]
+    
+    stats["unmatched"] += 1
+    return None
+
+def new_sort_stats() -> Dict[str, int]:
+    """Counters for how each PDF was resolved"""
+    return {"index_hits": 0, "content_hits": 0, "fallback_hits": 0, "unmatched": 0}
+
+def load_master(master_file):
+    """
+    Read the master sheet and build its member index.
+    
+    Args:
+        master_file: Excel/CSV file containing care gap data
+    
+    Returns:
+        tuple: (DataFrame, member index)
+    """
+    # Read master file as strings straight from the upload's spooled stream; every column
+    # is kept so the substring fallback can search all of them
+    with stage("parse") as parse:
+        df = read_table(upload_source(master_file), master_file.filename, dtype=str)
+        parse["rows"] = len(df)
+    
+    print(f"Master file loaded: {len(df)} rows")
+    
+    # Index the ID, Insurance and Care Gap columns once so each PDF is a constant-time lookup
+    with stage("index", rows=len(df)):
+        member_index = build_member_index(df[[col for col in df.columns if is_sort_column(col)]])
+    print(f"Member index built: {len(member_index)} keys")
+    
+    return df, member_index
+
+def filename_member_id(filename: str) -> str:
+    """Member ID a PDF's filename starts with (<memberid>_*.pdf)"""
+    return filename.split('_')[0] if '_' in filename else filename.replace('.pdf', '')
+
+def _content_lookup(batch, member_index: Dict[str, int], id_index_holder: Dict, df) -> Dict[int, Optional[int]]:
+    """
+    For the PDFs in a batch whose filename isn't in the index, the master row their text
+    points to. Returns batch position -> row position (None when the text didn't match).
+    """
+    from contextlib import ExitStack
+    from pdf_ids import extract_tokens_many
+    
+    misses = [n for n, pdf in enumerate(batch) if normalize_member_id(filename_member_id(pdf.filename)) not in member_index]
+    if not misses:
+        return {}
+    
+    # Spooled-to-disk uploads are read by path in the workers; the rest are copied once to send them over
+    with ExitStack() as views:
+        sources = []
+        for n in misses:
+            path = getattr(batch[n], 'path', None)
+            data = views.enter_context(upload_view(batch[n])) if path is not None else materialize(batch[n])
+            sources.append({"data": data, "path": path})
+        tokens_per_pdf = extract_tokens_many(sources)
+        del sources
+    
+    if "index" not in id_index_holder:
+        id_index_holder["index"] = build_id_index(df)
+    return dict(zip(misses, content_positions(id_index_holder["index"], tokens_per_pdf)))
+
+def iter_routed_pdfs(df, member_index: Dict[str, int], pdf_files, stats: Dict, substring_fallback: bool = True,
+                     progress: Optional[Callable] = None, content_lookup: bool = False):
+    """
+    Route each PDF to its folder in the archive.
+    
+    The member ID comes from the filename; with content_lookup, PDFs whose filename isn't
+    in the index are matched by the text of their first pages (extracted in parallel per
+    batch) before falling back to the substring scan.
+    
+    progress, if given, is called with pdfs_routed/pdfs_total after each PDF.
+    
+    Yields:
+        tuple: (zip_path, pdf upload) for each PDF; archive.iter_archive copies them into the archive
+    """
+    str_df_holder = {}
+    id_index_holder = {}
+    routed = 0
+    
+    # Process PDFs in smaller batches to avoid memory issues
+    batch_size = 50
+    for i in range(0, len(pdf_files), batch_size):
+        batch = pdf_files[i:i + batch_size]
+        print(f"Processing batch {i//batch_size + 1}: {len(batch)} files")
+        
+        content_matches = {}
+        if content_lookup:
+            try:
+                with stage("pdf_text"):
+                    content_matches = _content_lookup(batch, member_index, id_index_holder, df)
+            except UploadBudgetExceeded:
+                raise
+            except Exception as e:
+                print(f"Content lookup failed for batch {i//batch_size + 1}: {str(e)}")
+        
+        for n, pdf in enumerate(batch):
+            try:
+                # Extract member ID from filename
+                filename = pdf.filename
+                member_id = filename_member_id(filename)
+                
+                # Find matching row (index lookup, then the PDF's text, substring scan last)
+                if content_matches.get(n) is not None:
+                    stats["content_hits"] += 1
+                    row = df.iloc[content_matches[n]]
+                else:
+                    row = find_member_row(df, member_index, member_id, str_df_holder, stats, substring_fallback)
+                
+                if row is not None:
+                    # Get folder name from first matching row
+                    folder_name = f"{row.get('Insurance', 'Unknown')}_{row.get('Care Gap', 'Unknown')}"
+                    folder_name = "".join(c for c in folder_name if c.isalnum() or c in (' ', '_', '-')).strip()
+                    zip_path = f"{folder_name}/{filename}"
+                else:
+                    zip_path = f"Unmatched/{filename}"
+                
+            except Exception as e:
+                print(f"Error processing {pdf.filename}: {str(e)}")
+                continue
+            
+            yield zip_path, pdf
+            
+            routed += 1
+            if progress is not None:
+                progress(pdfs_routed=routed, pdfs_total=len(pdf_files))
+        
+        # Force garbage collection after each batch
+        gc.collect()
+    
+    print(f"Sorted {len(pdf_files)} PDFs: {stats['index_hits']} by index, {stats['content_hits']} by content, "
+          f"{stats['fallback_hits']} by fallback scan, {stats['unmatched']} unmatched")
+
+def _report_archive(stats: Dict, progress: Optional[Callable] = None):
+    """Log compression stats and add them to the request's metrics (and a job's progress)"""
+    stats["compress_cpu_seconds"] = round(stats["compress_cpu_seconds"], 4)
+    print(f"Archive: {stats['entries_deflated']} entries deflated, {stats['entries_stored']} stored, "
+          f"{stats['bytes_saved']} bytes saved for {stats['compress_cpu_seconds']}s of compression CPU")
+    annotate(**stats)
+    if progress is not None:
+        progress(**stats)
+
+def iter_sorted_zip(df, member_index: Dict[str, int], pdf_files, substring_fallback: bool = True,
+                    progress: Optional[Callable] = None, content_lookup: bool = False,
+                    compression: Optional[CompressionPolicy] = None):
+    """
+    Stream the sorted-PDF ZIP as it is built.
+    
+    Each PDF is copied (or compressed) into its entry and the archive is yielded as it is
+    produced, so peak memory stays bounded by the archive stage's in-flight limit plus
+    the member index regardless of batch size.
+    
+    Args:
+        df: Master DataFrame from load_master
+        member_index: Member index from load_master
+        pdf_files: List of PDF file objects from Flask
+        substring_fallback: Scan every cell for the member ID when the index has no exact match
+        progress: Optional callback taking keyword counters (pdfs_routed, pdfs_total, and
+                  the archive's compression stats at the end)
+        content_lookup: Match PDFs whose filename isn't in the index by their text
+        compression: Compression policy (see archive.compression_policy); None uses the default
+    
+    Yields:
+        bytes: Consecutive chunks of the ZIP archive
+    """
+    stats = new_sort_stats()
+    archive_stats = new_archive_stats()
+    compression = compression or compression_policy()
+    
+    # Timed while the generator runs, so a streamed response includes time spent sending
+    with stage("zip", rows=len(pdf_files)):
+        entries = iter_routed_pdfs(df, member_index, pdf_files, stats, substring_fallback, progress, content_lookup)
+        for chunk in iter_archive(entries, compression, archive_stats):
+            if chunk:
+                yield chunk
+    _report_archive(archive_stats, progress)
+
+def sort_pdfs(master_file, pdf_files, substring_fallback: bool = True, content_lookup: bool = False,
+              compression: Optional[CompressionPolicy] = None):
     """
     Sort PDFs based on the master care gap sheet.
     
     Args:
         master_file: Excel file containing care gap data
         pdf_files: List of PDF file objects from Flask
+        substring_fallback: Scan every cell for the member ID when the index has no exact match
+        content_lookup: Match PDFs whose filename isn't in the index by their text
+        compression: Compression policy (see archive.compression_policy); None uses the default
     
     Returns:
         bytes: ZIP file containing sorted PDFs as bytes for download
     """
     try:
-        # Read master file with minimal memory
-        if master_file.filename.endswith('.csv'):
-            df = pd.read_csv(BytesIO(master_file.read()), dtype=str)
-        else:
-            df = pd.read_excel(BytesIO(master_file.read()), dtype=str, engine='openpyxl')
-        master_file.seek(0)
+        df, member_index = load_master(master_file)
+        stats = new_sort_stats()
         
-        print(f"Master file loaded: {len(df)} rows")
+        archive_stats = new_archive_stats()
         
         # Create in-memory ZIP
         zip_buffer = BytesIO()
         
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            # Process PDFs in smaller batches to avoid memory issues
-            batch_size = 50
-            for i in range(0, len(pdf_files), batch_size):
-                batch = pdf_files[i:i + batch_size]
-                print(f"Processing batch {i//batch_size + 1}: {len(batch)} files")
-                
-                for pdf in batch:
-                    try:
-                        # Read PDF content
-                        pdf_content = pdf.read()
-                        pdf.seek(0)
-                        
-                        # Extract member ID from filename
-                        filename = pdf.filename
-                        member_id = filename.split('_')[0] if '_' in filename else filename.replace('.pdf', '')
-                        
-                        # Find matching row (use vectorized operation instead of iterrows)
-                        mask = df.astype(str).apply(lambda x: x.str.contains(member_id, case=False, na=False)).any(axis=1)
-                        matching_rows = df[mask]
-                        
-                        if not matching_rows.empty:
-                            # Get folder name from first matching row
-                            row = matching_rows.iloc[0]
-                            folder_name = f"{row.get('Insurance', 'Unknown')}_{row.get('Care Gap', 'Unknown')}"
-                            folder_name = "".join(c for c in folder_name if c.isalnum() or c in (' ', '_', '-')).strip()
-                            zip_path = f"{folder_name}/{filename}"
-                        else:
-                            zip_path = f"Unmatched/{filename}"
-                        
-                        # Add to ZIP
-                        zip_file.writestr(zip_path, pdf_content)
-                        
-                        # Clear memory
-                        del pdf_content
-                        
-                    except Exception as e:
-                        print(f"Error processing {pdf.filename}: {str(e)}")
-                        continue
-                
-                # Force garbage collection after each batch
-                gc.collect()
+        with stage("zip", rows=len(pdf_files)):
+            entries = iter_routed_pdfs(df, member_index, pdf_files, stats, substring_fallback,
+                                       content_lookup=content_lookup)
+            for chunk in iter_archive(entries, compression or compression_policy(), archive_stats):
+                zip_buffer.write(chunk)
+        _report_archive(archive_stats)
         
-        zip_buffer.seek(0)
-        return zip_buffer.read()
+        return zip_buffer.getvalue()
         
     except Exception as e:
         print(f"Error in sort_pdfs: {str(e)}")
         import traceback
         traceback.print_exc()
         raise
-
@@ -0,0 +1,63 @@
+import gc
+import os
+import time
+from typing import Dict
+
+# Startup timings and warm state.
+#
+# Records how long the app took to import, warm up and serve its first request, per
+# process. With gunicorn's preload_app the master imports the app and runs warm_up once;
+# workers are forked from it with every module already loaded, and gc.freeze() keeps the
+# collector from writing to (and so copying) those shared pages in each worker.
+
+# Import the modules pandas and the pipelines otherwise load on first use (Excel engines,
+# PDF reader, process pools) at startup rather than in the first request
+WARM_IMPORTS = os.getenv("WARM_IMPORTS", "true").lower() == "true"
+
+_started = time.time()
+
+_timings: Dict[str, float] = {}
+_first_request_seen = False
+
+def record(name: str, seconds: float):
+    _timings[name] = round(seconds, 4)
+    print(f"Startup: {name} took {seconds:.3f}s (pid {os.getpid()})", flush=True)
+
+def warm_up():
+    """Load lazily imported modules now (no-op when WARM_IMPORTS is off)"""
+    if not WARM_IMPORTS:
+        return
+    started = time.perf_counter()
+    import multiprocessing  # noqa: F401
+    import concurrent.futures.process  # noqa: F401
+    import xlsxwriter  # noqa: F401
+    import openpyxl  # noqa: F401
+    import PyPDF2  # noqa: F401
+    from readers import excel_engine
+    if excel_engine() == "calamine":
+        import python_calamine  # noqa: F401
+    record("warm_up", time.perf_counter() - started)
+
+def freeze():
+    """Move everything allocated so far out of the collector's reach (call before forking workers)"""
+    gc.collect()
+    gc.freeze()
+
+def worker_started():
+    """Restart the clock in a worker forked from a preloaded master (its timings so far are the master's)"""
+    global _started, _first_request_seen
+    _started = time.time()
+    _first_request_seen = False
+
+def first_request(seconds: float):
+    """Record the first request this process served: its own latency and the time since the process started"""
+    global _first_request_seen
+    if _first_request_seen:
+        return
+    _first_request_seen = True
+    record("first_request", seconds)
+    record("start_to_first_response", time.time() - _started)
+
+def startup_stats() -> Dict:
+    """Startup timings of this process, in seconds"""
+    return {"pid": os.getpid(), "uptime_seconds": round(time.time() - _started, 1), **_timings}
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+# Tests import the backend modules the way app.py does (from backend/), and the in-memory
+# database from benchmarks/
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (BACKEND_DIR, os.path.join(BACKEND_DIR, "benchmarks")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from fake_db import FakeDB  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    return FakeDB()
@@ -0,0 +1,61 @@
+from datetime import datetime
+
+import pandas as pd
+
+from fuzzy_dedup import fuzzy_dedup, fuzzy_options
+from merging import MASTER_COLUMNS
+
+MASTER_ROW = ("Robert", "Smith", "12345678", "BCS", datetime(1980, 1, 2), "Payer A")
+
+
+def _frame(*rows):
+    records = [dict(zip(MASTER_COLUMNS, row + ("Dr. Who", ""))) for row in rows]
+    return pd.DataFrame(records, columns=MASTER_COLUMNS)
+
+
+def _dedup(*new_rows, max_block=None):
+    return fuzzy_dedup(_frame(MASTER_ROW, *new_rows), protected_rows=1, options=fuzzy_options(), max_block=max_block)
+
+
+def test_nickname_case_and_text_dob_match():
+    kept, review, stats = _dedup(("BOB", "  smith ", "12345678", "BCS", "01/02/1980", "Payer B"))
+
+    assert len(kept) == 1
+    assert stats["fuzzy_duplicates_dob"] == 1
+    assert review.loc[0, "Matched On"] == "DOB + Member ID"
+    assert review.loc[0, "Kept From"] == "Master"
+    assert review.loc[0, "Kept Sheet Row"] == 2
+
+
+def test_member_id_match_when_dob_disagrees():
+    kept, review, stats = _dedup(("Robert", "Smith", "123-456-78", "BCS", "1981-01-02", "Payer B"))
+
+    assert len(kept) == 1
+    assert stats["fuzzy_duplicates_id"] == 1
+    assert review.loc[0, "Matched On"] == "Member ID"
+    assert review.loc[0, "Blocked By"] == "Last name sound"
+
+
+def test_different_people_and_gaps_are_kept():
+    kept, review, stats = _dedup(
+        # Same DOB and gap, different person
+        ("Maria", "Garcia", "87654321", "BCS", datetime(1980, 1, 2), "Payer B"),
+        # Same person, different care gap
+        ("Robert", "Smith", "12345678", "COL", datetime(1980, 1, 2), "Payer B"),
+        # Similar name and same gap, but neither the DOB nor the member ID agree
+        ("Roberta", "Smith", "99999999", "BCS", datetime(1990, 6, 1), "Payer B"),
+    )
+
+    assert len(kept) == 4
+    assert review.empty
+    assert stats["fuzzy_duplicates_dob"] == stats["fuzzy_duplicates_id"] == 0
+
+
+def test_oversized_block_is_skipped():
+    duplicate = ("Bob", "Smith", "12345678", "BCS", "01/02/1980", "Payer B")
+    kept, review, stats = _dedup(duplicate, duplicate, max_block=2)
+
+    assert stats["fuzzy_blocks_skipped"] == 2
+    assert stats["fuzzy_candidate_pairs"] == 0
+    assert len(kept) == 3
+    assert review.empty
@@ -0,0 +1,93 @@
+import pandas as pd
+import pytest
+
+import cache
+import gaps_store
+from merging import compile_gap_lookup
+
+
+def _gaps_df():
+    return pd.DataFrame({
+        "Breast Cancer Screening": ["BCS", "Mammogram", "BCS-E"],
+        "Colorectal Cancer Screening": ["COL", "Colonoscopy", None],
+        "Diabetes Eye Exam": ["EED", None, None],
+    })
+
+
+def _edits(df):
+    """Successive uploads: a row added, a cell changed, a column added, a row removed, ..."""
+    for n in range(7):
+        df = df.copy()
+        step = n % 4
+        if step == 0:
+            df.loc[len(df)] = [f"New {n} {col}" for col in range(df.shape[1])]
+        elif step == 1:
+            df.iloc[0, 0] = f"Changed {n}"
+        elif step == 2:
+            df[f"Extra {n}"] = [f"X{n}"] + [None] * (len(df) - 1)
+        else:
+            df = df.iloc[:-1]
+        yield df
+
+
+def _cells(df):
+    df = df.reset_index(drop=True).astype(object)
+    return df.where(df.notna(), None).values.tolist()
+
+
+@pytest.fixture
+def versions(db, monkeypatch):
+    """Upload a gaps file and its edits; returns version -> uploaded frame"""
+    monkeypatch.setattr(gaps_store, "GAPS_SNAPSHOT_EVERY", 3)
+    monkeypatch.setattr(gaps_store, "GAPS_CHUNK_ROWS", 2)
+    uploaded = {}
+    frames = [_gaps_df(), *_edits(_gaps_df())]
+    for df in frames:
+        meta = gaps_store.save_gaps(db, df)
+        uploaded[meta["version"]] = df
+    return uploaded
+
+
+def test_delta_versions_rebuild_the_uploaded_file(db, versions):
+    metas = {version: gaps_store.get_gaps_meta(db, version) for version in versions}
+    assert any(not meta["snapshot"] for meta in metas.values())
+
+    for version, df in versions.items():
+        meta = metas[version]
+        rebuilt = gaps_store.load_gaps_df(db, meta)
+        assert list(rebuilt.columns) == list(df.columns)
+        assert _cells(rebuilt) == _cells(df)
+        assert gaps_store.load_gap_lookup(db, meta) == compile_gap_lookup(df)
+
+
+def test_cached_delta_matches_direct_read(db, versions, monkeypatch):
+    monkeypatch.setattr(cache, "_gaps_entries", type(cache._gaps_entries)())
+    applied_on_base = []
+
+    def load_gap_lookup(db, meta, base_lookup=None):
+        applied_on_base.append(base_lookup is not None)
+        return gaps_store.load_gap_lookup(db, meta, base_lookup)
+
+    monkeypatch.setattr(cache, "load_gap_lookup", load_gap_lookup)
+    for version in sorted(versions):
+        meta = gaps_store.get_gaps_meta(db, version)
+        # The previous version is cached, so a delta is applied to its lookup
+        cached_version, lookup = cache.get_gaps(db, version)
+        assert cached_version == version
+        assert lookup == gaps_store.load_gap_lookup(db, meta)
+        assert applied_on_base[-1] == (not meta["snapshot"])
+
+
+def test_conflicting_upload_is_rejected_and_removed(db, versions):
+    active = gaps_store.get_gaps_meta(db)
+    stored = db.system_files.count_documents({"file_type": "gaps"})
+    chunks = db.gaps_chunks.count_documents({})
+
+    # Another upload switched the active version after this one was diffed
+    db.system_files.update_one({"file_type": "gaps_active"}, {"$set": {"gaps_id": "other"}})
+    with pytest.raises(gaps_store.GapsVersionConflict):
+        gaps_store.save_gaps(db, versions[active["version"]].assign(Added="x"))
+
+    assert db.system_files.count_documents({"file_type": "gaps"}) == stored
+    assert db.gaps_chunks.count_documents({}) == chunks
+    assert db.system_files.find_one({"file_type": "gaps_active"})["gaps_id"] == "other"
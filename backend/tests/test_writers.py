@@ -0,0 +1,54 @@
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import pytest
+
+import writers
+
+
+def _cells(path, sheet_name):
+    worksheet = openpyxl.load_workbook(path)[sheet_name]
+    return [
+        [(cell.value, cell.number_format, cell.font.b, cell.alignment.horizontal, cell.alignment.vertical,
+          cell.border.top.style) for cell in row]
+        for row in worksheet.iter_rows()
+    ]
+
+
+@pytest.fixture
+def frame():
+    return pd.DataFrame({
+        "Text": ["x", None, "=1+1", "http://example.com", "00123"],
+        "Float": [1.5, 2.0, np.nan, np.inf, -np.inf],
+        "Int": np.arange(5, dtype=np.int64),
+        "When": pd.to_datetime(["2020-01-01", None, "2021-05-05 10:11:12", "2020-01-01", "2020-01-01"], format="mixed"),
+        "Mixed": [date(2020, 1, 2), True, np.int64(5), 3.5, pd.Timestamp("2020-02-02")],
+        "Gap": pd.Categorical(["BCS", "COL", None, "BCS", "EED"]),
+        "Other": [timedelta(days=1), None, "", np.nan, pd.NaT],
+        "Born": [datetime(1980, 1, 2), datetime(1975, 12, 31), None, datetime(2001, 7, 4), datetime(1999, 1, 1)],
+    })
+
+
+def test_xlsx_cells_match_to_excel(frame, tmp_path):
+    expected = tmp_path / "expected.xlsx"
+    with pd.ExcelWriter(expected, engine="xlsxwriter") as writer:
+        frame.to_excel(writer, index=False, sheet_name="Merged")
+    written = tmp_path / "written.xlsx"
+    writers.write_xlsx(frame, str(written), "Merged")
+
+    assert _cells(written, "Merged") == _cells(expected, "Merged")
+
+
+def test_extra_sheets_match_to_excel(frame, tmp_path):
+    review = frame[["Text", "Born"]].iloc[:2]
+    expected = tmp_path / "expected.xlsx"
+    with pd.ExcelWriter(expected, engine="xlsxwriter") as writer:
+        frame.to_excel(writer, index=False, sheet_name="Merged")
+        review.to_excel(writer, index=False, sheet_name="Review")
+    written = tmp_path / "written.xlsx"
+    writers.write_xlsx(frame, str(written), "Merged", extra_sheets={"Review": review})
+
+    for sheet_name in ("Merged", "Review"):
+        assert _cells(written, sheet_name) == _cells(expected, sheet_name)
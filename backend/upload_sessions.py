@@ -0,0 +1,328 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+from werkzeug.datastructures import MultiDict
+from jobs import StoredUpload
+
+# Resumable, chunked uploads.
+#
+# A client declares the files it is about to send (name, size, form field), PUTs them in
+# numbered chunks with a sha256 of each, asks which chunks are still missing after a
+# dropped connection, and finalizes the session once everything arrived. The merge and
+# sort routes then take uploadSession=<id> in place of multipart files and read the
+# assembled files straight from disk, so a retry only re-sends the missing chunks and a
+# batch is no longer limited to what fits in one POST.
+#
+# Sessions live under UPLOAD_SESSIONS_DIR so they survive worker restarts:
+#   session.json   the declared files, chunk size and finalized flag
+#   received.log   one line per stored chunk ("<file> <chunk>"), appended after its data
+#                  is written; a chunk missing from the log is simply sent again
+#   files/<n>      each file, preallocated to its declared size and filled in place
+
+UPLOAD_SESSIONS_DIR = os.getenv("UPLOAD_SESSIONS_DIR", os.path.join(tempfile.gettempdir(), "nch-upload-sessions"))
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_MB", "8")) * 2**20
+UPLOAD_SESSION_MAX_FILES = int(os.getenv("UPLOAD_SESSION_MAX_FILES", "10000"))
+UPLOAD_SESSION_MAX_BYTES = int(os.getenv("UPLOAD_SESSION_MAX_MB", "4096")) * 2**20
+# Uploads contain PHI; sessions untouched this long are deleted (sessions a merge or sort
+# used are deleted as soon as it finishes)
+UPLOAD_SESSION_TTL_SECONDS = int(os.getenv("UPLOAD_SESSION_TTL_SECONDS", str(4 * 60 * 60)))
+# How often each process sweeps for expired sessions
+UPLOAD_SESSION_SWEEP_SECONDS = int(os.getenv("UPLOAD_SESSION_SWEEP_SECONDS", "300"))
+
+COPY_CHUNK_BYTES = 2**20
+
+_lock = threading.Lock()
+_sweeper_pid = None
+
+class SessionNotFound(LookupError):
+    pass
+
+class SessionNotReady(ValueError):
+    pass
+
+def _session_dir(session_id: str) -> str:
+    if not session_id or not session_id.isalnum():
+        raise SessionNotFound("Upload session not found.")
+    return os.path.join(UPLOAD_SESSIONS_DIR, session_id)
+
+def _file_path(session_dir: str, index: int) -> str:
+    return os.path.join(session_dir, "files", str(index))
+
+def _write_record(session_dir: str, record: dict):
+    path = os.path.join(session_dir, "session.json")
+    with open(path + ".tmp", 'w') as f:
+        json.dump(record, f)
+    os.replace(path + ".tmp", path)
+
+def _chunk_count(size: int, chunk_size: int) -> int:
+    # An empty file still takes one (empty) chunk
+    return max(1, -(-size // chunk_size))
+
+def load_session(session_id: str) -> dict:
+    """
+    Raises:
+        SessionNotFound: Unknown or expired session
+    """
+    session_dir = _session_dir(session_id)
+    try:
+        with open(os.path.join(session_dir, "session.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        raise SessionNotFound("Upload session not found.")
+
+def _received(session_id: str) -> Dict[int, set]:
+    """file index -> chunk numbers stored so far"""
+    received: Dict[int, set] = {}
+    try:
+        with open(os.path.join(_session_dir(session_id), "received.log")) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2:
+                    received.setdefault(int(parts[0]), set()).add(int(parts[1]))
+    except FileNotFoundError:
+        pass
+    return received
+
+def expire_sessions():
+    """Delete sessions with no activity for UPLOAD_SESSION_TTL_SECONDS"""
+    cutoff = time.time() - UPLOAD_SESSION_TTL_SECONDS
+    try:
+        names = os.listdir(UPLOAD_SESSIONS_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        session_dir = os.path.join(UPLOAD_SESSIONS_DIR, name)
+        try:
+            last_activity = max(os.path.getmtime(os.path.join(session_dir, entry)) for entry in os.listdir(session_dir))
+        except (OSError, ValueError):
+            last_activity = 0
+        if last_activity < cutoff:
+            shutil.rmtree(session_dir, ignore_errors=True)
+
+def _sweep():
+    while True:
+        time.sleep(UPLOAD_SESSION_SWEEP_SECONDS)
+        try:
+            expire_sessions()
+        except Exception as e:
+            print(f"Upload session sweep failed: {e}")
+
+def start_sweeper():
+    """
+    Expire sessions every UPLOAD_SESSION_SWEEP_SECONDS from a daemon thread, started once
+    per process (a thread started before a fork doesn't run in the child)
+    """
+    global _sweeper_pid
+    if _sweeper_pid == os.getpid():
+        return
+    with _lock:
+        if _sweeper_pid != os.getpid():
+            _sweeper_pid = os.getpid()
+            threading.Thread(target=_sweep, name="upload-session-sweeper", daemon=True).start()
+
+def create_session(files: List[dict], chunk_size: Optional[int] = None) -> dict:
+    """
+    Start an upload session.
+
+    Args:
+        files: Declared files, each {"name", "size", "field"} plus an optional "sha256" of
+               the whole file, checked on finalize. "field" is the multipart field the file
+               stands in for (masterFile, careSheet_0, pdfFiles, ...)
+        chunk_size: Requested chunk size in bytes (capped at UPLOAD_CHUNK_MB)
+
+    Returns:
+        dict: The session (id, chunk_size, files with their chunk counts)
+
+    Raises:
+        ValueError: Invalid file list or over the session limits
+    """
+    if not isinstance(files, list) or not files:
+        raise ValueError("At least one file is required.")
+    if len(files) > UPLOAD_SESSION_MAX_FILES:
+        raise ValueError(f"At most {UPLOAD_SESSION_MAX_FILES} files per upload session.")
+    chunk_size = min(int(chunk_size or UPLOAD_CHUNK_BYTES), UPLOAD_CHUNK_BYTES)
+    if chunk_size <= 0:
+        raise ValueError("Invalid chunk size.")
+
+    declared = []
+    for index, entry in enumerate(files):
+        if not isinstance(entry, dict):
+            raise ValueError(f"File {index}: expected an object with name, size and field.")
+        name, size, field = entry.get("name"), entry.get("size"), entry.get("field")
+        if not isinstance(name, str) or not name or not isinstance(field, str) or not field:
+            raise ValueError(f"File {index}: name and field are required.")
+        if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+            raise ValueError(f"File {index}: size must be a non-negative integer.")
+        declared.append({
+            "index": index,
+            "name": os.path.basename(name),
+            "field": field,
+            "size": size,
+            "sha256": entry.get("sha256"),
+            "chunks": _chunk_count(size, chunk_size),
+        })
+    if sum(entry["size"] for entry in declared) > UPLOAD_SESSION_MAX_BYTES:
+        raise ValueError(f"Upload session is larger than the {UPLOAD_SESSION_MAX_BYTES // 2**20} MB limit.")
+
+    expire_sessions()
+    session_id = uuid.uuid4().hex
+    session_dir = os.path.join(UPLOAD_SESSIONS_DIR, session_id)
+    os.makedirs(os.path.join(session_dir, "files"))
+    for entry in declared:
+        # Sparse until filled; chunks are written at their offsets in any order
+        with open(_file_path(session_dir, entry["index"]), 'wb') as f:
+            f.truncate(entry["size"])
+    record = {"id": session_id, "chunk_size": chunk_size, "files": declared,
+              "created_at": time.time(), "finalized": False}
+    _write_record(session_dir, record)
+    return record
+
+def write_chunk(session_id: str, file_index: int, chunk: int, stream, checksum: Optional[str]) -> dict:
+    """
+    Store one chunk read from stream at its offset.
+
+    Args:
+        checksum: Hex sha256 of the chunk as sent; required
+
+    Returns:
+        dict: {"file", "chunk", "size"}
+
+    Raises:
+        SessionNotFound: Unknown session
+        ValueError: Unknown file or chunk, wrong length, checksum mismatch, or a finalized session
+    """
+    record = load_session(session_id)
+    if record["finalized"]:
+        raise ValueError("Upload session is already finalized.")
+    if not 0 <= file_index < len(record["files"]):
+        raise ValueError(f"Unknown file {file_index}.")
+    entry = record["files"][file_index]
+    if not 0 <= chunk < entry["chunks"]:
+        raise ValueError(f"File {file_index} has no chunk {chunk}.")
+    if not checksum:
+        raise ValueError("Chunk checksum (X-Chunk-Sha256) is required.")
+
+    chunk_size = record["chunk_size"]
+    offset = chunk * chunk_size
+    expected = min(chunk_size, entry["size"] - offset)
+    session_dir = _session_dir(session_id)
+
+    # Hashed while written in place; a chunk that fails the check isn't logged, so it
+    # still counts as missing and its bytes are overwritten by the retry
+    digest = hashlib.sha256()
+    written = 0
+    with open(_file_path(session_dir, file_index), 'r+b') as f:
+        f.seek(offset)
+        while written <= expected:
+            data = stream.read(min(COPY_CHUNK_BYTES, expected + 1 - written))
+            if not data:
+                break
+            if written + len(data) > expected:
+                raise ValueError(f"Chunk {chunk} of file {file_index} is longer than {expected} bytes.")
+            f.write(data)
+            digest.update(data)
+            written += len(data)
+    if written != expected:
+        raise ValueError(f"Chunk {chunk} of file {file_index} should be {expected} bytes, got {written}.")
+    if digest.hexdigest() != checksum.strip().lower():
+        raise ValueError(f"Checksum mismatch for chunk {chunk} of file {file_index}.")
+
+    with _lock, open(os.path.join(session_dir, "received.log"), 'a') as log:
+        log.write(f"{file_index} {chunk}\n")
+    return {"file": file_index, "chunk": chunk, "size": written}
+
+def session_status(session_id: str) -> dict:
+    """
+    Which chunks are still missing.
+
+    Returns:
+        dict: id, chunk_size, finalized, totals, and per incomplete file its missing chunk numbers
+    """
+    record = load_session(session_id)
+    received = _received(session_id)
+    incomplete = []
+    chunks_missing = 0
+    for entry in record["files"]:
+        have = received.get(entry["index"], set())
+        if len(have) < entry["chunks"]:
+            missing = [n for n in range(entry["chunks"]) if n not in have]
+            chunks_missing += len(missing)
+            incomplete.append({"file": entry["index"], "name": entry["name"], "missing": missing})
+    return {
+        "id": record["id"],
+        "chunk_size": record["chunk_size"],
+        "finalized": record["finalized"],
+        "files_total": len(record["files"]),
+        "files_complete": len(record["files"]) - len(incomplete),
+        "chunks_total": sum(entry["chunks"] for entry in record["files"]),
+        "chunks_missing": chunks_missing,
+        "incomplete": incomplete,
+    }
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(COPY_CHUNK_BYTES), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+def finalize_session(session_id: str) -> dict:
+    """
+    Check every chunk arrived (and whole-file checksums, where declared) and mark the
+    session ready to be used by the merge and sort routes.
+
+    Returns:
+        dict: The session status
+
+    Raises:
+        SessionNotFound: Unknown session
+        SessionNotReady: Chunks missing, or a file doesn't match its declared sha256
+    """
+    status = session_status(session_id)
+    if status["finalized"]:
+        return status
+    if status["chunks_missing"]:
+        raise SessionNotReady(f"{status['chunks_missing']} chunks are still missing.")
+
+    record = load_session(session_id)
+    session_dir = _session_dir(session_id)
+    for entry in record["files"]:
+        if entry.get("sha256") and _file_sha256(_file_path(session_dir, entry["index"])) != str(entry["sha256"]).lower():
+            raise SessionNotReady(f"File {entry['index']} ({entry['name']}) doesn't match its checksum. Re-upload it.")
+
+    record["finalized"] = True
+    record["finalized_at"] = time.time()
+    _write_record(session_dir, record)
+    status["finalized"] = True
+    return status
+
+def session_files(session_id: str) -> MultiDict:
+    """
+    A finalized session's files by form field, in declared order, for routes to use in
+    place of request.files. Files are read from the session directory in place.
+
+    Raises:
+        SessionNotFound: Unknown session
+        SessionNotReady: Not finalized yet
+    """
+    record = load_session(session_id)
+    if not record["finalized"]:
+        raise SessionNotReady("Upload session isn't finalized yet.")
+    session_dir = _session_dir(session_id)
+    files = MultiDict()
+    for entry in record["files"]:
+        files.add(entry["field"], StoredUpload(_file_path(session_dir, entry["index"]), entry["name"]))
+    return files
+
+def delete_session(session_id: str) -> bool:
+    session_dir = _session_dir(session_id)
+    if not os.path.isdir(session_dir):
+        return False
+    shutil.rmtree(session_dir, ignore_errors=True)
+    return True
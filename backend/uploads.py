@@ -0,0 +1,204 @@
+import mmap
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from io import BytesIO
+from tempfile import TemporaryFile
+from typing import Optional
+
+# Upload access without copying.
+#
+# werkzeug keeps each uploaded file in a spooled temp file (in memory while small, on
+# disk past a threshold). Instead of read()-ing it into a bytes object and wrapping that
+# in BytesIO, parsers get the spooled stream itself (or the path of an upload spooled
+# to a job directory), PDFs are copied into the archive chunk by chunk, and hashing
+# works on a memoryview / mmap of the data.
+#
+# Budgets, per request:
+#   MAX_UPLOAD_MB      total request size; larger requests are rejected with 413
+#   UPLOAD_SPOOL_KB    size up to which an uploaded file stays in memory before it is
+#                      spooled to disk (UPLOAD_SPOOL_DIR)
+#   UPLOAD_MEMORY_MB   upload bytes that may be copied into memory (e.g. to hand a file
+#                      to a parse or text-extraction process); past it UploadBudgetExceeded
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "1024")) * 2**20
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_KB", "512")) * 2**10
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR") or None
+UPLOAD_MEMORY_BYTES = int(os.getenv("UPLOAD_MEMORY_MB", "256")) * 2**20
+
+COPY_CHUNK_BYTES = 2**20
+
+class UploadBudgetExceeded(ValueError):
+    pass
+
+class ByteBudget:
+    """Bytes of upload data a request may copy into memory"""
+
+    def __init__(self, limit: int = UPLOAD_MEMORY_BYTES):
+        self.limit = limit
+        self.used = 0
+
+    def charge(self, size: int):
+        if self.used + size > self.limit:
+            raise UploadBudgetExceeded(
+                f"Request needs more than {self.limit // 2**20} MB of upload data in memory. "
+                "Submit it as a background job or in smaller batches."
+            )
+        self.used += size
+
+_budget: ContextVar[Optional[ByteBudget]] = ContextVar("upload_budget", default=None)
+
+def start_budget(limit: int = UPLOAD_MEMORY_BYTES) -> ByteBudget:
+    """Give the current request (or job) a fresh in-memory budget"""
+    budget = ByteBudget(limit)
+    _budget.set(budget)
+    return budget
+
+class SpooledUpload:
+    """
+    Upload kept in a BytesIO until it grows past max_size, then moved to a temporary file
+    (like SpooledTemporaryFile, but it says whether it rolled over and hands out its
+    in-memory buffer, so views of it don't depend on private attributes).
+    Everything else is delegated to the current backing file.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.rolled = False
+        self.file = BytesIO()
+
+    def rollover(self):
+        if self.rolled:
+            return
+        disk = TemporaryFile(mode="rb+", dir=UPLOAD_SPOOL_DIR)
+        disk.write(self.file.getbuffer())
+        disk.seek(self.file.tell())
+        self.file.close()
+        self.file = disk
+        self.rolled = True
+
+    def memory_buffer(self) -> Optional[BytesIO]:
+        """The BytesIO holding the upload, or None once it is on disk"""
+        return None if self.rolled else self.file
+
+    def write(self, data) -> int:
+        if not self.rolled and self.file.tell() + memoryview(data).nbytes > self.max_size:
+            self.rollover()
+        return self.file.write(data)
+
+    def fileno(self) -> int:
+        # A descriptor needs a real file
+        self.rollover()
+        return self.file.fileno()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+def spooled_stream(content_length: Optional[int] = None):
+    """Stream werkzeug writes one uploaded file into (see Flask's Request._get_file_stream)"""
+    if UPLOAD_SPOOL_BYTES <= 0 or (content_length is not None and content_length > UPLOAD_SPOOL_BYTES):
+        # Known to be large: straight to disk rather than filling memory first
+        return TemporaryFile(mode="rb+", dir=UPLOAD_SPOOL_DIR)
+    return SpooledUpload(UPLOAD_SPOOL_BYTES)
+
+def upload_source(file):
+    """
+    Path or seekable binary stream (positioned at the start) that a parser can read the
+    upload from in place. Callers that read from a stream leave it wherever the parser
+    stopped; the next upload_source / upload_view call rewinds it.
+    """
+    path = getattr(file, 'path', None)
+    if path is not None:
+        return path
+    stream = getattr(file, 'stream', file)
+    stream.seek(0)
+    return stream
+
+def upload_size(file) -> int:
+    path = getattr(file, 'path', None)
+    if path is not None:
+        return os.path.getsize(path)
+    stream = getattr(file, 'stream', file)
+    position = stream.tell()
+    size = stream.seek(0, os.SEEK_END)
+    stream.seek(position)
+    return size
+
+def _memory_buffer(stream):
+    """The BytesIO behind an in-memory stream, or None if it's backed by a real file"""
+    if isinstance(stream, SpooledUpload):
+        return stream.memory_buffer()
+    return stream if hasattr(stream, 'getbuffer') else None
+
+@contextmanager
+def upload_view(file):
+    """
+    Read-only bytes-like view of an upload without copying it: a memoryview of an
+    in-memory upload, or an mmap of a disk-backed one.
+    """
+    path = getattr(file, 'path', None)
+    handle = None
+    view = None
+    try:
+        if path is not None:
+            handle = open(path, 'rb')
+            fileno = handle.fileno()
+        else:
+            stream = getattr(file, 'stream', file)
+            buffer = _memory_buffer(stream)
+            if buffer is not None:
+                view = buffer.getbuffer()
+            else:
+                stream.seek(0)
+                fileno = stream.fileno()
+
+        if view is None:
+            if os.fstat(fileno).st_size == 0:
+                view = memoryview(b"")
+            else:
+                view = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        yield view
+    finally:
+        # Releases the export lock on a BytesIO / unmaps the file
+        if isinstance(view, memoryview):
+            view.release()
+        elif view is not None:
+            view.close()
+        if handle is not None:
+            handle.close()
+
+def materialize(file) -> bytes:
+    """Copy an upload into a bytes object, charged against the request's memory budget"""
+    budget = _budget.get()
+    if budget is not None:
+        budget.charge(upload_size(file))
+    with upload_view(file) as view:
+        return bytes(view)
+
+def iter_copy(file, dest, chunk_size: int = COPY_CHUNK_BYTES):
+    """Copy an upload into a writable file object chunk by chunk, yielding after each chunk"""
+    path = getattr(file, 'path', None)
+    if path is not None:
+        with open(path, 'rb') as source:
+            for chunk in iter(lambda: source.read(chunk_size), b''):
+                dest.write(chunk)
+                yield len(chunk)
+        return
+
+    source = upload_source(file)
+    for chunk in iter(lambda: source.read(chunk_size), b''):
+        dest.write(chunk)
+        yield len(chunk)
+
+def copy_upload(file, dest, chunk_size: int = COPY_CHUNK_BYTES) -> int:
+    """Copy an upload into a writable file object, returning the bytes copied"""
+    return sum(iter_copy(file, dest, chunk_size))
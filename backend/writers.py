@@ -0,0 +1,161 @@
+import os
+import tempfile
+from datetime import date, datetime, timedelta
+from typing import Dict, Optional
+import numpy as np
+import pandas as pd
+from metrics import stage
+
+# Output stage for merged sheets.
+#
+# Results are written to a file rather than built in memory: Excel output goes through
+# xlsxwriter's constant_memory mode, which flushes each row to disk once the next one
+# starts, and rows are written straight from the frame's column arrays. The cells match
+# what DataFrame.to_excel writes (same header style, date formats and value conversions).
+# CSV and Parquet (needs the optional pyarrow package) are faster alternatives.
+
+# Directory for spooled outputs (defaults to the system temp directory)
+OUTPUT_SPOOL_DIR = os.getenv("OUTPUT_SPOOL_DIR") or None
+
+# Format name -> (mimetype, file extension)
+OUTPUT_FORMATS = {
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+# Same formats pandas' Excel writer uses
+DATETIME_FORMAT = "YYYY-MM-DD HH:MM:SS"
+DATE_FORMAT = "YYYY-MM-DD"
+HEADER_FORMAT = {"bold": True, "border": 1, "align": "center", "valign": "top"}
+
+EXCEL_MAX_ROWS = 1048576
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def output_format(name: Optional[str]) -> str:
+    """
+    Validate a requested output format (defaults to xlsx).
+
+    Raises:
+        ValueError: Unknown format, or Parquet without pyarrow installed
+    """
+    name = (name or "xlsx").strip().lower()
+    if name not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format '{name}'. Use xlsx, csv or parquet.")
+    if name == "parquet" and not parquet_available():
+        raise ValueError("Parquet output is not available on this server.")
+    return name
+
+def download_name(basename: str, fmt: str) -> str:
+    return f"{basename}.{OUTPUT_FORMATS[fmt][1]}"
+
+def _excel_value(value):
+    """Convert a cell value the way pandas' Excel writer does, returning (value, num_format)"""
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value), None
+    if isinstance(value, (int, np.integer)):
+        return int(value), None
+    if isinstance(value, (float, np.floating)):
+        if np.isposinf(value):
+            return "inf", None
+        if np.isneginf(value):
+            return "-inf", None
+        return float(value), None
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            raise ValueError("Excel does not support datetimes with timezones.")
+        return value, DATETIME_FORMAT
+    if isinstance(value, date):
+        return value, DATE_FORMAT
+    if isinstance(value, timedelta):
+        return value.total_seconds() / 86400, "0"
+    return str(value), None
+
+def _write_sheet(workbook, df: pd.DataFrame, sheet_name: str, header, cell_format):
+    worksheet = workbook.add_worksheet(sheet_name)
+    for col, name in enumerate(df.columns):
+        worksheet.write(0, col, str(name), header)
+
+    columns = [df.iloc[:, col].to_numpy(dtype=object) for col in range(df.shape[1])]
+    missing = [pd.isna(values) for values in columns]
+    for row in range(len(df)):
+        for col, values in enumerate(columns):
+            if missing[col][row]:
+                continue
+            value, num_format = _excel_value(values[row])
+            worksheet.write(row + 1, col, value, cell_format(num_format))
+
+def write_xlsx(df: pd.DataFrame, path: str, sheet_name: str = "Sheet1", extra_sheets: Optional[Dict[str, pd.DataFrame]] = None):
+    """Write df (then any extra sheets, by name) to an .xlsx file row by row in constant memory"""
+    import xlsxwriter
+
+    sheets = {sheet_name: df, **(extra_sheets or {})}
+    for frame in sheets.values():
+        if len(frame) + 1 > EXCEL_MAX_ROWS:
+            raise ValueError(f"{len(frame)} rows don't fit in an Excel sheet. Use CSV or Parquet output.")
+
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+    try:
+        header = workbook.add_format(HEADER_FORMAT)
+        formats = {}
+
+        def cell_format(num_format):
+            if num_format is None:
+                return None
+            if num_format not in formats:
+                formats[num_format] = workbook.add_format({"num_format": num_format})
+            return formats[num_format]
+
+        # constant_memory writes each sheet in full before the next one starts
+        for name, frame in sheets.items():
+            _write_sheet(workbook, frame, name, header, cell_format)
+    finally:
+        workbook.close()
+
+def write_parquet(df: pd.DataFrame, path: str):
+    """Write df to Parquet; mixed-type object columns (e.g. numeric and text IDs) are stored as text"""
+    frame = df.copy(deep=False)
+    for col in frame.columns:
+        values = frame[col]
+        if isinstance(values.dtype, pd.CategoricalDtype) and values.cat.categories.dtype == object:
+            # Categories of mixed types would fail the same way
+            values = values.astype(object)
+        if values.dtype == object:
+            frame[col] = values.where(values.isna(), values.astype(str))
+    frame.to_parquet(path, index=False)
+
+def write_table(df: pd.DataFrame, path: str, fmt: str = "xlsx", sheet_name: str = "Sheet1",
+                extra_sheets: Optional[Dict[str, pd.DataFrame]] = None):
+    """Write df to path in the given output format (extra sheets need xlsx)"""
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format '{fmt}'")
+    if extra_sheets and fmt != "xlsx":
+        raise ValueError(f"{fmt} output holds a single sheet")
+    with stage("serialize", rows=len(df)):
+        if fmt == "xlsx":
+            write_xlsx(df, path, sheet_name, extra_sheets)
+        elif fmt == "csv":
+            df.to_csv(path, index=False)
+        else:
+            write_parquet(df, path)
+
+def spool_table(df: pd.DataFrame, fmt: str = "xlsx", sheet_name: str = "Sheet1",
+                extra_sheets: Optional[Dict[str, pd.DataFrame]] = None) -> str:
+    """
+    Write df to a new temporary file and return its path; the caller removes it
+    (e.g. once the response has been sent).
+    """
+    handle, path = tempfile.mkstemp(suffix="." + OUTPUT_FORMATS[fmt][1], dir=OUTPUT_SPOOL_DIR)
+    os.close(handle)
+    try:
+        write_table(df, path, fmt, sheet_name, extra_sheets)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path
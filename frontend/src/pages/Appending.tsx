@@ -22,6 +22,8 @@ const Appending: React.FC = () => {
     const [masterFile, setMasterFile] = useState<File | null>(null);
     const [loading, setLoading] = useState(false);
     const [enableToBeRemoved, setEnableToBeRemoved] = useState(false);
+    const [outputFormat, setOutputFormat] = useState<'xlsx' | 'csv'>('xlsx');
+    const [fuzzyDedup, setFuzzyDedup] = useState(false);
 
     // Fetch insurance configs on mount
     useEffect(() => {
@@ -46,7 +48,8 @@ const Appending: React.FC = () => {
 
     const fetchConfigs = async () => {
         try {
-            const response = await fetch(`${API_BASE_URL}/api/insurance-configs`, {
+            // Only ids and names are needed for the picker; unchanged lists come back as 304
+            const response = await fetch(`${API_BASE_URL}/api/insurance-configs?fields=name`, {
                 headers: {
                     'Authorization': `Bearer ${localStorage.getItem('authToken') || 'authenticated'}`,
                 },
@@ -93,6 +96,8 @@ const Appending: React.FC = () => {
             formData.append('masterFile', masterFile);
 
             formData.append('enableToBeRemoved', enableToBeRemoved ? 'true' : 'false');
+            formData.append('outputFormat', outputFormat);
+            formData.append('fuzzyDedup', fuzzyDedup ? 'true' : 'false');
             
             // Add care gap sheets with their config IDs
             fileUploads.forEach((upload, index) => {
@@ -119,7 +124,7 @@ const Appending: React.FC = () => {
                 const url = window.URL.createObjectURL(blob);
                 const a = document.createElement('a');
                 a.href = url;
-                a.download = 'merged_care_gaps.xlsx';
+                a.download = `merged_care_gaps.${outputFormat}`;
                 document.body.appendChild(a);
                 a.click();
                 
@@ -196,6 +201,48 @@ const Appending: React.FC = () => {
                             </div>
                         </label>
                     </div>
+
+                    {/* Fuzzy dedup toggle */}
+                    <div className="mt-4 pt-4 border-t border-slate-600/50">
+                        <label className="flex items-center gap-3 cursor-pointer group">
+                            <div className="relative">
+                                <input
+                                    type="checkbox"
+                                    checked={fuzzyDedup}
+                                    onChange={(e) => {
+                                        setFuzzyDedup(e.target.checked);
+                                        // The review sheet is a second worksheet, so fuzzy dedup needs Excel output
+                                        if (e.target.checked) {
+                                            setOutputFormat('xlsx');
+                                        }
+                                    }}
+                                    className="sr-only peer"
+                                />
+                                <div className="w-11 h-6 bg-slate-600/60 rounded-full peer-checked:bg-indigo-600/80 transition-all duration-200 border border-slate-500/50 peer-checked:border-indigo-400/50"></div>
+                                <div className="absolute left-1 top-1 w-4 h-4 bg-white rounded-full transition-all duration-200 peer-checked:translate-x-5"></div>
+                            </div>
+                            <div>
+                                <p className="text-white font-semibold text-sm group-hover:text-indigo-300 transition-colors">Remove near-duplicates?</p>
+                                <p className="text-white/60 text-xs">Also merge rows that differ in case, nicknames or DOB format; removed rows are listed on a review sheet</p>
+                            </div>
+                        </label>
+                    </div>
+
+                    {/* Output format */}
+                    <div className="mt-4 pt-4 border-t border-slate-600/50 flex items-center justify-between gap-3">
+                        <div>
+                            <p className="text-white font-semibold text-sm">Output format</p>
+                            <p className="text-white/60 text-xs">CSV is much faster to produce for large masters</p>
+                        </div>
+                        <select
+                            value={outputFormat}
+                            onChange={(e) => setOutputFormat(e.target.value as 'xlsx' | 'csv')}
+                            className="bg-slate-600/60 text-white text-sm rounded-lg border border-slate-500/50 px-3 py-1.5"
+                        >
+                            <option value="xlsx">Excel (.xlsx)</option>
+                            <option value="csv" disabled={fuzzyDedup}>CSV (.csv)</option>
+                        </select>
+                    </div>
                 </div>
 
                 {/* Insurance Config Selection */}
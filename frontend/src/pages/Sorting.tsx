@@ -1,5 +1,6 @@
 import React, { useState } from 'react';
 import Layout from '../Layout';
+import { uploadFiles } from '../uploadSession';
 
 const Sorting: React.FC = () => {
     const API_BASE_URL = (process.env.REACT_APP_API_BASE_URL || "http://localhost:5000").replace(/\/+$/, ''); // Remove trailing slashes
@@ -7,6 +8,8 @@ const Sorting: React.FC = () => {
     const [masterFile, setMasterFile] = useState<File | null>(null);
     const [pdfFiles, setPdfFiles] = useState<FileList | null>(null);
     const [loading, setLoading] = useState(false);
+    const [contentLookup, setContentLookup] = useState(false);
+    const [uploadProgress, setUploadProgress] = useState<string | null>(null);
 
     const handlePdfFolderChange = (e: React.ChangeEvent<HTMLInputElement>) => {
         if (e.target.files && e.target.files.length > 0) {
@@ -22,13 +25,22 @@ const Sorting: React.FC = () => {
 
         setLoading(true);
         try {
+            // Upload in resumable chunks first; the sort then reads the files by session id
+            const sessionId = await uploadFiles(
+                API_BASE_URL,
+                [
+                    { field: 'masterFile', file: masterFile },
+                    ...Array.from(pdfFiles).map((file) => ({ field: 'pdfFiles', file })),
+                ],
+                (sent, total) => setUploadProgress(`Uploading ${sent}/${total}`),
+            );
+            setUploadProgress(null);
+
             const formData = new FormData();
-            formData.append('masterFile', masterFile);
-            
-            // Convert FileList to Array before using forEach
-            Array.from(pdfFiles).forEach((file) => {
-                formData.append('pdfFiles', file);
-            });
+            formData.append('uploadSession', sessionId);
+            // Stream the ZIP back so large batches aren't capped by server memory
+            formData.append('stream', 'true');
+            formData.append('contentLookup', contentLookup.toString());
             
             const response = await fetch(`${API_BASE_URL}/api/sort-pdfs`, {
                 method: 'POST',
@@ -64,6 +76,7 @@ const Sorting: React.FC = () => {
             alert("Error connecting to server");
         } finally {
             setLoading(false);
+            setUploadProgress(null);
         }
     };
 
@@ -138,6 +151,26 @@ const Sorting: React.FC = () => {
                             )}
                         </div>
                     </label>
+
+                    {/* Content lookup toggle */}
+                    <div className="mt-4 pt-4 border-t border-slate-600/50">
+                        <label className="flex items-center gap-3 cursor-pointer group">
+                            <div className="relative">
+                                <input
+                                    type="checkbox"
+                                    checked={contentLookup}
+                                    onChange={(e) => setContentLookup(e.target.checked)}
+                                    className="sr-only peer"
+                                />
+                                <div className="w-11 h-6 bg-slate-600/60 rounded-full peer-checked:bg-indigo-600/80 transition-all duration-200 border border-slate-500/50 peer-checked:border-indigo-400/50"></div>
+                                <div className="absolute left-1 top-1 w-4 h-4 bg-white rounded-full transition-all duration-200 peer-checked:translate-x-5"></div>
+                            </div>
+                            <div>
+                                <p className="text-white font-semibold text-sm group-hover:text-indigo-300 transition-colors">Read member IDs from PDF text?</p>
+                                <p className="text-white/60 text-xs">Match PDFs whose filename has no member ID by their contents</p>
+                            </div>
+                        </label>
+                    </div>
                 </div>
 
                 {/* Sort Button */}
@@ -147,7 +180,7 @@ const Sorting: React.FC = () => {
                         disabled={!masterFile || !pdfFiles || pdfFiles.length === 0 || loading}
                         className="w-full bg-indigo-600/70 hover:bg-indigo-500/70 border border-indigo-500/50 text-white font-bold text-base px-6 py-3 rounded-lg transition-all duration-200 shadow-lg disabled:opacity-50 disabled:cursor-not-allowed"
                     >
-                        {loading ? "Processing..." : "Sort PDFs"}
+                        {loading ? (uploadProgress || "Processing...") : "Sort PDFs"}
                     </button>
                     {(!masterFile || !pdfFiles || pdfFiles.length === 0) && (
                         <p className="text-white/60 text-xs text-center mt-2">
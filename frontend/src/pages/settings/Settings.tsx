@@ -77,7 +77,13 @@ const Settings: React.FC = () => {
             }
 
             if (response.ok) {
-                alert("Gap Name Keys file uploaded successfully!");
+                const result = await response.json();
+                if (response.status === 200) {
+                    alert(`Gap Name Keys file is unchanged (still version ${result.version}).`);
+                } else {
+                    const { mappings_added, mappings_changed, mappings_removed } = result.changes;
+                    alert(`Gap Name Keys file uploaded as version ${result.version}: ${mappings_added} gap names added, ${mappings_changed} remapped, ${mappings_removed} removed.`);
+                }
                 setGapsFile(null);
                 fetchGapsFileInfo();
             } else {
@@ -119,7 +125,12 @@ const Settings: React.FC = () => {
                         
                         {gapsFileInfo?.exists && (
                             <div className="mb-3 p-2 bg-green-500/10 border border-green-500/50 rounded text-green-400 text-sm text-center">
-                                ✓ File uploaded ({gapsFileInfo.row_count} rows)
+                                ✓ Version {gapsFileInfo.version} uploaded ({gapsFileInfo.row_count} rows)
+                                {gapsFileInfo.changes && gapsFileInfo.base_version && (
+                                    <div className="text-green-400/70 text-xs mt-1">
+                                        vs. version {gapsFileInfo.base_version}: {gapsFileInfo.changes.rows_added} rows added, {gapsFileInfo.changes.rows_changed} changed, {gapsFileInfo.changes.rows_removed} removed
+                                    </div>
+                                )}
                             </div>
                         )}
                         
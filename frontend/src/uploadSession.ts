@@ -0,0 +1,107 @@
+// Chunked, resumable uploads (see backend/upload_sessions.py).
+//
+// Files are declared up front, sent in chunks with a sha256 each, and the session is
+// finalized once the server has every chunk; a dropped connection only costs the chunks
+// that hadn't arrived. The returned session id is passed to the merge/sort routes as
+// `uploadSession` in place of the files themselves.
+
+export interface SessionFile {
+    field: string;
+    file: File;
+}
+
+interface SessionStatus {
+    chunks_missing: number;
+    incomplete: { file: number; missing: number[] }[];
+}
+
+const PARALLEL_CHUNKS = 4;
+const ATTEMPTS = 5;
+
+const toHex = (buffer: ArrayBuffer) =>
+    Array.from(new Uint8Array(buffer)).map((b) => b.toString(16).padStart(2, '0')).join('');
+
+const sleep = (ms: number) => new Promise((resolve) => setTimeout(resolve, ms));
+
+export async function uploadFiles(
+    apiBaseUrl: string,
+    files: SessionFile[],
+    onProgress?: (sent: number, total: number) => void,
+): Promise<string> {
+    const auth = { 'Authorization': `Bearer ${localStorage.getItem('authToken') || 'authenticated'}` };
+
+    const created = await fetch(`${apiBaseUrl}/api/uploads`, {
+        method: 'POST',
+        headers: { ...auth, 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            files: files.map(({ field, file }) => ({ name: file.name, size: file.size, field })),
+        }),
+    });
+    if (!created.ok) {
+        throw new Error((await created.json()).message);
+    }
+    const session = await created.json();
+    const sessionUrl = `${apiBaseUrl}/api/uploads/${session.id}`;
+    const chunkSize: number = session.chunk_size;
+
+    const sendChunk = async (index: number, chunk: number) => {
+        const data = await files[index].file.slice(chunk * chunkSize, (chunk + 1) * chunkSize).arrayBuffer();
+        const checksum = toHex(await crypto.subtle.digest('SHA-256', data));
+        const response = await fetch(`${sessionUrl}/files/${index}/chunks/${chunk}`, {
+            method: 'PUT',
+            headers: { ...auth, 'Content-Type': 'application/octet-stream', 'X-Chunk-Sha256': checksum },
+            body: data,
+        });
+        if (!response.ok) {
+            throw new Error((await response.json()).message);
+        }
+    };
+
+    // Sends the given chunks and returns the ones that failed
+    const sendAll = async (chunks: [number, number][]) => {
+        const queue = [...chunks];
+        const failed: [number, number][] = [];
+        let sent = 0;
+        const worker = async () => {
+            for (let next = queue.shift(); next; next = queue.shift()) {
+                try {
+                    await sendChunk(next[0], next[1]);
+                } catch (error) {
+                    // Retried on the next pass
+                    console.error('Chunk upload failed:', error);
+                    failed.push(next);
+                }
+                onProgress?.(++sent, chunks.length);
+            }
+        };
+        await Promise.all(Array.from({ length: PARALLEL_CHUNKS }, worker));
+        return failed;
+    };
+
+    let pending: [number, number][] = session.files.flatMap((file: { index: number; chunks: number }) =>
+        Array.from({ length: file.chunks }, (_, chunk) => [file.index, chunk] as [number, number]));
+    for (let attempt = 1; attempt <= ATTEMPTS; attempt++) {
+        // Without a status from the server, the chunks that failed here are sent again
+        pending = await sendAll(pending);
+        try {
+            const response = await fetch(sessionUrl, { headers: auth });
+            if (response.ok) {
+                const status: SessionStatus = await response.json();
+                pending = status.incomplete.flatMap(({ file, missing }) =>
+                    missing.map((chunk) => [file, chunk] as [number, number]));
+            }
+        } catch (error) {
+            console.error('Upload status check failed:', error);
+        }
+        if (pending.length === 0) {
+            break;
+        }
+        await sleep(1000 * attempt);
+    }
+
+    const finalized = await fetch(`${sessionUrl}/finalize`, { method: 'POST', headers: auth });
+    if (!finalized.ok) {
+        throw new Error((await finalized.json()).message);
+    }
+    return session.id;
+}